@@ -1,20 +1,92 @@
-from flask import Flask, request
+from werkzeug.wrappers import Request, Response
 import functions_framework
 import logging
 logging.basicConfig(level=logging.INFO)
 from google.cloud import pubsub_v1
 import os
 import gcsfs
+import fsspec
 import json
+import hashlib
+import secrets
 import requests
+import requests.adapters
+import threading
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 PROJECT_ID = os.environ.get('PROJECT_ID')
 EVENT_BUS = os.environ.get('EVENT_BUS')
 SPODKAST_ROUTE = "gs://yggdrasil-ai-hermod-spodkast/{owner}/{id}"
 ENTITY = "spodkast"
+FILESYSTEM_PROTOCOL = os.environ.get('FILESYSTEM_PROTOCOL', 'gs')
+# Connections kept alive per host by the shared HTTP session
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+# Size of the blocks streamed while downloading input files
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+# Input files downloaded at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+# Largest input file accepted, and largest total accepted per request
+MAX_INPUT_FILE_BYTES = int(os.environ.get('MAX_INPUT_FILE_BYTES', 64 * 1024 * 1024))
+MAX_INPUT_BYTES = int(os.environ.get('MAX_INPUT_BYTES', 256 * 1024 * 1024))
+# Input files are downloaded into the document store shared with the event manager,
+# and workspaces only keep links to them
+DOCUMENT_STORE_ENABLED = os.environ.get('DOCUMENT_STORE_ENABLED', '1') != '0'
+DOCUMENT_STORE_ROUTE = os.environ.get('DOCUMENT_STORE_ROUTE', "gs://yggdrasil-ai-hermod-spodkast/_documents")
+DOCUMENT_FILE = "document.pdf"
+DOCUMENT_LINK_SUFFIX = ".link"
+# Actions published to the agents, their arguments are validated against it
+ACTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "actions.json")
 
-APP = Flask("internal")
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+    """
+    Returns the client registered as name, building it with factory the first time.
+    Clients are shared by every thread and reused across warm invocations.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+def get_filesystem(protocol=None):
+    """
+    This function returns the shared fsspec filesystem for protocol.
+    Parameters:
+        protocol: fsspec protocol, FILESYSTEM_PROTOCOL by default
+    """
+    protocol = protocol or FILESYSTEM_PROTOCOL
+    def factory():
+        if protocol in ("gs", "gcs"):
+            return gcsfs.GCSFileSystem(project=PROJECT_ID)
+        if protocol in ("file", "local"):
+            # Object stores have no directories, local paths need them created
+            return fsspec.filesystem(protocol, auto_mkdir=True)
+        return fsspec.filesystem(protocol)
+    return _get_client(f"filesystem:{protocol}", factory)
+
+def get_publisher():
+    return _get_client("publisher", pubsub_v1.PublisherClient)
+
+def get_http_session():
+    """
+    This function returns the shared requests session, which keeps alive
+    up to HTTP_POOL_SIZE connections per host.
+    """
+    def factory():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _get_client("http_session", factory)
 
 def publish_message(author:str, operation:str, entity_id:str, payload:str):
     """
@@ -30,36 +102,167 @@ def publish_message(author:str, operation:str, entity_id:str, payload:str):
         "entityId": entity_id,
         "operation": operation,
         "timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        # Tells this event apart from identical requests, so only its own redeliveries are skipped
+        "requestId": secrets.token_hex(16),
         "payload": payload
     }
     message_json = json.dumps(message).encode("utf-8")
     print("Publishing ", message_json)
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
     topic_path = publisher.topic_path(PROJECT_ID, EVENT_BUS)
     publish_future = publisher.publish(topic_path,
                                         data=message_json)
     publish_future.result()
 
 def read_file(file):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+    fs = get_filesystem()
     with fs.open(file, 'r') as f:
         content = f.read()
     return content
 
 def write_to_file(file, content):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+    fs = get_filesystem()
     with fs.open(file, "w") as file_:
         file_.write(content)
 
-def download_file(url, destiny_file):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-    with requests.get(url, stream=True) as r:
+class ByteBudget:
+    """
+    Bytes left to download for one request, shared by its download threads.
+    """
+    def __init__(self, limit):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, size, source):
+        with self._lock:
+            if size > self.remaining:
+                raise ValueError(f"Input files exceed {MAX_INPUT_BYTES} bytes while downloading {source}")
+            self.remaining -= size
+
+def download_file(url, destiny_file, budget=None, max_bytes=None):
+    """
+    This function streams url into destiny_file, removing it if the download fails.
+    Parameters:
+        url: Url of the file
+        destiny_file: Where to save the file
+        budget: ByteBudget shared with the other files of the request
+        max_bytes: Largest size accepted, MAX_INPUT_FILE_BYTES by default
+    """
+    max_bytes = MAX_INPUT_FILE_BYTES if max_bytes is None else max_bytes
+    fs = get_filesystem()
+    with get_http_session().get(url, stream=True) as r:
         r.raise_for_status()
-        with fs.open(destiny_file, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+        # Refuse oversized files before transferring anything
+        length = r.headers.get('Content-Length')
+        if length is not None and int(length) > max_bytes:
+            raise ValueError(f"{url} is larger than {max_bytes} bytes")
+        written = 0
+        try:
+            with fs.open(destiny_file, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"{url} is larger than {max_bytes} bytes")
+                    if budget is not None:
+                        budget.take(len(chunk), url)
+                    f.write(chunk)
+        except Exception:
+            if fs.exists(destiny_file):
+                fs.rm(destiny_file)
+            raise
     return destiny_file
-    
+
+def document_path(digest, name=DOCUMENT_FILE):
+    return f"{DOCUMENT_STORE_ROUTE}/{digest}/{name}"
+
+def store_document(url, budget=None, max_bytes=None):
+    """
+    This function downloads url into the document store, unless it already holds the same
+    bytes, and returns their sha256. It keeps the layout of the event manager DocumentStore:
+    the validators of the last download of url are sent, so files that didn't change
+    are not transferred again.
+    Parameters:
+        url: Url of the file
+        budget: ByteBudget shared with the other files of the request
+        max_bytes: Largest size accepted, MAX_INPUT_FILE_BYTES by default
+    """
+    max_bytes = MAX_INPUT_FILE_BYTES if max_bytes is None else max_bytes
+    fs = get_filesystem()
+    index_file = f"{DOCUMENT_STORE_ROUTE}/_urls/{hashlib.sha256(url.encode()).hexdigest()}.json"
+    try:
+        known = json.loads(read_file(index_file))
+    except (FileNotFoundError, ValueError):
+        known = None
+    headers = {}
+    if known and fs.exists(document_path(known["sha256"])):
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+    with get_http_session().get(url, stream=True, headers=headers) as r:
+        if r.status_code == 304 and headers:
+            return known["sha256"]
+        r.raise_for_status()
+        # Refuse oversized files before transferring anything
+        length = r.headers.get('Content-Length')
+        if length is not None and int(length) > max_bytes:
+            raise ValueError(f"{url} is larger than {max_bytes} bytes")
+        incoming = f"{DOCUMENT_STORE_ROUTE}/_incoming/{secrets.token_hex(16)}"
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            with fs.open(incoming, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"{url} is larger than {max_bytes} bytes")
+                    if budget is not None:
+                        budget.take(len(chunk), url)
+                    digest.update(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            if not fs.exists(document_path(sha256)):
+                fs.mv(incoming, document_path(sha256))
+        finally:
+            if fs.exists(incoming):
+                fs.rm(incoming)
+        write_to_file(index_file, json.dumps({"sha256": sha256, "etag": r.headers.get("ETag"),
+                                              "last_modified": r.headers.get("Last-Modified")}))
+    return sha256
+
+def link_document(digest, file, url=None):
+    """
+    This function writes the link to the stored document digest as file plus DOCUMENT_LINK_SUFFIX,
+    and leaves a reference to the document from it. Returns the link file.
+    """
+    link_file = file + DOCUMENT_LINK_SUFFIX
+    write_to_file(link_file, json.dumps({"sha256": digest, "document": document_path(digest), "url": url}))
+    write_to_file(document_path(digest, f"refs/{hashlib.sha256(link_file.encode()).hexdigest()}"), link_file)
+    return link_file
+
+def download_files(urls, folder):
+    """
+    This function downloads urls into folder concurrently and returns the saved files in order.
+    With DOCUMENT_STORE_ENABLED, the files are downloaded into the document store and linked from folder.
+    The first failure cancels the downloads not yet started and is raised.
+    Parameters:
+        urls: Urls of the files
+        folder: Folder where the files are saved
+    """
+    budget = ByteBudget(MAX_INPUT_BYTES)
+    def download(url):
+        filename = url.split('/')[-1]
+        logging.info(f"Downloading {filename}")
+        if DOCUMENT_STORE_ENABLED:
+            return link_document(store_document(url, budget=budget), f"{folder}/{filename}", url=url)
+        return download_file(url, f"{folder}/{filename}", budget=budget)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(urls))))
+    try:
+        futures = [executor.submit(download, url) for url in urls]
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(cancel_futures=True)
+
 def parse_sections(text):
     # Split the text into sections
     sections = text.split("#section")[1:]  # The first item is empty, so we skip it
@@ -69,159 +272,151 @@ def parse_sections(text):
 
     return sections
 
-@APP.route('/', methods=['GET', 'POST'])
-def unknown_operation():
-    response = APP.response_class(
-        response="Incomplete path, please select an operation",
-        status=400,
-        mimetype='text/plain')
-    return response
-
-@APP.route('/extend', methods=['POST', ])
-def extend_sections():
-    logging.info("Received request to extend sections: {}".format(request))
-    request_json = json.loads(request.data)
-    author = request_json["author"]
-    if request_json["author"] == "#spokeAgent#":
-        author = request_json["conversationId"].split(".")[0]
-    user = request_json["user"] if request_json["user"]!="undefined" else author
-    name = request_json["name"]
-    
-    publish_message(author=author, operation="extend", entity_id=name, payload=json.dumps(request_json))
-
-    response = APP.response_class(
-        response=json.dumps({"payload":{
-            "user": user,
-            "id": name
-            },
-            "responseMessage": f"Generating sections"}),
-        status=200,
-        mimetype='text/plain')
-    return response
-
-@APP.route('/produce', methods=['POST', ])
-def produce_spodkast():
-    logging.info("Received request to produce podcast: {}".format(request))
-    request_json = json.loads(request.data)
-    author = request_json["author"]
-    if request_json["author"] == "#spokeAgent#":
-        author = request_json["conversationId"].split(".")[0]
-    user = request_json["user"] if request_json["user"]!="undefined" else author
-    name = request_json["name"]
-    
-    # Generate podcast
-    publish_message(author=author, operation="produce", entity_id=name, payload=json.dumps(request_json))
-
-    response = APP.response_class(
-        response=json.dumps({"payload":{
-            "user": user,
-            "id": name
-            },
-            "responseMessage": f"Producing podcast"}),
-        status=200,
-        mimetype='text/plain')
-    return response
-
-@APP.route('/export', methods=['POST', ])
-def export_spodkast():
-    logging.info("Received request to export podcast: {}".format(request))
-    request_json = json.loads(request.data)
-    author = request_json["author"]
-    if request_json["author"] == "#spokeAgent#":
-        author = request_json["conversationId"].split(".")[0]
-    user = request_json["user"] if request_json["user"]!="undefined" else author
-    name = request_json["name"]
-    
-    # Generate podcast
-    publish_message(author=author, operation="export", entity_id=name, payload=json.dumps(request_json))
-
-    response = APP.response_class(
-        response=json.dumps({"payload":{
-            "user": user,
-            "id": name
-            },
-            "responseMessage": f"Exporting podcast"}),
-        status=200,
-        mimetype='text/plain')
-    return response
-
-@APP.route('/create', methods=['POST', ])
-def create_spodkast():
-    logging.info("Received request: {}".format(request))
-    request_json = json.loads(request.data)
-    author = request_json["author"]
-    if request_json["author"] == "#spokeAgent#":
-        author = request_json["conversationId"].split(".")[0]
-    user = request_json["user"] if request_json["user"]!="undefined" else author
-    name = request_json["name"]
-    requirements = request_json["requirements"]
-    notification_mail = request_json["notificationMail"]
-    files = [file.strip() for file in request_json["inputFiles"].split(',') if file.strip()!='']
+class InvalidRequest(ValueError):
+    """Raised when a request doesn't match the arguments of its action."""
+
+class ActionSchema:
+    """
+    Arguments of an action in actions.json, compiled once: the ones every request must include,
+    the defaults of the others and the ones that must be strings.
+    """
+    def __init__(self, args):
+        self.required = tuple(name for name, arg in args.items() if arg.get("required"))
+        self.defaults = {name: arg["default"] for name, arg in args.items()
+                         if not arg.get("required") and "default" in arg}
+        self.strings = tuple(name for name, arg in args.items() if arg.get("type") == "string")
+
+    def parse(self, data):
+        """
+        This function parses the body of a request. Returns its arguments, with the defaults
+        of the ones it doesn't include. Raises InvalidRequest if it doesn't match the schema.
+        """
+        try:
+            payload = json.loads(data)
+        except ValueError as e:
+            raise InvalidRequest(f"Invalid JSON body: {e}")
+        if not isinstance(payload, dict):
+            raise InvalidRequest("The body must be a JSON object")
+        missing = [name for name in self.required if name not in payload]
+        if missing:
+            raise InvalidRequest(f"Missing arguments: {', '.join(missing)}")
+        for name in self.strings:
+            if name in payload and not isinstance(payload[name], str):
+                raise InvalidRequest(f"{name} must be a string")
+        return {**self.defaults, **payload}
+
+def resolve_owner(payload):
+    """Returns the author of a request and the user owning its podcast."""
+    author = payload["author"]
+    if author == "#spokeAgent#":
+        if not isinstance(payload.get("conversationId"), str):
+            raise InvalidRequest("Requests of #spokeAgent# need a conversationId")
+        author = payload["conversationId"].split(".")[0]
+    user = payload["user"] if payload.get("user", "undefined") != "undefined" else author
+    return author, user
+
+def _response(body, status=200):
+    return Response(response=json.dumps(body), status=status, mimetype='text/plain')
+
+def _error(error, status=400):
+    return _response({"payload": {"error": error}, "responseMessage": f"ERROR: {error}"}, status=status)
+
+def _publishing_handler(operation, message):
+    """Returns the handler of an operation that is only published to the event manager."""
+    def handler(payload, author, user):
+        publish_message(author=author, operation=operation, entity_id=payload["name"], payload=json.dumps(payload))
+        return _response({"payload": {"user": user, "id": payload["name"]}, "responseMessage": message})
+    return handler
+
+def create_spodkast(payload, author, user):
+    name = payload["name"]
+    requirements = payload["requirements"]
+    notification_mail = payload["notificationMail"]
+    files = [file.strip() for file in payload["inputFiles"].split(',') if file.strip()!='']
 
     # Ensure workspace setup
     assigned_folder = SPODKAST_ROUTE.format(owner=user, id=name)
     logging.info(f"Ensuring {assigned_folder} setup")
     if requirements == "undefined":
         logging.info("Reading requirements")
-        requirements = read_file(f"{assigned_folder}/requirements.txt")
+        try:
+            requirements = read_file(f"{assigned_folder}/requirements.txt")
+        except FileNotFoundError:
+            return _error(f"No requirements given, and {assigned_folder} has none")
     else:
         logging.info("Writing requirements")
         write_to_file(f"{assigned_folder}/requirements.txt", requirements)
     if notification_mail!="undefined":
         logging.info("Writing notification mail")
         write_to_file(f"{assigned_folder}/mail.txt", notification_mail)
-    owned_files = []
-    if len(files) > 0 and files[0]!="undefined":
-        for file in [x.strip() for x in files]:
-            filename = file.split('/')[-1]
-            logging.info(f"Downloading {filename}")
-            saved_file = download_file(file, f'{assigned_folder}/input_files/{filename}')
-            owned_files += [saved_file]
-    else:
+    if len(files) == 0 or files[0]=="undefined":
         logging.error("No input files")
-        response = APP.response_class(
-            response=json.dumps({"payload": {
-                "error": "No input files"
-            },
-            "responseMessage": "ERROR: No input files"}),
-            status=200,
-            mimetype='text/plain'
-        )
-        return response
-
-    publish_message(author=author, operation="create", entity_id=name, payload=json.dumps(request_json))
-
-    response = APP.response_class(
-        response=json.dumps({"payload":{
-            "workspace": assigned_folder,
-            "id": name
-        },
-        "responseMessage": f"Creation of {name} started in {assigned_folder}"}),
-        status=200,
-        mimetype='text/plain')
-    return response
-    
-    
+        return _error("No input files")
+    if payload["asyncDownload"] == "1":
+        # The event manager downloads the files and reports its progress in the workspace
+        logging.info(f"Leaving {len(files)} input files to be downloaded in the background")
+        message = f"Creation of {name} started in {assigned_folder}, follow it in {assigned_folder}/progress.json"
+    else:
+        try:
+            download_files(files, f"{assigned_folder}/input_files")
+        except (ValueError, requests.RequestException) as e:
+            logging.error(f"Could not download input files: {e}")
+            return _error(f"Could not download input files: {e}")
+        message = f"Creation of {name} started in {assigned_folder}"
+
+    publish_message(author=author, operation="create", entity_id=name, payload=json.dumps(payload))
+
+    return _response({"payload": {"workspace": assigned_folder, "id": name}, "responseMessage": message})
+
+HANDLERS = {
+    "create": create_spodkast,
+    "extend": _publishing_handler("extend", "Generating sections"),
+    "produce": _publishing_handler("produce", "Producing podcast"),
+    "export": _publishing_handler("export", "Exporting podcast"),
+}
+
+def load_routes(actions_file=ACTIONS_FILE):
+    """
+    This function maps the path of each action in actions_file, its name without the
+    -spodkast suffix, to its handler and the schema of its arguments.
+    """
+    with open(actions_file) as f:
+        actions = json.load(f)
+    routes = {}
+    for action, definition in actions.items():
+        operation = action[:-len("-spodkast")] if action.endswith("-spodkast") else action
+        routes[f"/{operation}"] = (HANDLERS[operation], ActionSchema(definition["args"]))
+    return routes
+
+ROUTES = load_routes()
+
 @functions_framework.http
 def actions_spodkast(request):
-    internal_ctx = APP.test_request_context(path=request.full_path,
-                                            method=request.method)
-    internal_ctx.request.data = request.data
-    internal_ctx.request.headers = request.headers
-    internal_ctx.request.args = request.args
-    
-    APP.config['PRESERVE_CONTEXT_ON_EXCEPTION']=False
-    
-    return_value = APP.response_class(
-        response="Invalid Request", 
-        status=400,
-        mimetype='text/plain')
-    
+    """
+    HTTP entry point, routing each request on its path to the handler of its action
+    with its arguments parsed and validated.
+    """
+    route = ROUTES.get(request.path)
+    if route is None:
+        if request.path in ("", "/"):
+            return _error("Incomplete path, please select an operation")
+        return _error(f"Unknown operation {request.path}", status=404)
+    if request.method != "POST":
+        return _error(f"{request.path} only accepts POST requests", status=405)
+    handler, schema = route
+    logging.info(f"Received request to {request.path}")
+    try:
+        payload = schema.parse(request.get_data())
+        author, user = resolve_owner(payload)
+    except InvalidRequest as e:
+        logging.info(f"Invalid request to {request.path}: {e}")
+        return _error(str(e))
     try:
-        internal_ctx.push()
-        return_value = APP.full_dispatch_request()
-        logging.info("Request processed: {}".format(return_value))
-        internal_ctx.pop()
-    except Exception as e:
-        logging.error(e)
-    return return_value
\ No newline at end of file
+        return handler(payload, author, user)
+    except Exception:
+        logging.exception(f"Request to {request.path} failed")
+        return _error("Internal error, the request could not be processed", status=500)
+
+def application(environ, start_response):
+    """WSGI application serving actions_spodkast, to run it locally or test it."""
+    return actions_spodkast(Request(environ))(environ, start_response)
@@ -0,0 +1,320 @@
+"""
+Batch runner for backfills over many spodkasts.
+
+Runs operations of the event manager, e.g. after a prompt change or a new voice, over the
+podcasts listed in a manifest, without going through Pub/Sub and cold starts. The podcasts are
+spread over a pool of processes, each one running the stages of its podcasts in the same way
+the event manager does, with its HTTP sessions, caches and rate limiters shared by all of them.
+The rate limits of the event manager are split between the processes, so together they stay
+within them.
+
+The manifest lists one operation per line, as CSV (user,id,operation) or as a JSON object with
+those keys and, optionally, a payload with fields of the event payload. The operations of each
+podcast run in order, and with slow=0, the default, each one runs the following ones too.
+
+    python backfill.py podcasts.csv --processes 4
+    python backfill.py podcasts.csv --processes 4 --env VOICE_SECTION=<voice id> --output backfill.json
+
+Every finished operation is appended to a checkpoint, podcasts.csv.checkpoint by default, and
+running the same manifest again resumes from it. Operations already handled in this backfill
+are also skipped by the event ledger of their workspace, while those of other backfills or
+requests are run again.
+
+The event manager never prunes its storage while handling events. With --prune, documents no
+workspace linked in DOCUMENT_TTL and expired cache entries are deleted, after the backfill or on
+their own, e.g. daily from a scheduled job:
+
+    python backfill.py --prune
+"""
+import argparse
+import csv
+import json
+import logging
+import math
+import multiprocessing
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Settings of the event manager split between the processes, as their names in the
+# event manager module and in the environment
+PARTITIONED_LIMITS = (
+    "LLM_REQUESTS_PER_MINUTE",
+    "LLM_TOKENS_PER_MINUTE",
+    "LLM_MAX_CONCURRENCY",
+    "TTS_REQUESTS_PER_MINUTE",
+    "TTS_CHARACTERS_PER_MINUTE",
+    "TTS_VOICE_CONCURRENCY",
+    "INGESTION_PROCESSES",
+)
+
+_event_manager = None
+
+def load_event_manager():
+    """
+    This function imports the event manager. It is imported as main, so its ingestion
+    workers can import it too.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "spodkast_event_manager"))
+    import main as event_manager
+    return event_manager
+
+def read_manifest(path):
+    """
+    This function reads the operations of a backfill manifest, in order and without repetitions.
+    Returns a list of dicts with the user, id, operation, payload and key of each operation.
+    """
+    operations = {}
+    with open(path, newline="") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+            else:
+                fields = next(csv.reader([line]))
+                if fields == ["user", "id", "operation"]:
+                    continue
+                if len(fields) != 3:
+                    raise ValueError(f"{path}:{number}: expected user,id,operation, got {line}")
+                entry = dict(zip(("user", "id", "operation"), (field.strip() for field in fields)))
+            key = f"{entry['user']}/{entry['id']}/{entry['operation']}"
+            operations.setdefault(key, {"user": entry["user"], "id": entry["id"], "operation": entry["operation"],
+                                        "payload": entry.get("payload", {}), "key": key})
+    return list(operations.values())
+
+class Checkpoint:
+    """
+    Progress of a backfill, a JSON line per finished operation after a header with the id of the run.
+    Lines are flushed to disk as they are written, so a backfill stopped at any point resumes from them.
+    """
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.run = None
+        self.done = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line of a run that was killed while writing it
+                        continue
+                    if "run" in record:
+                        self.run = record["run"]
+                    elif record.get("status") == "done":
+                        self.done.add(record["key"])
+        self._file = open(path, "a")
+        if self.run is None:
+            self.run = secrets.token_hex(8)
+            self.write({"run": self.run, "started": time.time()})
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+def partition_limits(event_manager, processes):
+    """
+    This function splits the rate limits and concurrencies of the event manager between processes.
+    Returns the environment of the processes. Limits of 0, which mean no limit, are kept.
+    """
+    environment = {}
+    for name in PARTITIONED_LIMITS:
+        value = getattr(event_manager, name)
+        if value:
+            environment[name] = str(max(1, value // processes))
+    return environment
+
+def _init_worker(notify, level):
+    global _event_manager
+    logging.basicConfig(level=level)
+    _event_manager = load_event_manager()
+    if not notify:
+        _event_manager._make_authorized_post_request = _skip_notification
+
+def _skip_notification(endpoint, payload):
+    logging.info("Not notifying the user of the backfilled podcast")
+
+def run_podcast(operations, run):
+    """
+    This function runs the operations of a podcast in order, in a worker process.
+    Returns the result of each operation run, stopping after the first one that fails.
+    Parameters:
+        operations: Operations of the podcast, as read from the manifest
+        run: Id of the backfill, part of the requestId of every event, so the event ledger skips the
+             operations this backfill already ran and only those
+    """
+    event_manager = _event_manager
+    results = []
+    for operation in operations:
+        event = {
+            "author": operation["user"],
+            "entity": event_manager.ENTITY,
+            "entityId": operation["id"],
+            "operation": operation["operation"],
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "requestId": f"backfill-{run}-{operation['key']}",
+            "payload": json.dumps({"user": operation["user"], "slow": "0", **operation["payload"]}),
+        }
+        result = {"key": operation["key"], "status": "done", "duplicate": False}
+        started = time.perf_counter()
+        try:
+            if operation["operation"] not in event_manager.OPERATIONS:
+                raise ValueError(f"Unknown operation {operation['operation']}")
+            workspace = event_manager.event_workspace(operation["user"], operation["id"], json.loads(event["payload"]))
+            # Handled by this backfill before it was stopped, the event manager skips it
+            result["duplicate"] = event_manager.IDEMPOTENCY_ENABLED and bool(
+                event_manager.EventLedger(workspace).lookup(event_manager.event_key(event)))
+            # Every stage runs in this process, however long the podcast takes
+            event_manager._dispatch_event(event, deadline=event_manager.EventDeadline(budget=math.inf),
+                                          message_id=f"backfill-{run}")
+        except Exception as e:
+            logging.exception(f"Backfill of {operation['key']} failed")
+            result.update(status="failed", error=repr(e))
+        finally:
+            event_manager.export_spans()
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        results.append(result)
+        if result["status"] == "failed":
+            break
+    return results
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def at(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+    return {"count": len(values), "p50_s": at(0.5), "p95_s": at(0.95), "max_s": values[-1]}
+
+def prune_storage():
+    """
+    This function deletes the expired documents of the document store, the expired entries of
+    the LLM and TTS caches, keeping the TTS cache within TTS_CACHE_MAX_BYTES, and the texts
+    spilled by invocations that crashed before reading them.
+    Returns the stats of the document store.
+    """
+    event_manager = load_event_manager()
+    stats = event_manager.DOCUMENT_STORE.prune() if event_manager.DOCUMENT_STORE_ENABLED else None
+    event_manager.prune_spilled_pages()
+    if event_manager.LLM_CACHE_ENABLED:
+        event_manager.LLM_CACHE.prune()
+    if event_manager.TTS_CACHE_ENABLED:
+        event_manager.TTS_CACHE.prune(event_manager.TTS_CACHE_MAX_BYTES or None)
+    return stats
+
+def run_backfill(args):
+    """
+    This function runs the operations of the manifest that aren't in the checkpoint yet.
+    Returns the report of the run.
+    """
+    operations = read_manifest(args.manifest)
+    checkpoint = Checkpoint(args.checkpoint or f"{args.manifest}.checkpoint", restart=args.restart)
+    pending = [operation for operation in operations if operation["key"] not in checkpoint.done]
+    podcasts = {}
+    for operation in pending:
+        podcasts.setdefault((operation["user"], operation["id"]), []).append(operation)
+    processes = max(1, min(args.processes, len(podcasts)))
+
+    event_manager = load_event_manager()
+    # Spawned processes take the environment of this one
+    os.environ.update(partition_limits(event_manager, processes))
+    os.environ.setdefault("LEASE_SECONDS", str(args.lease_seconds))
+    logging.info(f"Backfill {checkpoint.run}: {len(pending)} of {len(operations)} operations "
+                 f"over {len(podcasts)} podcasts in {processes} processes")
+
+    seconds = []
+    counts = {"done": 0, "duplicates": 0, "failed": 0, "not_run": 0}
+    completed_podcasts = 0
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(args.notify, logging.getLogger().level)) as pool:
+            futures = {pool.submit(run_podcast, podcast, checkpoint.run): podcast for podcast in podcasts.values()}
+            for future in as_completed(futures):
+                podcast = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # The worker process died, its operations run again when the backfill is resumed
+                    logging.error(f"Backfill of {podcast[0]['user']}/{podcast[0]['id']} failed: {e!r}")
+                    results = [{"key": podcast[0]["key"], "status": "failed", "error": repr(e)}]
+                for result in results:
+                    if result["status"] == "done":
+                        checkpoint.write(result)
+                        seconds.append(result["seconds"])
+                    counts[result["status"]] += 1
+                    counts["duplicates"] += result.get("duplicate", False)
+                counts["not_run"] += len(podcast) - len(results)
+                if all(result["status"] == "done" for result in results) and len(results) == len(podcast):
+                    completed_podcasts += 1
+                elapsed = time.perf_counter() - started
+                print(f"[{completed_podcasts}/{len(podcasts)}] {podcast[0]['user']}/{podcast[0]['id']} "
+                      f"{results[-1]['status']}, {completed_podcasts / elapsed * 3600:.1f} podcasts/hour", flush=True)
+    finally:
+        checkpoint.close()
+    wall = time.perf_counter() - started
+    return {
+        "run": checkpoint.run,
+        "operations": len(operations),
+        "resumed": len(operations) - len(pending),
+        **counts,
+        "podcasts": len(podcasts),
+        "completed_podcasts": completed_podcasts,
+        "processes": processes,
+        "wall_seconds": round(wall, 3),
+        "podcasts_per_hour": round(completed_podcasts / wall * 3600, 1) if wall else 0.0,
+        "operation_seconds": percentiles(seconds),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run operations of the event manager over many spodkasts")
+    parser.add_argument("manifest", nargs="?", help="CSV (user,id,operation) or JSON lines of the operations to run")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Podcasts handled at the same time")
+    parser.add_argument("--checkpoint", help="Progress of the backfill, the manifest path plus .checkpoint by default")
+    parser.add_argument("--restart", action="store_true", help="Discard the checkpoint and run every operation again")
+    parser.add_argument("--lease-seconds", type=int, default=3600,
+                        help="Lease of each workspace, longer than any podcast takes")
+    parser.add_argument("--notify", action="store_true", help="Mail the users their exported podcasts")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Setting of the event manager, can be repeated")
+    parser.add_argument("--prune", action="store_true",
+                        help="Delete expired documents and cache entries, after the backfill if there is a manifest")
+    parser.add_argument("--output", help="Save the report as JSON")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if not args.manifest and not args.prune:
+        parser.error("a manifest or --prune is required")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    # Spans are only useful in the logs of the cloud function
+    os.environ.setdefault("TRACE_EXPORTER", "none")
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+    report = run_backfill(args) if args.manifest else {"failed": 0}
+    if args.prune:
+        report["pruned"] = prune_storage()
+    for key, value in report.items():
+        print(f"  {key}: {value}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
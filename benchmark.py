@@ -0,0 +1,1111 @@
+"""
+Offline benchmark of the spodkast pipeline.
+
+The actions_spodkast routes and spodkast_event_manager run in this process against local
+stand-ins: fake OpenAI and TTS servers with configurable latency and error rates, an fsspec
+local or memory filesystem in place of GCS and an in-process Pub/Sub queue. Input files are
+generated PDFs served over HTTP.
+
+    python benchmark.py --podcasts 4 --pages 5,20,80 --output run.json
+    python benchmark.py --podcasts 4 --pages 5,20,80 --baseline run.json
+    python benchmark.py --podcasts 4 --concurrency 4 --llm-quota-rpm 60 --env LLM_REQUESTS_PER_MINUTE=60
+    python benchmark.py --scenario large-document --memory-target 384
+    python benchmark.py --scenario actions --requests 5000
+    python benchmark.py --scenario startup
+    python benchmark.py --scenario combine-audio --audio-hours 4
+    python benchmark.py --scenario clients --requests 1000
+    python benchmark.py --scenario summarizer --pages 300 --max-workers 1,4,16 --env REDUCE_FAN_IN=4
+
+Settings of the services can be changed with --env, e.g. --env PRODUCE_MODE=stream.
+Both fake APIs stream their answers, so --env PIPELINED_SPEECH=1 can be compared with the default:
+
+    python benchmark.py --sections 10 --tts-char-latency 0.002 --env PIPELINED_SPEECH=1
+"""
+import argparse
+import base64
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from werkzeug.test import Client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORDS = ("the podcast argument society poverty charity reform history science market energy city "
+         "language memory network evidence method theory policy culture water health future").split()
+# MPEG-1 Layer III frame at 128 kbps and 44.1 kHz, 26 ms of silence
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)
+# Seconds of audio in each frame, 1152 samples at 44.1 kHz
+MP3_FRAME_SECONDS = 1152 / 44100
+# Characters of text rendered in each frame by the fake TTS
+TTS_CHARACTERS_PER_FRAME = 15
+# Frames sent in each chunk of the fake TTS responses
+TTS_FRAMES_PER_CHUNK = 8
+# Share of the latency of a streamed response spent before its first chunk
+STREAM_FIRST_CHUNK_SHARE = 0.1
+# Cold imports of the event manager timed by the startup scenario
+STARTUP_IMPORTS = 5
+# Dependencies the event manager should only import in the operations that use them
+HEAVY_MODULES = ("openai", "pdfminer", "gcsfs", "google.cloud.pubsub_v1", "google.auth")
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "wall_seconds": False,
+    "podcasts_per_hour": True,
+    "requests_per_second": True,
+    "latency.p99_ms": False,
+    "create_latency.p95_ms": False,
+    "end_to_end.p50_ms": False,
+    "end_to_end.p95_ms": False,
+    "calls.openai": False,
+    "calls.tts": False,
+    "calls.openai_throttled": False,
+    "throughput.openai_per_minute": True,
+    "peak_rss_mib.self": False,
+    "mb_per_second": True,
+    "peak_rss_growth_mib": False,
+    "shared.storage.p50_ms": False,
+    "shared.http.p50_ms": False,
+    "streaming.speedup.8_workers": True,
+    "import.p50_ms": False,
+    "first_event.create_ms": False,
+    "first_event.extend_ms": False,
+    "first_event.produce_ms": False,
+    "first_event.export_ms": False,
+    "documents.download_bytes": False,
+    "documents.llm_calls_saved": True,
+}
+
+def words(count, rng):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+def make_pdf(pages):
+    """
+    This function builds a PDF with one page of Helvetica text for each item of pages.
+    Parameters:
+        pages: Text of each page, lines separated by newlines
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    font = 3 + 2 * len(pages)
+    for i, text in enumerate(pages):
+        lines = [f"BT /F1 10 Tf 40 {750 - 12 * j} Td ({line}) Tj ET" for j, line in enumerate(text.split("\n"))]
+        stream = "\n".join(lines).encode()
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, content in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % (i + 1) + content + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+def make_corpus(pages_per_file, rng, lines_per_page=50, words_per_line=12):
+    """
+    This function generates one PDF for each page count in pages_per_file.
+    Returns a dict from file name to PDF content.
+    """
+    corpus = {}
+    for i, pages in enumerate(pages_per_file):
+        text = ["\n".join(words(words_per_line, rng) for _ in range(lines_per_page)) for _ in range(pages)]
+        corpus[f"document{i}_{pages}p.pdf"] = make_pdf(text)
+    return corpus
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections after failed requests
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+class FakeService:
+    """
+    Local HTTP server answering like a remote API. Every request waits latency seconds,
+    and a share error_rate of them fails with error_status. Requests beyond a quota of
+    requests_per_minute are answered at once with 429 and a Retry-After.
+    Handlers are called with the path, the JSON body and the headers of every request, and
+    answer a status, a content, its type and optionally more headers.
+    Handlers answering a list of chunks are streamed with chunked encoding: the first chunk
+    is sent after STREAM_FIRST_CHUNK_SHARE of latency and the rest of it is spread between
+    the others, so streamed and whole answers take as long.
+    """
+    def __init__(self, handler, latency=0.0, error_rate=0.0, error_status=500, seed=0, requests_per_minute=0):
+        self.handler = handler
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests_per_minute = requests_per_minute
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self._window = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and content are sent apart, Nagle would hold the content of keep-alive
+            # responses until the client's delayed ACK, as no real API does
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                service._serve(self)
+
+            def do_POST(self):
+                service._serve(self)
+
+        self.server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _serve(self, request):
+        length = int(request.headers.get("Content-Length") or 0)
+        body = json.loads(request.rfile.read(length)) if length else None
+        headers = {}
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            throttled = bool(self.requests_per_minute) and len(self._window) >= self.requests_per_minute
+            if throttled:
+                self.throttled += 1
+                headers["Retry-After"] = str(math.ceil(60 - (now - self._window[0])))
+            elif self.requests_per_minute:
+                self._window.append(now)
+            failed = not throttled and self._random.random() < self.error_rate
+            self.errors += failed
+        if throttled:
+            content = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode()
+            status, content_type = 429, "application/json"
+        elif failed:
+            time.sleep(self.latency)
+            content = json.dumps({"error": {"message": "Injected error", "type": "server_error"}}).encode()
+            status, content_type = self.error_status, "application/json"
+        else:
+            status, content, content_type, *extra = self.handler(request.path, body, request.headers)
+            headers.update(*extra)
+            if isinstance(content, list):
+                self._stream(request, status, headers, content, content_type)
+                return
+            time.sleep(self.latency)
+        with self._lock:
+            self.bytes_sent += len(content)
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        try:
+            for i in range(0, len(content), 64 * 1024):
+                request.wfile.write(content[i:i + 64 * 1024])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _stream(self, request, status, headers, chunks, content_type):
+        time.sleep(self.latency * STREAM_FIRST_CHUNK_SHARE)
+        interval = self.latency * (1 - STREAM_FIRST_CHUNK_SHARE) / max(1, len(chunks) - 1)
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        try:
+            for i, chunk in enumerate(chunks):
+                if i:
+                    time.sleep(interval)
+                request.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                with self._lock:
+                    self.bytes_sent += len(chunk)
+                request.wfile.flush()
+            request.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def chat_handler(sections, seed=0):
+    """
+    Returns a handler answering OpenAI chat completions with text shaped like the real
+    answers: podcast plans with the given number of sections, summaries and speeches.
+    Requests with stream set are answered with server-sent events, a word at a time.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def handle(path, body, headers):
+        messages = body["messages"]
+        system = messages[0]["content"]
+        with lock:
+            if "podcast planner" in system:
+                content = "\n".join(f"#section {i}#\n- Title: {words(4, rng)}\n- Ideas: {words(25, rng)}\n"
+                                    f"- Original statements: {words(15, rng)}" for i in range(1, sections + 1))
+            elif "#summary#" in system:
+                content = f"#summary#\n{words(80, rng)}\n\n#original statements#\n- {words(12, rng)}\n- {words(12, rng)}"
+            else:
+                content = ". ".join(words(15, rng).capitalize() for _ in range(10)) + "."
+        if body.get("stream"):
+            return 200, stream_events(body["model"], content), "text/event-stream"
+        prompt_words = sum(len(message["content"].split()) for message in messages)
+        answer = {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": int(prompt_words * 1.3), "completion_tokens": int(len(content.split()) * 1.3)},
+        }
+        answer["usage"]["total_tokens"] = answer["usage"]["prompt_tokens"] + answer["usage"]["completion_tokens"]
+        return 200, json.dumps(answer).encode(), "application/json"
+    return handle
+
+def stream_events(model, content):
+    """Returns the chunks of a streamed chat completion of content."""
+    pieces = re.findall(r"\S+\s*", content)
+    events = []
+    for i, piece in enumerate(pieces):
+        delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+        chunk = {"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        events.append(f"data: {json.dumps(chunk)}\n\n".encode())
+    last = {"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    events.append(f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n".encode())
+    return events
+
+def tts_handler(seconds_per_character=0.0):
+    """
+    Returns a handler answering TTS requests with silent frames, streamed in chunks.
+    Every character of the text adds seconds_per_character to the answer.
+    """
+    def handle(path, body, headers):
+        text = body["text"]
+        time.sleep(len(text) * seconds_per_character)
+        frames = max(1, len(text) // TTS_CHARACTERS_PER_FRAME)
+        return 200, [MP3_FRAME * min(TTS_FRAMES_PER_CHUNK, frames - i)
+                     for i in range(0, frames, TTS_FRAMES_PER_CHUNK)], "audio/mpeg"
+    return handle
+
+def files_handler(corpus):
+    """Returns a handler serving the files of corpus, answering 304 to requests with their ETag."""
+    etags = {name: '"%s"' % hashlib.sha256(content).hexdigest()[:16] for name, content in corpus.items()}
+
+    def handle(path, body, headers):
+        name = path.lstrip("/")
+        content = corpus.get(name)
+        if content is None:
+            return 404, b"Not found", "text/plain"
+        if headers.get("If-None-Match") == etags[name]:
+            return 304, b"", "application/pdf", {"ETag": etags[name]}
+        return 200, content, "application/pdf", {"ETag": etags[name]}
+    return handle
+
+class HTTPChatCompletion:
+    """
+    Stand-in of the openai<1 ChatCompletion API posting to api_base, used when the
+    installed openai package no longer has it. Streamed requests return an iterator of
+    the chunks, like openai<1 does.
+    """
+    def __init__(self, api_base, session):
+        self.api_base = api_base
+        self.session = session
+
+    def create(self, **request):
+        response = self.session.post(f"{self.api_base}/chat/completions", json=request, timeout=600,
+                                     stream=bool(request.get("stream")))
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        if request.get("stream"):
+            return self._events(response)
+        return response.json()
+
+    def _events(self, response):
+        with response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    return
+                yield json.loads(data)
+
+class LocalPubSub:
+    """
+    In-process stand-in of the Pub/Sub publisher. Published messages are queued until
+    a delivery worker hands them to the event manager. With duplicates, every message
+    is queued that many more times, alternately as a redelivery of the same message
+    and as the same event published again under a new message id.
+    """
+    def __init__(self, duplicates=0):
+        self.messages = queue.Queue()
+        self.published = 0
+        self.duplicates = duplicates
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data):
+        with self._lock:
+            self.published += 1
+            message_id = str(self.published)
+        self.messages.put((message_id, data))
+        for i in range(self.duplicates):
+            self.messages.put((message_id if i % 2 == 0 else f"{message_id}-republished{i}", data))
+        future = Future()
+        future.set_result(message_id)
+        return future
+
+def load_services(args, root, tts_url, openai_url):
+    """
+    This function imports both services configured for the benchmark.
+    The event manager is imported as main, so its ingestion workers can import it too.
+    """
+    os.environ.update({
+        "PROJECT_ID": "benchmark",
+        "EVENT_BUS": "benchmark",
+        "FILESYSTEM_PROTOCOL": args.filesystem,
+        "TTS_URL": tts_url + "/v1/text-to-speech/{voice}",
+        "OPENAI_API_BASE": openai_url + "/v1",
+        "OPENAI_KEY": "benchmark",
+        "VOICE_INTRODUCTION": "introduction",
+        "VOICE_SECTION": "section",
+        "VOICE_CLOSURE": "closure",
+        "TRACE_EXPORTER": "json",
+        "LOG_PROMPTS": "0",
+    })
+    if args.filesystem == "memory":
+        # Spawned workers would not see the memory filesystem of this process
+        os.environ["INGESTION_PROCESSES"] = "1"
+    if args.memory_target:
+        os.environ["MEMORY_TARGET_MB"] = str(args.memory_target)
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+    sys.path.insert(0, os.path.join(ROOT, "spodkast_event_manager"))
+    import main as event_manager
+    # Spans are collected here, workers don't need to report theirs
+    os.environ["TRACE_EXPORTER"] = "none"
+    spec = importlib.util.spec_from_file_location("actions_spodkast_main", os.path.join(ROOT, "actions_spodkast", "main.py"))
+    actions = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(actions)
+
+    route = root + "/{owner}/{id}"
+    actions.SPODKAST_ROUTE = route
+    actions.DOCUMENT_STORE_ROUTE = root + "/_documents"
+    event_manager.DOCUMENT_STORE = event_manager.DocumentStore(root + "/_documents")
+    event_manager.SPILL_DIR = root + "/_spill"
+    event_manager.SPODKAST_ROUTE = route
+    event_manager.EXPORT_FOLDER = root + "/_export/{owner}/{id}"
+    event_manager.SINTONIA_AUDIO = root + "/_assets/sintonia.mp3"
+    event_manager.HOT_AUDIO_ASSETS.clear()
+    event_manager.HOT_AUDIO_ASSETS.add(event_manager.SINTONIA_AUDIO)
+    event_manager.get_filesystem().pipe(event_manager.SINTONIA_AUDIO, MP3_FRAME * 40)
+    if args.cache:
+        event_manager.LLM_CACHE = event_manager.TieredCache(
+            "llm", root + "/_cache/llm", event_manager.LLM_CACHE_MAX_ENTRIES, event_manager.LLM_CACHE_TTL)
+        event_manager.TTS_CACHE = event_manager.TieredCache(
+            "tts", root + "/_cache/tts", event_manager.TTS_CACHE_MAX_ENTRIES, event_manager.TTS_CACHE_TTL,
+            max_bytes=event_manager.TTS_MEMORY_CACHE_BYTES)
+    else:
+        event_manager.LLM_CACHE_ENABLED = False
+        event_manager.TTS_CACHE_ENABLED = False
+
+    # Read without importing openai, which the startup scenario counts as an import of the event
+    if int(importlib.metadata.version("openai").split(".")[0]) >= 1:
+        importlib.import_module("clients")._clients["openai"] = types.SimpleNamespace(
+            ChatCompletion=HTTPChatCompletion(openai_url + "/v1", event_manager.get_http_session()))
+    return actions, event_manager
+
+class Pipeline:
+    """
+    Both services wired to the stand-ins. Podcasts are requested through the /create
+    route and their events are delivered by concurrency worker threads.
+    """
+    def __init__(self, actions, event_manager, concurrency, duplicates=0):
+        self.actions = actions
+        self.event_manager = event_manager
+        self.pubsub = LocalPubSub(duplicates)
+        actions._clients["publisher"] = self.pubsub
+        importlib.import_module("clients")._clients["publisher"] = self.pubsub
+        self.client = Client(actions.application)
+        self.spans = []
+        self.errors = []
+        self.finished = {}
+        self.delivered = 0
+        self._lock = threading.Lock()
+        event_manager.export_spans = self._collect_spans
+        event_manager._make_authorized_post_request = self._notify
+        self.workers = [threading.Thread(target=self._deliver, daemon=True) for _ in range(max(1, concurrency))]
+        for worker in self.workers:
+            worker.start()
+
+    def _collect_spans(self):
+        tracing = importlib.import_module("tracing")
+        with tracing._finished_spans_lock:
+            spans = list(tracing._finished_spans)
+            tracing._finished_spans.clear()
+        with self._lock:
+            self.spans.extend(spans)
+
+    def _notify(self, endpoint, payload):
+        message = json.loads(payload)["message"]
+        spodkast_id = re.search(r"/([^/]+)/podcast\.mp3", message).group(1)
+        with self._lock:
+            self.finished[spodkast_id] = time.perf_counter()
+
+    def _deliver(self):
+        while True:
+            item = self.pubsub.messages.get()
+            if item is None:
+                break
+            message_id, data = item
+            with self._lock:
+                self.delivered += 1
+            cloud_event = types.SimpleNamespace(data={"message": {"data": base64.b64encode(data), "messageId": message_id}})
+            try:
+                self.event_manager.spodkast_event_manager(cloud_event)
+            except Exception as e:
+                logging.exception("Event failed")
+                with self._lock:
+                    self.errors.append(repr(e))
+            finally:
+                self.pubsub.messages.task_done()
+
+    def create(self, name, input_files, **options):
+        """
+        This function requests a podcast through the /create route.
+        Returns the response and the seconds it took.
+        """
+        request = {"author": "benchmark", "user": "benchmark", "name": name, "slow": "0",
+                   "notificationMail": "benchmark@example.com", "requirements": "A short and engaging podcast",
+                   "inputFiles": ",".join(input_files), **options}
+        started = time.perf_counter()
+        response = self.client.post("/create", data=json.dumps(request))
+        return response, time.perf_counter() - started
+
+    def drain(self):
+        """Waits until every published event has been handled."""
+        self.pubsub.messages.join()
+
+    def close(self):
+        for _ in self.workers:
+            self.pubsub.messages.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def percentiles(values, digits=1):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def at(q):
+        return round(values[min(len(values) - 1, int(round(q * (len(values) - 1))))] * 1000, digits)
+    return {"count": len(values), "p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99),
+            "max_ms": round(values[-1] * 1000, digits)}
+
+def span_report(spans):
+    durations = {}
+    for span in spans:
+        durations.setdefault(span.name, []).append((span.end - span.start) / 1e9)
+    report = {}
+    for name, values in sorted(durations.items()):
+        report[name] = {**percentiles(values), "total_s": round(sum(values), 3)}
+    return report
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+def run_pipeline(args, pipeline, services):
+    """
+    Scenario requesting args.podcasts podcasts, each from args.files PDFs of the page
+    counts in args.pages, and waiting until all of them are exported.
+    """
+    corpus = services["corpus"]
+    names = sorted(corpus)
+    create_latencies = []
+    requested = {}
+    started = time.perf_counter()
+    for i in range(args.podcasts):
+        files = [names[(i * args.files + j) % len(names)] for j in range(args.files)]
+        urls = [f"{services['files'].url}/{name}" for name in files]
+        name = f"podcast{i}"
+        requested[name] = time.perf_counter()
+        response, latency = pipeline.create(name, urls, asyncDownload="1" if args.async_download else "0")
+        create_latencies.append(latency)
+        if "ERROR" in json.loads(response.data)["responseMessage"]:
+            pipeline.errors.append(json.loads(response.data)["responseMessage"])
+    pipeline.drain()
+    wall = time.perf_counter() - started
+    end_to_end = [pipeline.finished[name] - requested[name] for name in requested if name in pipeline.finished]
+    return {
+        "wall_seconds": round(wall, 3),
+        "podcasts": args.podcasts,
+        "completed": len(end_to_end),
+        "podcasts_per_hour": round(len(end_to_end) / wall * 3600, 1) if wall else 0.0,
+        "create_latency": percentiles(create_latencies),
+        "end_to_end": percentiles(end_to_end),
+    }
+
+def run_large_document(args, pipeline, services):
+    """
+    Scenario producing a podcast from a single large PDF, 1,000 pages by default,
+    with the event manager given a memory target of --memory-target MiB.
+    """
+    return run_pipeline(args, pipeline, services)
+
+def run_duplicates(args, pipeline, services):
+    """
+    Scenario delivering every event --duplicates more times, concurrently with the original,
+    so the podcasts must be produced with as many OpenAI and TTS calls as without duplicates.
+    """
+    return run_pipeline(args, pipeline, services)
+
+def run_actions(args, pipeline, services):
+    """
+    Micro-benchmark of the actions_spodkast entry point: args.requests requests through the
+    WSGI test client, cycling over every action and an invalid request. Their events are
+    published to a queue that is never delivered, and input files are left to the event manager.
+    """
+    sink = LocalPubSub()
+    publisher = pipeline.actions._clients["publisher"]
+    pipeline.actions._clients["publisher"] = sink
+    requests = [
+        ("/create", {"author": "benchmark", "user": "benchmark", "name": "actions", "notificationMail": "benchmark@example.com",
+                     "requirements": "A short and engaging podcast", "inputFiles": f"{services['files'].url}/document.pdf",
+                     "asyncDownload": "1"}),
+        ("/extend", {"author": "benchmark", "user": "benchmark", "name": "actions", "slow": "1"}),
+        ("/produce", {"author": "benchmark", "name": "actions"}),
+        ("/export", {"author": "#spokeAgent#", "conversationId": "benchmark.1", "user": "undefined", "name": "actions"}),
+        ("/produce", {"author": "benchmark"}),
+    ]
+    requests = [(path, json.dumps(body)) for path, body in requests]
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    try:
+        for i in range(args.requests):
+            path, body = requests[i % len(requests)]
+            sent = time.perf_counter()
+            response = pipeline.client.post(path, data=body)
+            latencies.append(time.perf_counter() - sent)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+    finally:
+        pipeline.actions._clients["publisher"] = publisher
+    wall = time.perf_counter() - started
+    return {
+        "wall_seconds": round(wall, 3),
+        "requests": args.requests,
+        "requests_per_second": round(args.requests / wall, 1) if wall else 0.0,
+        "latency": percentiles(latencies, digits=3),
+        "statuses": statuses,
+        "events": sink.published,
+    }
+
+def level_reducer(event_manager):
+    """
+    This function returns a StreamingReducer of event_manager that only packs the texts of a level
+    into groups once all of them are ready, like the level by level loop it replaced.
+    """
+    class LevelReducer(event_manager.StreamingReducer):
+        def add(self, future, level=0):
+            self._level(level)["pending"].append(future)
+
+        def result(self):
+            texts = [future.result() for future in self._level(0)["pending"]]
+            while len(texts) > 1:
+                self.levels = []
+                level = self._level(0)
+                for text in texts:
+                    self._append(0, text)
+                if len(level["group"]) == 1:
+                    promoted = Future()
+                    promoted.set_result(level["group"][0])
+                    self._level(1)["pending"].append(promoted)
+                elif level["group"]:
+                    self._emit(0)
+                texts = [future.result() for future in self._level(1)["pending"]]
+            return texts[0] if texts else ""
+    return LevelReducer
+
+def run_summarizer(args, pipeline, services):
+    """
+    Scenario summarizing the text of args.pages pages with a fake generate_answer, once for each
+    count of --max-workers, with the StreamingReducer and with a level by level reduction.
+    Every answer takes between half and one and a half times --llm-latency, so they finish out of
+    order, and lists the page markers of its messages, so the final summary must list every page
+    in document order.
+    """
+    event_manager = pipeline.event_manager
+    rng = random.Random(args.seed)
+    lock = threading.Lock()
+    calls = []
+    def generate_answer(prompt, message_list, model, use_cache=True, on_text=None):
+        with lock:
+            calls.append(len(message_list))
+        # Seeded by the messages, so every run waits as long for the same call
+        time.sleep(args.llm_latency * random.Random(f"{args.seed}:{message_list}").uniform(0.5, 1.5))
+        return " ".join(re.findall(r"\bm\d{4}\b", " ".join(message_list)))
+
+    page_count = sum(int(p) for p in args.pages.split(",") if p.strip())
+    pages = [f"m{i:04d} {words(600, rng)}\n" for i in range(page_count)]
+    expected = " ".join(f"m{i:04d}" for i in range(page_count))
+    generate, reducer = event_manager.generate_answer, event_manager.StreamingReducer
+    event_manager.generate_answer = generate_answer
+    results = {"pages": page_count}
+    started = time.perf_counter()
+    try:
+        for name, reducer_class in (("streaming", reducer), ("levels", level_reducer(event_manager))):
+            event_manager.StreamingReducer = reducer_class
+            seconds = {}
+            for max_workers in [int(w) for w in args.max_workers.split(",") if w.strip()]:
+                calls.clear()
+                stats = {}
+                sent = time.perf_counter()
+                summary = event_manager.summarizer(pages=iter(pages), max_workers=max_workers, stats=stats)
+                seconds[max_workers] = time.perf_counter() - sent
+                if summary != expected:
+                    pipeline.errors.append(f"{name} summary with {max_workers} workers is not in document order")
+                results.update(chunks=stats["chunks"], llm_calls=len(calls))
+            fewest = min(seconds)
+            results[name] = {f"{workers}_workers_s": round(wall, 3) for workers, wall in seconds.items()}
+            results[name]["speedup"] = {f"{workers}_workers": round(seconds[fewest] / wall, 2)
+                                        for workers, wall in seconds.items()}
+    finally:
+        event_manager.generate_answer = generate
+        event_manager.StreamingReducer = reducer
+    results["wall_seconds"] = round(time.perf_counter() - started, 3)
+    return results
+
+def run_clients(args, pipeline, services):
+    """
+    Micro-benchmark of the client registry of the event manager: args.requests storage writes and
+    reads and as many downloads of an input file, first building their filesystem and HTTP session
+    on every call, as before the registry, and then through the shared clients. Reports the clients
+    built by the factories given to _get_client and the latency of every call.
+    """
+    event_manager = pipeline.event_manager
+    # The registry lives in the clients module, which the storage helpers of the event manager use
+    clients = importlib.import_module("clients")
+    get_client = clients._get_client
+    path = event_manager.SPODKAST_ROUTE.format(owner="benchmark", id="clients") + "/object.txt"
+    url = f"{services['files'].url}/{sorted(services['corpus'])[0]}"
+    started = time.perf_counter()
+    results = {}
+    for mode in ("fresh", "shared"):
+        constructions = {"filesystem": 0, "http_session": 0}
+        def build(name, factory):
+            constructions[name.split(":")[0]] += 1
+            return factory()
+        if mode == "fresh":
+            clients._get_client = build
+        else:
+            clients._get_client = lambda name, factory: get_client(name, lambda: build(name, factory))
+        for name in [name for name in clients._clients if name.split(":")[0] in constructions]:
+            del clients._clients[name]
+        storage, http = [], []
+        try:
+            for i in range(args.requests):
+                sent = time.perf_counter()
+                event_manager.write_to_file(path, str(i))
+                event_manager.read_file(path)
+                storage.append(time.perf_counter() - sent)
+                sent = time.perf_counter()
+                session = event_manager.get_http_session()
+                session.get(url).raise_for_status()
+                http.append(time.perf_counter() - sent)
+                if mode == "fresh":
+                    session.close()
+        finally:
+            clients._get_client = get_client
+        results[mode] = {"constructions": constructions, "storage": percentiles(storage, digits=3),
+                         "http": percentiles(http, digits=3)}
+    return {"wall_seconds": round(time.perf_counter() - started, 3), "calls": args.requests, **results}
+
+def mp3_segment(frames, frames_per_block=1024):
+    """
+    This function yields in blocks a generated TTS segment of frames copies of MP3_FRAME,
+    wrapped in the ID3v2 tag, Info header frame and ID3v1 tag that combine_audios leaves out.
+    """
+    # ID3v2.4 tag with 1000 bytes of padding, its size in syncsafe bytes
+    yield b"ID3\x04\x00\x00\x00\x00\x07\x68" + bytes(1000)
+    yield MP3_FRAME[:36] + b"Info" + MP3_FRAME[40:]
+    while frames > 0:
+        yield MP3_FRAME * min(frames, frames_per_block)
+        frames -= frames_per_block
+    yield b"TAG" + bytes(125)
+
+def run_combine_audio(args, pipeline, services):
+    """
+    Micro-benchmark of combine_audios: --audio-hours hours of generated frames, split into an
+    introduction, args.sections sections and a closure with SINTONIA_AUDIO between them, as in a
+    podcast, are concatenated into one file. Reports the throughput and how much the peak RSS of
+    the process grew, which should not depend on the length of the podcast. The memory filesystem
+    holds every file in memory, so it's only meaningful with the default local filesystem.
+    """
+    event_manager = pipeline.event_manager
+    fs = event_manager.get_filesystem()
+    folder = event_manager.SPODKAST_ROUTE.format(owner="benchmark", id="combine")
+    segments = args.sections + 2
+    frames = int(args.audio_hours * 3600 / MP3_FRAME_SECONDS / segments)
+    files = []
+    for i in range(segments):
+        files.append(f"{folder}/segment{i}.mp3")
+        with fs.open(files[-1], "wb") as f:
+            for block in mp3_segment(frames):
+                f.write(block)
+    sintonia = event_manager.SINTONIA_AUDIO
+    files = [files[0], sintonia, *files[1:-1], sintonia, files[-1]]
+    input_bytes = sum(fs.size(file) for file in files)
+    expected = segments * frames * len(MP3_FRAME) + 2 * fs.size(sintonia)
+
+    peak_before = peak_rss()["self"]
+    started = time.perf_counter()
+    podcast = event_manager.combine_audios(files, f"{folder}/podcast.mp3")
+    wall = time.perf_counter() - started
+    output_bytes = fs.size(podcast)
+    if output_bytes != expected:
+        pipeline.errors.append(f"Combined {output_bytes} bytes, expected {expected} without tags and header frames")
+    return {
+        "wall_seconds": round(wall, 3),
+        "audio_hours": round(segments * frames * MP3_FRAME_SECONDS / 3600, 2),
+        "files": len(files),
+        "input_mb": round(input_bytes / 1e6, 1),
+        "output_mb": round(output_bytes / 1e6, 1),
+        "mb_per_second": round(input_bytes / 1e6 / wall, 1) if wall else 0.0,
+        "peak_rss_before_mib": peak_before,
+        "peak_rss_growth_mib": round(peak_rss()["self"] - peak_before, 1),
+    }
+
+def import_event_manager():
+    """
+    This function imports the event manager, in a new process.
+    Returns the seconds it took and the heavy dependencies it imported.
+    """
+    sys.path.insert(0, os.path.join(ROOT, "spodkast_event_manager"))
+    started = time.perf_counter()
+    importlib.import_module("main")
+    return time.perf_counter() - started, [name for name in HEAVY_MODULES if name in sys.modules]
+
+def cold_event(args, root, tts_url, openai_url, data):
+    """
+    This function handles an event twice in a new process, first right after importing the
+    event manager and then warm, as a new request. Returns the seconds of both and the heavy
+    dependencies the first one imported.
+    """
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    actions, event_manager = load_services(args, root, tts_url, openai_url)
+    # Events handed over to the next operation are not delivered
+    importlib.import_module("clients")._clients["publisher"] = LocalPubSub()
+    event_manager._make_authorized_post_request = lambda endpoint, payload: None
+    event_manager.export_spans = lambda: None
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    event = json.loads(data)
+    seconds = []
+    for attempt in ("cold", "warm"):
+        event["requestId"] = f"startup-{attempt}-{event['requestId']}"
+        cloud_event = types.SimpleNamespace(data={"message": {"data": base64.b64encode(json.dumps(event).encode()),
+                                                              "messageId": f"startup-{attempt}"}})
+        started = time.perf_counter()
+        event_manager.spodkast_event_manager(cloud_event)
+        seconds.append(time.perf_counter() - started)
+        if attempt == "cold":
+            imported = [name for name in HEAVY_MODULES if name in sys.modules and name not in loaded]
+    return seconds, imported
+
+def run_startup(args, pipeline, services):
+    """
+    Scenario timing cold starts of the event manager: its import in STARTUP_IMPORTS new processes,
+    and the first event of each operation in a new process, against a podcast created beforehand,
+    next to the same event handled again by the warm process.
+    """
+    if args.filesystem != "file":
+        raise ValueError("The startup scenario needs --filesystem file, new processes can't see the memory filesystem")
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    imports = []
+    imported = set()
+    for _ in range(STARTUP_IMPORTS):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            seconds, modules = pool.submit(import_event_manager).result()
+        imports.append(seconds)
+        imported.update(modules)
+
+    urls = [f"{services['files'].url}/{name}" for name in sorted(services["corpus"])[:args.files]]
+    response, _ = pipeline.create("startup", urls, asyncDownload="1")
+    if "ERROR" in json.loads(response.data)["responseMessage"]:
+        pipeline.errors.append(json.loads(response.data)["responseMessage"])
+    pipeline.drain()
+    requests = {
+        "create": {"author": "benchmark", "user": "benchmark", "name": "startup", "slow": "1",
+                   "notificationMail": "benchmark@example.com", "requirements": "A short and engaging podcast",
+                   "inputFiles": ",".join(urls), "asyncDownload": "1"},
+        "extend": {"author": "benchmark", "user": "benchmark", "name": "startup", "slow": "1"},
+        "produce": {"author": "benchmark", "name": "startup"},
+        "export": {"author": "benchmark", "name": "startup"},
+    }
+    sink = LocalPubSub()
+    publisher = pipeline.actions._clients["publisher"]
+    pipeline.actions._clients["publisher"] = sink
+    try:
+        for operation, body in requests.items():
+            pipeline.client.post(f"/{operation}", data=json.dumps(body))
+    finally:
+        pipeline.actions._clients["publisher"] = publisher
+
+    first_event, warm_event, first_event_imports = {}, {}, {}
+    root = pipeline.event_manager.SPODKAST_ROUTE[:-len("/{owner}/{id}")]
+    for operation in requests:
+        _, data = sink.messages.get_nowait()
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            (cold, warm), imported = pool.submit(cold_event, args, root, services["tts"].url,
+                                                 services["openai"].url, data).result()
+        first_event[f"{operation}_ms"] = round(cold * 1000, 1)
+        first_event_imports[operation] = imported
+        warm_event[f"{operation}_ms"] = round(warm * 1000, 1)
+    return {
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "import": percentiles(imports),
+        "import_loads": sorted(imported),
+        "first_event": first_event,
+        "warm_event": warm_event,
+        "first_event_loads": first_event_imports,
+    }
+
+SCENARIOS = {
+    "pipeline": run_pipeline,
+    "actions": run_actions,
+    "large-document": run_large_document,
+    "duplicates": run_duplicates,
+    "startup": run_startup,
+    "combine-audio": run_combine_audio,
+    "clients": run_clients,
+    "summarizer": run_summarizer,
+}
+# Options of each scenario that replace the defaults of the command line
+SCENARIO_DEFAULTS = {
+    "large-document": {"podcasts": 1, "files": 1, "pages": "1000", "memory_target": 384},
+    "duplicates": {"duplicates": 2, "concurrency": 4},
+    "clients": {"requests": 1000},
+    "summarizer": {"pages": "300", "llm_latency": 0.5},
+}
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(results, baseline, tolerance, min_delta_ms=5.0):
+    """
+    This function compares results with a baseline run.
+    Returns the rows of the comparison and whether any metric regressed more than tolerance.
+    Parameters:
+        results: Results of this run
+        baseline: Results of the run to compare with
+        tolerance: Relative change allowed before a metric counts as a regression
+        min_delta_ms: Latency changes smaller than this are noise, whatever their relative size
+    """
+    current, previous = flatten(results), flatten(baseline)
+    metrics = dict(COMPARED_METRICS)
+    metrics.update({name: False for name in current if name.startswith("stages.") and name.endswith(".p50_ms")})
+    rows = []
+    regressed = False
+    for name, higher_is_better in metrics.items():
+        if name not in current or not previous.get(name):
+            continue
+        change = (current[name] - previous[name]) / previous[name]
+        worse = -change if higher_is_better else change
+        regression = worse > tolerance
+        if name.endswith("_ms") and abs(current[name] - previous[name]) < min_delta_ms:
+            regression = False
+        regressed = regressed or regression
+        rows.append((name, previous[name], current[name], change, regression))
+    return rows, regressed
+
+def print_report(results, comparison=None):
+    scenario = {k: v for k, v in results.items()
+                if k not in ("config", "stages", "calls", "throughput", "tokens", "documents", "deliveries",
+                             "peak_rss_mib", "memory", "errors")}
+    print(f"Scenario {results['config']['scenario']}")
+    for key, value in scenario.items():
+        print(f"  {key}: {value}")
+    print("Calls: " + ", ".join(f"{k}={v}" for k, v in results["calls"].items()))
+    print("Served per minute: " + ", ".join(f"{k}={v}" for k, v in results["throughput"].items()))
+    print("Tokens: " + ", ".join(f"{k}={v}" for k, v in results["tokens"].items()))
+    print("Documents: " + ", ".join(f"{k}={v}" for k, v in results["documents"].items()))
+    print("Deliveries: " + ", ".join(f"{k}={v}" for k, v in results["deliveries"].items()))
+    print(f"Peak RSS (MiB): self={results['peak_rss_mib']['self']} children={results['peak_rss_mib']['children']}")
+    if "memory" in results:
+        memory = results["memory"]
+        print(f"Memory target: {memory['peak_mib']} of {memory['target_mib']} MiB"
+              f"{'' if memory['within_target'] else ', EXCEEDED'}")
+    print(f"{'span':<24}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}{'total s':>10}")
+    for name, stats in results["stages"].items():
+        print(f"{name:<24}{stats['count']:>7}{stats['p50_ms']:>11}{stats['p95_ms']:>11}{stats['max_ms']:>11}{stats['total_s']:>10}")
+    if results["errors"]:
+        print(f"{len(results['errors'])} errors, first: {results['errors'][0]}")
+    if comparison:
+        print(f"{'metric':<36}{'baseline':>12}{'current':>12}{'change':>9}")
+        for name, previous, current, change, regression in comparison:
+            flag = "  REGRESSION" if regression else ""
+            print(f"{name:<36}{previous:>12}{current:>12}{change:>+9.1%}{flag}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the spodkast pipeline")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="pipeline")
+    parser.add_argument("--podcasts", type=int, default=2, help="Podcasts requested")
+    parser.add_argument("--files", type=int, default=2, help="Input files of each podcast")
+    parser.add_argument("--pages", default="3,12,40", help="Page counts of the generated PDFs, separated by commas")
+    parser.add_argument("--sections", type=int, default=4, help="Sections of each podcast plan")
+    parser.add_argument("--concurrency", type=int, default=1, help="Events handled at the same time")
+    parser.add_argument("--duplicates", type=int, default=0, help="Extra deliveries of every event")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests sent in the actions and clients scenarios")
+    parser.add_argument("--audio-hours", type=float, default=2.0, help="Hours of audio combined in the combine-audio scenario")
+    parser.add_argument("--max-workers", default="1,2,4,8,16",
+                        help="Summarizer concurrencies compared in the summarizer scenario, separated by commas")
+    parser.add_argument("--async-download", action="store_true", help="Download input files in the event manager")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds of every OpenAI answer")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="Seconds before every TTS response")
+    parser.add_argument("--tts-char-latency", type=float, default=0.0,
+                        help="Seconds added to every TTS response per character of its text")
+    parser.add_argument("--tts-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-quota-rpm", type=int, default=0, help="Requests per minute OpenAI accepts, 0 for no quota")
+    parser.add_argument("--tts-quota-rpm", type=int, default=0, help="Requests per minute the TTS accepts, 0 for no quota")
+    parser.add_argument("--filesystem", choices=["file", "memory"], default="file")
+    parser.add_argument("--cache", action="store_true", help="Enable the LLM and TTS caches")
+    parser.add_argument("--memory-target", type=int, default=0,
+                        help="MEMORY_TARGET_MB of the event manager, the run fails if its peak memory exceeds it")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Setting of the services, can be repeated")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative change counted as a regression")
+    parser.add_argument("--verbose", action="store_true")
+    scenario = parser.parse_args(argv).scenario
+    parser.set_defaults(**SCENARIO_DEFAULTS.get(scenario, {}))
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    rng = random.Random(args.seed)
+    pages = [int(p) for p in args.pages.split(",") if p.strip()]
+    services = {
+        "corpus": make_corpus(pages, rng),
+        "openai": FakeService(chat_handler(args.sections, args.seed), args.llm_latency, args.llm_error_rate,
+                              seed=args.seed, requests_per_minute=args.llm_quota_rpm),
+        "tts": FakeService(tts_handler(args.tts_char_latency), args.tts_latency, args.tts_error_rate,
+                           seed=args.seed + 1, requests_per_minute=args.tts_quota_rpm),
+    }
+    services["files"] = FakeService(files_handler(services["corpus"]))
+    workdir = tempfile.mkdtemp(prefix="spodkast-benchmark-") if args.filesystem == "file" else "/spodkast-benchmark"
+    actions, event_manager = load_services(args, workdir, services["tts"].url, services["openai"].url)
+    pipeline = Pipeline(actions, event_manager, args.concurrency, args.duplicates)
+    try:
+        results = SCENARIOS[args.scenario](args, pipeline, services)
+        store = event_manager.DOCUMENT_STORE.prune() if event_manager.DOCUMENT_STORE_ENABLED else None
+    finally:
+        pipeline.close()
+        for name in ("openai", "tts", "files"):
+            services[name].close()
+        if args.filesystem == "file":
+            shutil.rmtree(workdir, ignore_errors=True)
+    llm_spans = [span for span in pipeline.spans if span.name == "llm.chat"]
+    summarize_spans = [span for span in pipeline.spans if span.name == "stage.summarize"]
+    operation_spans = [span for span in pipeline.spans if span.name.startswith("operation.")]
+    minutes = results["wall_seconds"] / 60 or 1
+    def served(name):
+        return services[name].calls - services[name].errors - services[name].throttled
+    results.update({
+        "config": vars(args),
+        "stages": span_report(pipeline.spans),
+        "calls": {
+            "openai": services["openai"].calls,
+            "openai_errors": services["openai"].errors,
+            "openai_throttled": services["openai"].throttled,
+            "tts": services["tts"].calls,
+            "tts_errors": services["tts"].errors,
+            "tts_throttled": services["tts"].throttled,
+            "downloads": services["files"].calls,
+            "published": pipeline.pubsub.published,
+        },
+        "throughput": {
+            "openai_per_minute": round(served("openai") / minutes, 1),
+            "tts_per_minute": round(served("tts") / minutes, 1),
+        },
+        "tokens": {
+            "prompt": sum(span.attributes.get("prompt_tokens", 0) for span in llm_spans),
+            "completion": sum(span.attributes.get("completion_tokens", 0) for span in llm_spans),
+        },
+        "documents": {
+            **(store or {}),
+            "download_bytes": services["files"].bytes_sent,
+            "summaries_reused": sum(span.attributes.get("summaries_reused", 0) for span in summarize_spans),
+            "llm_calls_saved": sum(span.attributes.get("llm_calls_saved", 0) for span in summarize_spans),
+        },
+        "deliveries": {
+            "delivered": pipeline.delivered,
+            "operations": len(operation_spans),
+            "duplicates_skipped": sum(1 for span in operation_spans if span.attributes.get("duplicate")),
+        },
+        "peak_rss_mib": peak_rss(),
+        "errors": pipeline.errors,
+    })
+    if args.memory_target:
+        peak = results["peak_rss_mib"]["self"] + results["peak_rss_mib"]["children"]
+        results["memory"] = {"target_mib": args.memory_target, "peak_mib": round(peak, 1),
+                             "within_target": peak <= args.memory_target}
+    comparison, regressed = None, False
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison, regressed = compare(results, json.load(f), args.tolerance)
+    print_report(results, comparison)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    exceeded = not results.get("memory", {}).get("within_target", True)
+    return 1 if regressed or exceeded or results["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
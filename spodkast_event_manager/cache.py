@@ -0,0 +1,158 @@
+"""Caches of OpenAI answers and rendered audio."""
+import logging
+import time
+import math
+import threading
+from collections import OrderedDict
+from clients import get_filesystem, path_protocol
+from storage import content_hash, copy_file, modified_time
+
+class TieredCache:
+    """
+    Cache with a bounded in-memory LRU tier in front of a persistent tier
+    stored under route in any fsspec filesystem.
+    Values are bytes, and entries older than ttl seconds are ignored.
+    Large values can be cached as files, which only use the persistent tier.
+    """
+    def __init__(self, name, route, max_entries, ttl, max_bytes=None):
+        self.name = name
+        self.route = route.rstrip('/')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    @staticmethod
+    def key(*parts):
+        return content_hash(*parts)
+
+    def _path(self, key):
+        return f"{self.route}/{key[:2]}/{key}"
+
+    def _filesystem(self):
+        return get_filesystem(path_protocol(self.route))
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def _remember(self, key, value, created):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[0])
+            self._entries[key] = (value, created)
+            self._size += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     (self.max_bytes is not None and self._size > self.max_bytes)):
+                self._size -= len(self._entries.popitem(last=False)[1][0])
+                self.counters["evictions"] += 1
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[0]
+        return None
+
+    def _fresh_path(self, key, now):
+        """Returns the persistent path of key if it holds an entry younger than ttl."""
+        path = self._path(key)
+        try:
+            if now - self._filesystem().modified(path).timestamp() <= self.ttl:
+                return path
+        except FileNotFoundError:
+            pass
+        return None
+
+    def get(self, key, persistent=True):
+        """
+        Returns the value of key, or None if it isn't cached.
+        With persistent False only the in-memory tier is looked up.
+        """
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None:
+            return value
+        if persistent:
+            try:
+                path = self._fresh_path(key, now)
+                if path:
+                    with self._filesystem().open(path, 'rb') as f:
+                        value = f.read()
+                    self._remember(key, value, now)
+                    self._count("persistent_hits")
+                    return value
+            except Exception as e:
+                logging.warning(f"Could not read {self.name} cache entry {key}: {e}")
+        self._count("misses")
+        return None
+
+    def put(self, key, value, persist=True):
+        """Stores value for key, only in the in-memory tier if persist is False."""
+        self._remember(key, value, time.time())
+        if not persist:
+            return
+        try:
+            with self._filesystem().open(self._path(key), 'wb') as f:
+                f.write(value)
+            self._count("writes")
+        except Exception as e:
+            logging.warning(f"Could not write {self.name} cache entry {key}: {e}")
+
+    def get_file(self, key, output_file):
+        """Copies the cached file of key to output_file. Returns whether it was cached."""
+        try:
+            path = self._fresh_path(key, time.time())
+            if path:
+                copy_file(path, output_file)
+                self._count("persistent_hits")
+                return True
+        except Exception as e:
+            logging.warning(f"Could not read {self.name} cache entry {key}: {e}")
+        self._count("misses")
+        return False
+
+    def put_file(self, key, source_file):
+        """Caches a copy of source_file for key."""
+        try:
+            copy_file(source_file, self._path(key))
+            self._count("writes")
+        except Exception as e:
+            logging.warning(f"Could not write {self.name} cache entry {key}: {e}")
+
+    def prune(self, max_bytes=None):
+        """
+        Deletes persistent entries older than ttl and then, if max_bytes is given,
+        the least recently written ones until the tier takes at most max_bytes.
+        """
+        if max_bytes is None:
+            max_bytes = math.inf
+        now = time.time()
+        try:
+            fs = self._filesystem()
+            entries = sorted((modified_time(fs, info), info["size"], path)
+                             for path, info in fs.find(self.route, detail=True).items())
+            total = sum(size for _, size, _ in entries)
+            expired = []
+            for modified, size, path in entries:
+                if now - modified <= self.ttl and total <= max_bytes:
+                    break
+                expired.append(path)
+                total -= size
+            if expired:
+                fs.rm(expired)
+                self._count("evictions", len(expired))
+        except Exception as e:
+            logging.warning(f"Could not prune {self.name} cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_rate"] = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        return stats
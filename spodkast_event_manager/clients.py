@@ -0,0 +1,85 @@
+"""Clients shared by every thread of the event manager and reused across warm invocations."""
+import os
+import threading
+import requests
+import requests.adapters
+import fsspec
+# openai, gcsfs and pubsub are imported the first time their client is needed
+
+API_KEY = os.environ.get('OPENAI_KEY')
+# Alternative OpenAI endpoint, like a proxy or a local stand-in
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE')
+PROJECT_ID = os.environ.get('PROJECT_ID')
+FILESYSTEM_PROTOCOL = os.environ.get('FILESYSTEM_PROTOCOL', 'gs')
+# Connections kept alive per host by the shared HTTP session
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+    """
+    Returns the client registered as name, building it with factory the first time.
+    Clients are shared by every thread and reused across warm invocations.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+def get_filesystem(protocol=None):
+    """
+    This function returns the shared fsspec filesystem for protocol.
+    Parameters:
+        protocol: fsspec protocol, FILESYSTEM_PROTOCOL by default
+    """
+    protocol = protocol or FILESYSTEM_PROTOCOL
+    def factory():
+        if protocol in ("gs", "gcs"):
+            import gcsfs
+            return gcsfs.GCSFileSystem(project=PROJECT_ID)
+        if protocol in ("file", "local"):
+            # Object stores have no directories, local paths need them created
+            return fsspec.filesystem(protocol, auto_mkdir=True)
+        return fsspec.filesystem(protocol)
+    return _get_client(f"filesystem:{protocol}", factory)
+
+def get_publisher():
+    def factory():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient()
+    return _get_client("publisher", factory)
+
+def get_openai():
+    """
+    This function returns the openai module configured with the API key.
+    """
+    def factory():
+        import openai
+        openai.api_key = API_KEY
+        if OPENAI_API_BASE:
+            openai.api_base = OPENAI_API_BASE
+        return openai
+    return _get_client("openai", factory)
+
+def get_http_session():
+    """
+    This function returns the shared requests session, which keeps alive
+    up to HTTP_POOL_SIZE connections per host.
+    """
+    def factory():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _get_client("http_session", factory)
+
+def path_protocol(path):
+    """Returns the protocol of path, FILESYSTEM_PROTOCOL for paths without one."""
+    return fsspec.utils.get_protocol(path) if "://" in path else FILESYSTEM_PROTOCOL
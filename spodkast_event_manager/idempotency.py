@@ -0,0 +1,165 @@
+"""Leases and ledgers that let every event run once at a time in its workspace."""
+import os
+import logging
+import json
+import time
+import secrets
+from clients import get_filesystem
+from storage import content_hash, read_file, write_to_file
+
+# Deliveries of an event already handled in its workspace in the last IDEMPOTENCY_TTL seconds are skipped
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# Events lease their workspace for LEASE_SECONDS, longer than any invocation (EVENT_TIME_BUDGET), so the
+# lease of a crashed instance is reclaimed once it expires. Other events wait up to LEASE_WAIT_SECONDS for it
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', int(os.environ.get('EVENT_TIME_BUDGET', 540)) + 60))
+LEASE_WAIT_SECONDS = float(os.environ.get('LEASE_WAIT_SECONDS', 30))
+LEASE_FILE = "lease.json"
+LEDGER_FOLDER = "events"
+
+class WorkspaceBusy(RuntimeError):
+    """
+    Raised when another event keeps the workspace leased. The delivery fails and Pub/Sub redelivers
+    it, as the function is deployed with retries, and the ledger skips it if it was handled meanwhile.
+    """
+
+class WorkspaceLease:
+    """
+    Exclusive lease of a workspace, held in {workspace}/lease.json while an event is handled.
+    The lease file is only created if it doesn't exist, so a single delivery holds it at a time.
+    Leases expire after seconds, and the expired lease of a crashed instance is reclaimed by
+    the one contender that creates its reclaim marker.
+    """
+    def __init__(self, workspace, event_key, seconds=None):
+        self.workspace = workspace
+        self.path = f"{workspace}/{LEASE_FILE}"
+        self.event_key = event_key
+        self.seconds = LEASE_SECONDS if seconds is None else seconds
+        self.token = secrets.token_hex(16)
+        self._markers = []
+
+    @staticmethod
+    def _create(path, content):
+        """Writes content to path unless it exists. Returns whether it was written."""
+        try:
+            with get_filesystem().open(path, 'xb') as f:
+                f.write(json.dumps(content).encode())
+            return True
+        except FileExistsError:
+            return False
+
+    def holder(self):
+        """Returns the lease held on the workspace, or None."""
+        try:
+            return json.loads(read_file(self.path))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Still being written, or left half written by a crash
+            try:
+                modified = get_filesystem().modified(self.path).timestamp()
+            except FileNotFoundError:
+                return None
+            return {"owner": None, "event": None, "expires": modified + self.seconds}
+
+    def try_acquire(self):
+        """Takes the lease if it is free or expired. Returns None if taken, or the lease held otherwise."""
+        now = time.time()
+        lease = {"owner": self.token, "event": self.event_key, "expires": now + self.seconds}
+        if self._create(self.path, lease):
+            return None
+        current = self.holder()
+        if current is None:
+            # Released in between
+            return {}
+        if current["expires"] < now:
+            marker = f"{self.workspace}/lease-reclaim-{current['owner'] or int(current['expires'])}"
+            if self._create(marker, {"owner": self.token}):
+                logging.warning(f"Reclaiming the lease of {self.workspace} held by event {current['event']}, "
+                                f"expired {now - current['expires']:.0f}s ago")
+                self._markers.append(marker)
+                get_filesystem().rm(self.path)
+                if self._create(self.path, lease):
+                    return None
+            else:
+                self._remove_stale(marker)
+        return current
+
+    def _remove_stale(self, marker):
+        # The marker of a reclaimer that crashed would otherwise keep the lease from being reclaimed
+        fs = get_filesystem()
+        try:
+            if time.time() - fs.modified(marker).timestamp() > self.seconds:
+                fs.rm(marker)
+        except FileNotFoundError:
+            pass
+
+    def acquire(self, wait=None):
+        """
+        This function takes the lease, waiting up to wait seconds (LEASE_WAIT_SECONDS by default)
+        while other events hold it. Returns True once taken, and False without waiting if the same
+        event holds it, as that is a concurrent delivery of it.
+        Raises WorkspaceBusy if other events still hold it after wait.
+        """
+        deadline = time.monotonic() + (LEASE_WAIT_SECONDS if wait is None else wait)
+        delay = 0.05
+        while True:
+            current = self.try_acquire()
+            if current is None:
+                return True
+            if current.get("event") == self.event_key:
+                return False
+            if time.monotonic() >= deadline:
+                raise WorkspaceBusy(f"{self.workspace} is leased by event {current.get('event')}")
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(2 * delay, 1.0)
+
+    def release(self):
+        fs = get_filesystem()
+        current = self.holder()
+        if current and current.get("owner") == self.token:
+            fs.rm(self.path)
+        for marker in self._markers:
+            if fs.exists(marker):
+                fs.rm(marker)
+        self._markers = []
+
+def event_key(event, message_id=None):
+    """
+    Identifies an event by the requestId its publisher stamped on it, which stays the same if the
+    event is published again, or else by the Pub/Sub message_id, which redeliveries keep.
+    Two requests with the same payload are different events. Returns None if there is no id.
+    """
+    identity = event.get("requestId") or message_id
+    if identity is None:
+        return None
+    return content_hash(event["entity"], event["entityId"], event["operation"], identity)
+
+class EventLedger:
+    """
+    Events handled in a workspace, one record per event key in {workspace}/events/.
+    Records older than ttl are ignored, so the same request can be made again later.
+    """
+    def __init__(self, workspace, ttl=None):
+        self.workspace = workspace
+        self.ttl = IDEMPOTENCY_TTL if ttl is None else ttl
+
+    def _path(self, key):
+        return f"{self.workspace}/{LEDGER_FOLDER}/{key}.json"
+
+    def lookup(self, key):
+        """Returns the record of the event key if it was handled in the last ttl seconds."""
+        try:
+            record = json.loads(read_file(self._path(key)))
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - record.get("completed", 0) > self.ttl:
+            return None
+        return record
+
+    def record(self, key, event, message_id=None):
+        write_to_file(self._path(key), json.dumps({
+            "operation": event["operation"],
+            "entity_id": event["entityId"],
+            "message_id": message_id,
+            "completed": time.time(),
+        }))
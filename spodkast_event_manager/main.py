@@ -2,40 +2,167 @@ import os
 import logging
 logging.basicConfig(level=logging.INFO)
 import json
+import hashlib
+import time
+import contextlib
+import functools
+import secrets
+import resource
+import tempfile
+import shutil
+from collections import deque
 import functions_framework
-from google.cloud import pubsub_v1
-import openai
-import requests
 import base64
 import datetime
-import gcsfs
-from io import BytesIO
-from pdfminer.high_level import extract_text
-from nltk.tokenize import word_tokenize
-import urllib
-import google.auth.transport.requests
-import google.oauth2.id_token
-import nltk
-nltk.download('punkt')
-
-API_KEY = os.environ.get('OPENAI_KEY')
-openai.api_key = os.environ.get('OPENAI_KEY')
+from io import BytesIO, StringIO
+import re
+import math
+import threading
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+# openai, pdfminer, gcsfs, pubsub and google-auth are imported by the operations
+# that use them, so cold starts only pay for what the event needs
+from clients import PROJECT_ID, get_filesystem, get_http_session, get_openai, get_publisher, path_protocol
+from tracing import (current_span, export_spans, finish_span, in_current_context, report_profiler,
+                     start_profiler, start_span, trace_span, traced)
+from storage import (AUDIO_BLOCK_SIZE, MAX_INPUT_BYTES, PAGE_SEPARATOR, PDF_BLOCK_SIZE, ByteBudget, DocumentStore,
+                     content_hash, copy_file, download_file, iter_separated_pages, modified_time, read_bytes,
+                     read_file, write_to_file)
+from cache import TieredCache
+from ratelimit import LLM_TOKENS_PER_MINUTE, TTS_VOICE_CONCURRENCY, call_with_retries, get_rate_limiter
+from taskgraph import TaskGraph
+from idempotency import EventLedger, WorkspaceLease, event_key
+
 TEMPERATURE = 0.0
 MAX_EXTRACTION_TOKENS = 3000
+SUMMARIZER_MODEL = os.environ.get('SUMMARIZER_MODEL', "gpt-3.5-turbo")
+# Context window of each model, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Tokens of the context window kept free for the answer
+RESPONSE_TOKEN_RESERVE = int(os.environ.get('RESPONSE_TOKEN_RESERVE', 1500))
+# Tokens added by the chat format to every message
+MESSAGE_TOKEN_OVERHEAD = 4
+# Tokenizer used to count model tokens: "approximate" or "tiktoken"
+TOKENIZER = os.environ.get('TOKENIZER', 'approximate')
+# Chunk size, in words, used by the summarizer before token budgeting
+LEGACY_CHUNK_WORDS = 2000
+# Maximum number of concurrent OpenAI calls while summarizing a document
+SUMMARIZER_CONCURRENCY = int(os.environ.get('SUMMARIZER_CONCURRENCY', 8))
+# Processes extracting the text of input files in parallel
+INGESTION_PROCESSES = int(os.environ.get('INGESTION_PROCESSES', os.cpu_count() or 1))
+# Maximum number of summaries combined by each reduce call
+REDUCE_FAN_IN = int(os.environ.get('REDUCE_FAN_IN', 8))
 
-PROJECT_ID = os.environ.get('PROJECT_ID')
 EVENT_BUS = os.environ.get('EVENT_BUS')
 ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_KEY')
 VOICE_INTRODUCTION = os.environ.get('VOICE_INTRODUCTION')
 VOICE_SECTION = os.environ.get('VOICE_SECTION')
 VOICE_CLOSURE = os.environ.get('VOICE_CLOSURE')
 CONVERSATIONAL_URL = os.environ.get('CONVERSATIONAL_URL')
-SINTONIA_AUDIO = "gs://yggdrasil-ai-hermod-public/sintonia.mp3"
+TTS_MAX_ATTEMPTS = int(os.environ.get('TTS_MAX_ATTEMPTS', 5))
+LLM_MAX_ATTEMPTS = int(os.environ.get('LLM_MAX_ATTEMPTS', 5))
+# Texts of a podcast (introduction, closure and sections) written at the same time
+TEXT_CONCURRENCY = int(os.environ.get('TEXT_CONCURRENCY', 16))
+TTS_URL = os.environ.get('TTS_URL', "https://api.elevenlabs.io/v1/text-to-speech/{voice}")
+# "files" renders every segment to its own file and then combines them,
+# "stream" writes the TTS responses straight into the podcast upload
+PRODUCE_MODE = os.environ.get('PRODUCE_MODE', 'files')
+# Whether streamed segments are also saved to their own files, so they can be reused
+PRODUCE_TEE_SEGMENTS = os.environ.get('PRODUCE_TEE_SEGMENTS', '1') != '0'
+# TTS responses opened ahead of the one being written in stream mode
+TTS_STREAM_PREFETCH = int(os.environ.get('TTS_STREAM_PREFETCH', 4))
+# Speech of slow=0 podcasts is rendered while its text is still being generated, in pieces
+# of at least SPEECH_CHUNK_CHARACTERS that end with a sentence
+PIPELINED_SPEECH = os.environ.get('PIPELINED_SPEECH', '0') != '0'
+SPEECH_CHUNK_CHARACTERS = int(os.environ.get('SPEECH_CHUNK_CHARACTERS', 300))
+# Size of the parts uploaded while writing the podcast
+UPLOAD_BLOCK_SIZE = int(os.environ.get('UPLOAD_BLOCK_SIZE', 16 * 1024 * 1024))
+# Audio of a streamed segment kept in memory while it is read, larger ones are spilled to a temporary file
+TTS_SPOOL_BYTES = int(os.environ.get('TTS_SPOOL_BYTES', 4 * 1024 * 1024))
+# Input files downloaded at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+# Peak memory, in MiB, the event manager should stay under, 0 for no target. With a target,
+# caches, worker processes and PDF parsing are sized to fit in it
+MEMORY_TARGET_MB = int(os.environ.get('MEMORY_TARGET_MB', 0))
+# Folder the ingestion processes spill extracted texts to, in any fsspec filesystem. /tmp is memory
+# backed in Cloud Functions, so texts spilled there would count against the memory they are spilled to save
+SPILL_DIR = os.environ.get('SPILL_DIR', "gs://yggdrasil-ai-hermod-spodkast/_spill")
+# Spilled texts left behind by crashed invocations are deleted by the scheduled prune of backfill.py
+SPILL_TTL = int(os.environ.get('SPILL_TTL', 24 * 3600))
+# Memory taken by each ingestion worker process
+INGESTION_PROCESS_MB = int(os.environ.get('INGESTION_PROCESS_MB', 128))
+# Content-addressed store of the input documents, their extracted text and their summaries,
+# shared by every workspace, which only keep links to its documents
+DOCUMENT_STORE_ENABLED = os.environ.get('DOCUMENT_STORE_ENABLED', '1') != '0'
+DOCUMENT_STORE_ROUTE = os.environ.get('DOCUMENT_STORE_ROUTE', "gs://yggdrasil-ai-hermod-spodkast/_documents")
+SINTONIA_AUDIO = os.environ.get('SINTONIA_AUDIO', "gs://yggdrasil-ai-hermod-public/sintonia.mp3")
+# Audio files included in every podcast, kept in memory between invocations
+HOT_AUDIO_ASSETS = {SINTONIA_AUDIO}
 ENTITY = "spodkast"
-SPODKAST_ROUTE = "gs://yggdrasil-ai-hermod-spodkast/{owner}/{id}"
+# Routes can be changed to run against a copy of the buckets, e.g. in backfills
+SPODKAST_ROUTE = os.environ.get('SPODKAST_ROUTE', "gs://yggdrasil-ai-hermod-spodkast/{owner}/{id}")
 EXPORT_ROUTE = "yggdrasil-ai-hermod-public/spodkast/{owner}/{id}"
+EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER', "gs://" + EXPORT_ROUTE)
 USER = "pdftopodcastmanager"
+# Seconds an event invocation may run, it should match the function timeout
+EVENT_TIME_BUDGET = int(os.environ.get('EVENT_TIME_BUDGET', 540))
+# The function is deployed with retries, so failed events are delivered again, with backoff, until
+# they are EVENT_MAX_AGE seconds old. Older deliveries are dropped instead of retried for days
+EVENT_MAX_AGE = int(os.environ.get('EVENT_MAX_AGE', 6 * 3600))
+# Whether slow=0 requests run the following stages in the same invocation
+FUSED_PIPELINE = os.environ.get('FUSED_PIPELINE', '1') != '0'
+# Seconds that must be left in the invocation to start each fused stage
+FUSED_STAGE_SECONDS = {
+    "extend": int(os.environ.get('FUSED_EXTEND_SECONDS', 180)),
+    "produce": int(os.environ.get('FUSED_PRODUCE_SECONDS', 240)),
+    "export": int(os.environ.get('FUSED_EXPORT_SECONDS', 30)),
+}
+# Deliveries of an event already handled in its workspace in the last IDEMPOTENCY_TTL seconds are skipped
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', '1') != '0'
+# Bump when prompts or models change, so every manifest artifact is rebuilt
+MANIFEST_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Object stores take about one write per second to the same object, so the manifest and the
+# progress file are written at most every MANIFEST_FLUSH_SECONDS and PROGRESS_INTERVAL_SECONDS
+# while a stage runs, and the manifest once more when the stage ends
+MANIFEST_FLUSH_SECONDS = float(os.environ.get('MANIFEST_FLUSH_SECONDS', 2))
+PROGRESS_INTERVAL_SECONDS = float(os.environ.get('PROGRESS_INTERVAL_SECONDS', 2))
+PROGRESS_FILE = "progress.json"
+TTS_MODEL_ID = "eleven_monolingual_v1"
+TTS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.5
+}
+# Cache of OpenAI answers, keyed by model, prompt and messages
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') != '0'
+LLM_CACHE_ROUTE = os.environ.get('LLM_CACHE_ROUTE', "gs://yggdrasil-ai-hermod-spodkast/_cache/llm")
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 1024))
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 30 * 24 * 3600))
+# Cache of rendered audio, keyed by voice, TTS settings and text, shared by all workspaces.
+# Segments are only cached in TTS_CACHE_ROUTE, hot assets like SINTONIA_AUDIO are kept in memory
+TTS_CACHE_ENABLED = os.environ.get('TTS_CACHE_ENABLED', '1') != '0'
+TTS_CACHE_ROUTE = os.environ.get('TTS_CACHE_ROUTE', "gs://yggdrasil-ai-hermod-spodkast/_cache/tts")
+TTS_CACHE_MAX_ENTRIES = int(os.environ.get('TTS_CACHE_MAX_ENTRIES', 16))
+TTS_CACHE_TTL = int(os.environ.get('TTS_CACHE_TTL', 90 * 24 * 3600))
+TTS_MEMORY_CACHE_BYTES = int(os.environ.get('TTS_MEMORY_CACHE_BYTES', 32 * 1024 * 1024))
+# Size the persistent tier of the TTS cache is pruned to, 0 to only prune expired entries
+TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+# Whether prompts, answers and TTS texts are written to the logs
+LOG_PROMPTS = os.environ.get('LOG_PROMPTS', '0') != '0'
+
+LLM_CACHE = TieredCache("llm", LLM_CACHE_ROUTE, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+# Under a memory target, audio kept in memory takes at most a sixteenth of it
+TTS_CACHE = TieredCache("tts", TTS_CACHE_ROUTE, TTS_CACHE_MAX_ENTRIES, TTS_CACHE_TTL,
+                        max_bytes=min(TTS_MEMORY_CACHE_BYTES, MEMORY_TARGET_MB * 1024 * 1024 // 16)
+                        if MEMORY_TARGET_MB else TTS_MEMORY_CACHE_BYTES)
 
+@traced("pubsub.publish")
 def publish_message(author:str, operation:str, entity_id:str, payload:str):
     """
     This function publishes the message.
@@ -50,22 +177,29 @@ def publish_message(author:str, operation:str, entity_id:str, payload:str):
         "entityId": entity_id,
         "operation": operation,
         "timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        # Tells this event apart from identical requests, so only its own redeliveries are skipped
+        "requestId": secrets.token_hex(16),
         "payload": payload
     }
     message_json = json.dumps(message).encode("utf-8")
-    print("Publishing ", message_json)
-    publisher = pubsub_v1.PublisherClient()
+    logging.info(f"Publishing {message_json if LOG_PROMPTS else operation}")
+    current_span().set(operation=operation, entity_id=entity_id, bytes=len(message_json))
+    publisher = get_publisher()
     topic_path = publisher.topic_path(PROJECT_ID, EVENT_BUS)
     publish_future = publisher.publish(topic_path,
                                         data=message_json)
     publish_future.result()
 
+@traced("http.notify")
 def _make_authorized_post_request(endpoint, payload):
     """
     make_authorized_get_request makes a POST request to the specified HTTP endpoint
     by authenticating with the ID token obtained from the google-auth client library
     using the specified audience value.
     """
+    import urllib.request
+    import google.auth.transport.requests
+    import google.oauth2.id_token
 
     req = urllib.request.Request(endpoint)
 
@@ -79,54 +213,320 @@ def _make_authorized_post_request(endpoint, payload):
     response = urllib.request.urlopen(req)
     return json.load(response)
 
-def generate_answer(prompt, message_list, model, attempt=0):
+def _stream_completion(limiter, full_prompt, tokens, on_text):
+    """
+    Requests full_prompt as a stream and calls on_text with every piece of the answer as it arrives.
+    Opening the stream is retried like any other request, but a stream cut halfway is not,
+    as its first pieces were already handed over.
+    Returns the whole answer.
+    """
+    span = current_span()
+    started = time.perf_counter()
+    stream = call_with_retries(limiter, lambda: get_openai().ChatCompletion.create(stream=True, **full_prompt),
+                               tokens=tokens, max_attempts=LLM_MAX_ATTEMPTS)
+    pieces = []
+    for chunk in stream:
+        choices = chunk["choices"]
+        text = choices[0].get("delta", {}).get("content") if choices else None
+        if not text:
+            continue
+        if not pieces:
+            span.set(first_text_ms=round((time.perf_counter() - started) * 1000, 1))
+        pieces.append(text)
+        on_text(text)
+    return "".join(pieces)
+
+@traced("llm.chat")
+def generate_answer(prompt, message_list, model, use_cache=True, on_text=None):
         """
         This function will continue the conversation.
+        Answers are cached by model, prompt and messages unless use_cache is False.
+        Requests go through the rate limiter of the model, and transient failures
+        are retried up to LLM_MAX_ATTEMPTS times with backoff.
         Parameters:
-            conversation_info: The information of the conversation
-            message: The message to append
+            prompt: The system prompt
+            message_list: The user messages
+            model: The OpenAI model to use
+            use_cache: Whether to look up and store the answer in LLM_CACHE
+            on_text: If given, the answer is streamed and on_text is called with every piece of it
+                as it arrives. Cached answers are handed over in a single piece.
         """
+        span = current_span()
+        span.set(model=model, messages=len(message_list), cached=False)
+        use_cache = use_cache and LLM_CACHE_ENABLED
+        if use_cache:
+            cache_key = LLM_CACHE.key(model, prompt, message_list)
+            cached = LLM_CACHE.get(cache_key)
+            if cached is not None:
+                logging.info("Answer found in cache")
+                span.set(cached=True)
+                response = cached.decode("utf-8")
+                if on_text:
+                    on_text(response)
+                return response
+
         logging.info("Generating answer")
         messages = [{"role": "system", "content": prompt}]
         messages.extend([{"role": "user", "content": message} for message in message_list])
-        print(messages)
         full_prompt = {
             "model": model,
             "messages": messages
         }
 
-        logging.info("Calling OpenAI: {}".format(full_prompt))
+        if LOG_PROMPTS:
+            logging.info("Calling OpenAI: {}".format(full_prompt))
 
-        try:
-          response = openai.ChatCompletion.create(**full_prompt)["choices"][0]["message"]["content"]
-        except Exception as e:
-          if attempt < 3:
-            response = generate_answer(prompt, message_list, model, attempt+1)
-          else:
-            raise e
+        limiter = get_rate_limiter("llm", model)
+        # Tokens are only counted when there is a tokens per minute quota to respect
+        estimate = 0
+        if LLM_TOKENS_PER_MINUTE:
+            estimate = sum(count_tokens(message["content"], model) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+        if on_text:
+            response = _stream_completion(limiter, full_prompt, estimate, on_text)
+            # Streams don't report their usage
+            usage = {}
+            if LLM_TOKENS_PER_MINUTE:
+                completion_tokens = count_tokens(response, model)
+                usage = {"prompt_tokens": estimate, "completion_tokens": completion_tokens,
+                         "total_tokens": estimate + completion_tokens}
+        else:
+            completion = call_with_retries(limiter, lambda: get_openai().ChatCompletion.create(**full_prompt),
+                                           tokens=estimate, max_attempts=LLM_MAX_ATTEMPTS)
+            response = completion["choices"][0]["message"]["content"]
+            usage = completion.get("usage") or {}
+        span.set(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+        if LLM_TOKENS_PER_MINUTE and usage:
+            limiter.consume(usage.get("total_tokens", estimate) - estimate)
+        if LOG_PROMPTS:
+            logging.info(f"OpenAI answered: {response}")
+        if use_cache:
+            LLM_CACHE.put(cache_key, response.encode("utf-8"))
         return response
 
-def read_file(file):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-    with fs.open(file, 'r') as f:
-        content = f.read()
-    return content
+DOCUMENT_STORE = DocumentStore(DOCUMENT_STORE_ROUTE)
+
+@traced("stage.download")
+def download_files(urls, folder, on_downloaded=None):
+    """
+    This function downloads urls into folder concurrently and returns the saved files in order.
+    With DOCUMENT_STORE_ENABLED, the files are downloaded into DOCUMENT_STORE and linked from folder.
+    The first failure cancels the downloads not yet started and is raised.
+    Parameters:
+        urls: Urls of the files
+        folder: Folder where the files are saved
+        on_downloaded: Optional callback called with every file saved, as soon as it is
+    """
+    budget = ByteBudget(MAX_INPUT_BYTES)
+    span = current_span()
+    def download(url):
+        filename = url.split('/')[-1]
+        logging.info(f"Downloading {filename}")
+        if DOCUMENT_STORE_ENABLED:
+            digest = DOCUMENT_STORE.download(url, budget=budget)
+            saved_file = DOCUMENT_STORE.link(digest, f"{folder}/{filename}", url=url)
+        else:
+            saved_file = download_file(url, f"{folder}/{filename}", budget=budget)
+        if on_downloaded is not None:
+            on_downloaded(saved_file)
+        return saved_file
+    executor = ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(urls))))
+    try:
+        futures = [executor.submit(in_current_context(download), url) for url in urls]
+        saved_files = [future.result() for future in futures]
+    finally:
+        executor.shutdown(cancel_futures=True)
+    span.set(files=len(saved_files))
+    return saved_files
 
-def read_bytes(file):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+_progress_written = {}
+
+def report_progress(workspace, stage, throttle=False, **details):
+    """
+    This function writes the current stage of the workspace to its progress file.
+    Parameters:
+        workspace: Workspace of the podcast
+        stage: Name of the stage being run
+        throttle: Skip the update if the file was written less than PROGRESS_INTERVAL_SECONDS ago
+        details: Extra fields saved with the stage
+    """
+    now = time.monotonic()
+    if throttle and now - _progress_written.get(workspace, -math.inf) < PROGRESS_INTERVAL_SECONDS:
+        return
+    _progress_written[workspace] = now
+    progress = {"stage": stage,
+                "timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                **details}
+    write_to_file(f"{workspace}/{PROGRESS_FILE}", json.dumps(progress))
+
+def file_fingerprint(file):
+    """
+    Returns a hash of the content of file, taken from the object metadata when
+    the filesystem provides one, or computed reading it by blocks otherwise.
+    """
+    fs = get_filesystem()
+    info = fs.info(file)
+    for field in ("md5Hash", "crc32c"):
+        if info.get(field):
+            return f"{field}:{info[field]}"
+    digest = hashlib.sha256()
     with fs.open(file, 'rb') as f:
-        content = f.read()
-    return content
+        for block in iter(lambda: f.read(AUDIO_BLOCK_SIZE), b''):
+            digest.update(block)
+    return f"sha256:{digest.hexdigest()}"
+
+class WorkspaceManifest:
+    """
+    Artifacts of a workspace, stored in {workspace}/manifest.json.
+    For every artifact it keeps the hash of the inputs it was built from and
+    its output file, so stages skip the artifacts whose inputs haven't changed.
+    Records are saved at most every MANIFEST_FLUSH_SECONDS, and when a stage using the
+    manifest as a context manager ends, so a retried event resumes from the last
+    artifacts saved while concurrent artifacts don't write the manifest one by one.
+    """
+    def __init__(self, workspace):
+        self.path = f"{workspace}/{MANIFEST_FILE}"
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._saved = time.monotonic()
+        self.artifacts = {}
+        try:
+            content = json.loads(read_file(self.path))
+            if content.get("version") == MANIFEST_VERSION:
+                self.artifacts = content.get("artifacts", {})
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def lookup(self, artifact, inputs_hash):
+        """Returns the output of artifact if it was built from inputs_hash and still exists."""
+        with self._lock:
+            entry = self.artifacts.get(artifact)
+        if entry and entry["inputs"] == inputs_hash and get_filesystem().exists(entry["output"]):
+            return entry["output"]
+        return None
 
-def write_to_file(file, content):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-    with fs.open(file, "w") as file_:
-        file_.write(content)
+    def record(self, artifact, inputs_hash, output):
+        with self._lock:
+            self.artifacts[artifact] = {
+                "inputs": inputs_hash,
+                "output": output,
+                "updated": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            self._dirty = True
+            due = time.monotonic() - self._saved >= MANIFEST_FLUSH_SECONDS
+        if due:
+            # A write in progress from another thread saves this record or leaves it for the next one
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """Saves the records not saved yet. Without wait, returns at once if another thread is saving."""
+        if not self._write_lock.acquire(blocking=wait):
+            return
+        try:
+            with self._lock:
+                if not self._dirty:
+                    return
+                content = json.dumps({"version": MANIFEST_VERSION, "artifacts": self.artifacts},
+                                     indent=2, sort_keys=True)
+                self._dirty = False
+                self._saved = time.monotonic()
+            try:
+                write_to_file(self.path, content)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+        finally:
+            self._write_lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+def build_text_artifact(manifest, artifact, inputs_hash, output, generate):
+    """
+    Returns the text of artifact, reading it from output when the manifest has it
+    built from inputs_hash, or generating, writing and recording it otherwise.
+    """
+    if manifest.lookup(artifact, inputs_hash):
+        logging.info(f"Reusing {artifact}")
+        return read_file(output)
+    text = generate()
+    write_to_file(output, text)
+    manifest.record(artifact, inputs_hash, output)
+    return text
+
+# End of a sentence, with its closing quotes or brackets, or of a paragraph
+_SPEECH_BREAK = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n\s*\n")
+
+class SpeechSplitter:
+    """
+    Collects text as it is generated and hands over pieces of at least min_characters
+    that end with a sentence or a paragraph, so they can be spoken while the rest is written.
+    """
+    def __init__(self, on_piece, min_characters=None):
+        self.on_piece = on_piece
+        self.min_characters = max(1, min_characters or SPEECH_CHUNK_CHARACTERS)
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        while len(self.buffer) >= self.min_characters:
+            cut = next((match.end() for match in _SPEECH_BREAK.finditer(self.buffer)
+                        if match.end() >= self.min_characters), None)
+            if cut is None:
+                return
+            piece, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if piece:
+                self.on_piece(piece)
 
-def write_bytes(file, content):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-    with fs.open(file, mode='wb') as file_:
-        file_.write(content)
+    def close(self):
+        piece, self.buffer = self.buffer.strip(), ""
+        if piece:
+            self.on_piece(piece)
+
+def build_spoken_artifact(manifest, artifact, inputs_hash, output, generate, voice, audio_artifact, audio_output):
+    """
+    Like build_text_artifact, but the text is spoken with voice while generate(on_text) writes it:
+    every piece handed over by a SpeechSplitter is rendered at once, and the pieces are combined
+    in order into audio_output when the text is complete. The audio is recorded in the manifest
+    as audio_artifact the way generate_podcast does, so producing the podcast only combines it.
+    """
+    if manifest.lookup(artifact, inputs_hash):
+        logging.info(f"Reusing {artifact}")
+        return read_file(output)
+    parts = []
+    with ThreadPoolExecutor(max_workers=max(1, TTS_VOICE_CONCURRENCY)) as executor:
+        def speak(piece):
+            part_file = f"{audio_output[:-len('.mp3')]}.part{len(parts)}.mp3"
+            parts.append(executor.submit(in_current_context(generate_audio), voice, piece, part_file))
+        splitter = SpeechSplitter(speak)
+        text = generate(splitter.feed)
+        splitter.close()
+        part_files = [part.result() for part in parts]
+    write_to_file(output, text)
+    manifest.record(artifact, inputs_hash, output)
+    combine_audios(part_files, audio_output)
+    manifest.record(audio_artifact, content_hash(voice, text, TTS_MODEL_ID, TTS_VOICE_SETTINGS), audio_output)
+    if part_files:
+        get_filesystem().rm(part_files)
+    return text
+
+def _text_artifact(manifest, workspace, artifact, inputs_hash, generate, speech=None):
+    """
+    Builds the text artifact saved in {workspace}/{artifact}.txt.
+    With speech, a (voice, audio file) pair, the text is spoken while it is generated.
+    """
+    output = f'{workspace}/{artifact}.txt'
+    if speech is None:
+        return build_text_artifact(manifest, artifact, inputs_hash, output, generate)
+    voice, audio_artifact = speech
+    return build_spoken_artifact(manifest, artifact, inputs_hash, output, generate,
+                                 voice, audio_artifact, f'{workspace}/{audio_artifact}')
 
 def parse_sections(text):
     # Split the text into sections
@@ -137,9 +537,231 @@ def parse_sections(text):
 
     return sections
 
-def summarizer(text, max_tokens=2000):
-    """Summarize a given piece of text using GPT-3"""
-    # Tokenize text and split into chunks of 2000 tokens
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+# Pieces of at most 4 word characters, a punctuation sign or trailing whitespace,
+# each with its leading whitespace. They are never fewer than the BPE tokens
+# of English text, and joining them gives back the original text
+_APPROXIMATE_TOKEN = re.compile(r"\s*(?:\w{1,4}|[^\w\s])|\s+")
+_WORD = re.compile(r"\w+|[^\w\s]")
+
+def register_tokenizer(model, encode, decode):
+    """
+    Registers the tokenizer used to count and split the tokens of model.
+    Parameters:
+        model: The OpenAI model
+        encode: Function turning a text into a list of tokens
+        decode: Function turning a list of tokens back into text
+    """
+    with _tokenizers_lock:
+        _tokenizers[model] = (encode, decode)
+
+def _build_tokenizer(model):
+    if TOKENIZER == "tiktoken":
+        try:
+            import tiktoken
+            encoding = tiktoken.encoding_for_model(model)
+            return encoding.encode, encoding.decode
+        except Exception as e:
+            logging.warning(f"Could not load tiktoken for {model}, using approximate tokenizer: {e}")
+    return _APPROXIMATE_TOKEN.findall, ''.join
+
+def get_tokenizer(model):
+    """Returns the (encode, decode) functions registered for model."""
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            _tokenizers[model] = _build_tokenizer(model)
+        return _tokenizers[model]
+
+def count_tokens(text, model):
+    return len(get_tokenizer(model)[0](text))
+
+def message_token_budget(prompt, model, reserve=None):
+    """
+    Returns how many tokens the user messages of a call to model can take,
+    once the system prompt and the answer reserve are left out of its context window.
+    """
+    if reserve is None:
+        reserve = RESPONSE_TOKEN_RESERVE
+    context_window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    budget = context_window - count_tokens(prompt, model) - MESSAGE_TOKEN_OVERHEAD - reserve
+    if budget <= 0:
+        raise ValueError(f"The context window of {model} ({context_window} tokens) can't fit the prompt and a {reserve} tokens answer")
+    return budget
+
+class StreamingReducer:
+    """
+    Hierarchical reduction that runs while its inputs are still being produced.
+    Each level packs its texts, in document order, into groups of at most fan_in
+    texts whose tokens fit in budget. A group is reduced as soon as it is full,
+    and its result becomes an input of the next level.
+    """
+    def __init__(self, reduce, budget, model, executor, fan_in=None):
+        self.reduce = reduce
+        self.budget = budget
+        self.model = model
+        self.executor = executor
+        self.fan_in = max(2, fan_in or REDUCE_FAN_IN)
+        self.levels = []
+        self.calls = 0
+
+    def _level(self, k):
+        while len(self.levels) <= k:
+            self.levels.append({"pending": deque(), "group": [], "tokens": 0})
+        return self.levels[k]
+
+    def add(self, future, level=0):
+        """Adds the future of a text that follows every text already added to level."""
+        self._level(level)["pending"].append(future)
+        self.pump()
+
+    def _emit(self, k):
+        level = self.levels[k]
+        group = level["group"]
+        level["group"], level["tokens"] = [], 0
+        self.calls += 1
+        self._level(k + 1)["pending"].append(self.executor.submit(self.reduce, group))
+
+    def _append(self, k, text):
+        level = self.levels[k]
+        text_tokens = count_tokens(text, self.model) + MESSAGE_TOKEN_OVERHEAD
+        if level["group"] and level["tokens"] + text_tokens > self.budget:
+            self._emit(k)
+        level["group"].append(text)
+        level["tokens"] += text_tokens
+        if len(level["group"]) >= self.fan_in:
+            self._emit(k)
+
+    def pump(self):
+        """Moves every finished text, in order, into the open group of its level."""
+        k = 0
+        while k < len(self.levels):
+            pending = self.levels[k]["pending"]
+            while pending and pending[0].done():
+                self._append(k, pending.popleft().result())
+            k += 1
+
+    def result(self):
+        """Waits for every input and reduction, and returns the final text."""
+        k = 0
+        while k < len(self.levels):
+            level = self.levels[k]
+            # Lower levels are flushed, so nothing else can arrive to this one
+            while level["pending"]:
+                wait([level["pending"][0]])
+                self.pump()
+            higher = any(upper["pending"] or upper["group"] for upper in self.levels[k + 1:])
+            if not higher and len(level["group"]) <= 1:
+                return level["group"][0] if level["group"] else ""
+            if len(level["group"]) == 1:
+                # A lone trailing text goes up a level without being reduced
+                promoted = Future()
+                promoted.set_result(level["group"][0])
+                level["group"], level["tokens"] = [], 0
+                self._level(k + 1)["pending"].append(promoted)
+            elif level["group"]:
+                self._emit(k)
+            k += 1
+        return ""
+
+def iter_pdf_pages(file, parent=None):
+    """
+    Yields the text of each page of the PDF in file.
+    The PDF is read lazily by ranges, so it is never fully loaded in memory.
+    """
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    fs = get_filesystem()
+    # The consumer runs between pages, so extract_ms only counts the time spent in pdfminer
+    span = start_span("pdf.extract", parent=parent, path=file, pages=0, extract_ms=0.0)
+    error = None
+    try:
+        with fs.open(file, 'rb', block_size=PDF_BLOCK_SIZE) as fp:
+            resource_manager = PDFResourceManager(caching=True)
+            laparams = LAParams()
+            # Cached objects of the document add up to its whole size, so they are dropped under a memory target
+            for page in PDFPage.get_pages(fp, caching=not MEMORY_TARGET_MB):
+                started = time.perf_counter()
+                output = StringIO()
+                device = TextConverter(resource_manager, output, laparams=laparams)
+                PDFPageInterpreter(resource_manager, device).process_page(page)
+                device.close()
+                text = output.getvalue()
+                span.add("extract_ms", (time.perf_counter() - started) * 1000)
+                span.add("pages", 1)
+                span.add("characters", len(text))
+                yield text
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(span, error)
+
+def iter_text_chunks(pages, max_tokens, model, stats=None):
+    """
+    Yields chunks of max_tokens model tokens from the texts in pages, each of them
+    as soon as it fills, so summarization can start while pages are read.
+    When stats is given, the words seen are added to stats["words"].
+    """
+    encode, decode = get_tokenizer(model)
+    if encode == _APPROXIMATE_TOKEN.findall:
+        yield from _iter_offset_chunks(pages, max_tokens, stats)
+        return
+    tokens = []
+    start = 0
+    for page in pages:
+        if stats is not None:
+            stats["words"] = stats.get("words", 0) + len(_WORD.findall(page))
+        tokens.extend(encode(page))
+        while len(tokens) - start >= max_tokens:
+            yield decode(tokens[start:start + max_tokens])
+            start += max_tokens
+        del tokens[:start]
+        start = 0
+    if tokens:
+        yield decode(tokens)
+
+def _iter_offset_chunks(pages, max_tokens, stats=None):
+    """
+    iter_text_chunks for the approximate tokenizer, whose tokens are never built:
+    the text is scanned once for the offset where every max_tokens tokens end,
+    and chunks are sliced from it. The last token of each page may go on in the
+    next one, so it is the only text scanned again.
+    """
+    pending = ""
+    scanned = count = 0
+    for page in pages:
+        if stats is not None:
+            stats["words"] = stats.get("words", 0) + sum(1 for _ in _WORD.finditer(page))
+        pending += page
+        start = 0
+        last = None
+        for match in _APPROXIMATE_TOKEN.finditer(pending, scanned):
+            if last is not None:
+                count += 1
+                if count == max_tokens:
+                    yield pending[start:last.end()]
+                    start, count = last.end(), 0
+            last = match
+        if last is not None:
+            scanned = last.start()
+        pending = pending[start:]
+        scanned -= start
+    if pending:
+        yield pending
+
+def summarizer(text=None, max_tokens=None, max_workers=None, pages=None, stats=None):
+    """
+    Summarize a given piece of text using GPT-3.
+    Instead of text, an iterable of pages can be given, and each chunk is
+    summarized as soon as enough pages have been read to fill it.
+    Chunks and reduce groups are packed up to the model context window,
+    or up to max_tokens tokens if given.
+    When stats is given, the chunks and LLM calls are set in stats["chunks"] and stats["calls"].
+    """
     SUMMARIZER_PROMPT = """You are a text analyst. You will receive a fragment of a text and you should summarize it, and select its more original and remarkable statements and present them in a particular format. Example:
     ```
     user: very advanced school, by amusing the poor.
@@ -171,70 +793,259 @@ def summarizer(text, max_tokens=2000):
     Summary and original statements must always provide different information, summary shouldn't be deductible from original statements.
     Your answer should have a #summary# and an #original statements# section"""
         
-    tokens = word_tokenize(text)
-    chunks = [tokens[i:i + 2000] for i in range(0, len(tokens), max_tokens)]
-
-    # Summarize each chunk
-    summaries = [generate_answer(SUMMARIZER_PROMPT, [' '.join(chunk)], "gpt-3.5-turbo") for chunk in chunks]
-
-    def reduce_summaries(summaries):
-        # Pack summaries into groups with sum of tokens <= 3000
-        summary_groups = []
-        current_group = []
-        current_group_tokens = 0
-        for summary in summaries:
-            summary_tokens = len(word_tokenize(summary))
-            if current_group_tokens + summary_tokens > 2000:
-                # Start a new group
-                summary_groups.append(current_group)
-                current_group = [summary]
-                current_group_tokens = summary_tokens
-            else:
-                # Add to the current group
-                current_group.append(summary)
-                current_group_tokens += summary_tokens
-        # Add the last group if it isn't empty
-        if current_group:
-            summary_groups.append(current_group)
-        mapreduced = [generate_answer(SUMMARIZATION_MAPREDUCE_PROMPT, group, "gpt-3.5-turbo") for group in summary_groups]
-        return mapreduced
-    
-    while len(summaries) > 1:
-        summaries = reduce_summaries(summaries)
-    
-    return summaries[0]
+    if pages is None:
+        pages = [text]
+    model = SUMMARIZER_MODEL
+    chunk_budget = message_token_budget(SUMMARIZER_PROMPT, model)
+    reduce_budget = message_token_budget(SUMMARIZATION_MAPREDUCE_PROMPT, model)
+    if max_tokens is not None:
+        chunk_budget = min(chunk_budget, max_tokens)
+        reduce_budget = min(reduce_budget, max_tokens)
+    budget_stats = {"words": 0}
+    chunks = iter_text_chunks(pages, chunk_budget, model, stats=budget_stats)
+    if max_workers is None:
+        max_workers = SUMMARIZER_CONCURRENCY
+    max_workers = max(1, max_workers)
+
+    # Summarize each chunk as it arrives, and reduce adjacent summaries as soon
+    # as they fill a group. Only a few chunks are held waiting for a worker,
+    # so memory doesn't grow with the document size
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        reducer = StreamingReducer(in_current_context(lambda group: generate_answer(SUMMARIZATION_MAPREDUCE_PROMPT, group, model)),
+                                   reduce_budget, model, executor)
+        pending_chunks = threading.BoundedSemaphore(2 * max_workers)
+        chunks_count = 0
+        for chunk in chunks:
+            pending_chunks.acquire()
+            future = executor.submit(in_current_context(generate_answer), SUMMARIZER_PROMPT, [chunk], model)
+            future.add_done_callback(lambda _: pending_chunks.release())
+            reducer.add(future)
+            chunks_count += 1
+        summary = reducer.result()
+
+    legacy_chunks = math.ceil(budget_stats["words"] / LEGACY_CHUNK_WORDS)
+    current_span().set(chunks=chunks_count, calls=chunks_count + reducer.calls)
+    if stats is not None:
+        stats.update(chunks=chunks_count, calls=chunks_count + reducer.calls)
+    logging.info(f"Summarized {chunks_count} chunks of up to {chunk_budget} tokens with {chunks_count + reducer.calls} calls. "
+                 f"Splitting in chunks of {LEGACY_CHUNK_WORDS} words would have needed {legacy_chunks} chunks, "
+                 f"{legacy_chunks - chunks_count} more summarization calls")
+
+    return summary
+
+def spill_pages(pages, folder=None):
+    """Writes pages to a new file in folder, SPILL_DIR by default, and returns its path."""
+    path = f"{(folder or SPILL_DIR).rstrip('/')}/pages-{secrets.token_hex(16)}.txt"
+    with get_filesystem(path_protocol(path)).open(path, 'w') as f:
+        for page in pages:
+            f.write(page.replace(PAGE_SEPARATOR, "") + PAGE_SEPARATOR)
+    return path
+
+def iter_spilled_pages(path, remove=True):
+    """
+    Yields the pages spilled to path, reading it by blocks so only the pages
+    being used are loaded. The file is removed afterwards if remove is set.
+    """
+    fs = get_filesystem(path_protocol(path))
+    try:
+        with fs.open(path, 'r', block_size=PDF_BLOCK_SIZE) as f:
+            yield from iter_separated_pages(f)
+    finally:
+        if remove and fs.exists(path):
+            fs.rm(path)
+
+def prune_spilled_pages(folder=None, ttl=None):
+    """
+    This function deletes the texts spilled to folder, SPILL_DIR by default, more than ttl
+    seconds ago (SPILL_TTL by default), which the invocations that spilled them never read.
+    Returns the number of files deleted.
+    """
+    folder = (folder or SPILL_DIR).rstrip('/')
+    ttl = SPILL_TTL if ttl is None else ttl
+    fs = get_filesystem(path_protocol(folder))
+    now = time.time()
+    try:
+        stale = [path for path, info in fs.find(folder, detail=True).items()
+                 if now - modified_time(fs, info) > ttl]
+        if stale:
+            fs.rm(stale)
+    except Exception as e:
+        logging.warning(f"Could not prune the spilled texts: {e}")
+        return 0
+    return len(stale)
 
-def process_input_files(workspace, input_files=None):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+def extract_pages(file, parent=None, spill_dir=None):
+    """
+    Spills the text of every page of the PDF in file to a file in spill_dir, SPILL_DIR by default,
+    as it is extracted, and returns its path, to be read with iter_spilled_pages. Only the path is
+    sent back, so neither process holds the whole text.
+    It runs in the ingestion process pool, so it only takes picklable arguments.
+    Its span is a child of parent, a (trace_id, span_id) pair, and is exported by the worker.
+    """
+    try:
+        return spill_pages(iter_pdf_pages(file, parent=parent), spill_dir)
+    finally:
+        export_spans()
+
+@traced("stage.summarize")
+def process_input_files(workspace, input_files=None, manifest=None):
+    if manifest is None:
+        manifest = WorkspaceManifest(workspace)
+    with manifest:
+        return _summarize_input_files(workspace, input_files, manifest)
+
+def _summarize_input_files(workspace, input_files, manifest):
+    fs = get_filesystem()
     if not input_files:
         # Get list of files in {workspace}/input_files
-        input_files = fs.glob(f'{workspace}/input_files/')
-    summaries = []
-    for file in input_files:
-        # Extract text
-        print('Processing:', file)
-        fp = BytesIO(read_bytes(file))
-        extracted_text = extract_text(fp)
-        print('Summarizing extracted text')
-        summarized_text = summarizer(extracted_text)
-        filename = file.split('/')[-1]
-        summaries += [summarized_text]
-        write_to_file(f"{workspace}/input_summaries/{filename}", summarized_text)
+        input_files = fs.glob(f'{workspace}/input_files/*')
+    summarizer_settings = (SUMMARIZER_MODEL, RESPONSE_TOKEN_RESERVE, REDUCE_FAN_IN)
+
+    summaries = [None] * len(input_files)
+    pending = []
+    reused = llm_calls_saved = 0
+    for i, file in enumerate(input_files):
+        # Linked documents are identified by their sha256, and their summaries may come from the store
+        digest, source, filename = DocumentStore.resolve(file)
+        fingerprint = f"sha256:{digest}" if digest else file_fingerprint(source)
+        inputs_hash = content_hash(fingerprint, summarizer_settings)
+        output = f"{workspace}/input_summaries/{filename}"
+        if manifest.lookup(f"input_summaries/{filename}", inputs_hash):
+            logging.info(f"Reusing summary of {filename}")
+            summaries[i] = read_file(output)
+            continue
+        stored = DOCUMENT_STORE.get_summary(digest, summarizer_settings) if digest and DOCUMENT_STORE_ENABLED else None
+        if stored is not None:
+            logging.info(f"Reusing the stored summary of {filename}")
+            summaries[i] = stored["summary"]
+            write_to_file(output, summaries[i])
+            manifest.record(f"input_summaries/{filename}", inputs_hash, output)
+            reused += 1
+            llm_calls_saved += stored.get("llm_calls", 0)
+        else:
+            pending.append((i, source, filename, digest, inputs_hash, output))
+    current_span().set(documents=len(input_files), summaries_reused=reused, llm_calls_saved=llm_calls_saved)
+    if reused:
+        logging.info(f"Reused {reused} of {len(input_files)} summaries from the document store, "
+                     f"saving {llm_calls_saved} LLM calls")
+
+    def summarize_file(file, filename, digest, pages, inputs_hash, output):
+        logging.info(f"Summarizing: {file}")
+        stats = {}
+        with trace_span("summarize.file", path=file):
+            summarized_text = summarizer(pages=pages, stats=stats)
+        write_to_file(output, summarized_text)
+        manifest.record(f"input_summaries/{filename}", inputs_hash, output)
+        if digest and DOCUMENT_STORE_ENABLED:
+            DOCUMENT_STORE.put_summary(digest, summarizer_settings, summarized_text, stats.get("calls", 0))
+        return summarized_text
+
+    # Documents whose text was extracted for another workspace are not extracted again
+    extracted = {}
+    if DOCUMENT_STORE_ENABLED:
+        for i, file, filename, digest, inputs_hash, output in pending:
+            pages = DOCUMENT_STORE.get_pages(digest) if digest else None
+            if pages is not None:
+                extracted[i] = pages
+    to_extract = [item for item in pending if item[0] not in extracted]
+
+    processes = min(INGESTION_PROCESSES, len(to_extract))
+    if MEMORY_TARGET_MB:
+        # Workers take what this process leaves of the target. This process doesn't
+        # parse PDFs while they do, so it stays under its peak
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        processes = min(processes, max(1, int(MEMORY_TARGET_MB - peak) // INGESTION_PROCESS_MB))
+        logging.info(f"{processes} ingestion processes fit in the {MEMORY_TARGET_MB} MiB target")
+    if processes <= 1:
+        # Pages are extracted while their chunks are summarized, so a single document
+        # is never waited for, nor spilled
+        for i, file, filename, digest, inputs_hash, output in pending:
+            pages = extracted.get(i)
+            if pages is None:
+                pages = iter_pdf_pages(file)
+                if digest and DOCUMENT_STORE_ENABLED:
+                    pages = DOCUMENT_STORE.record_pages(digest, pages)
+            summaries[i] = summarize_file(file, filename, digest, pages, inputs_hash, output)
+        return summaries
+
+    # pdfminer is pure Python and CPU bound, so files are extracted in a process pool
+    # while the files already extracted are summarized from threads, reading their
+    # spilled pages as they go
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as extractors, \
+         ThreadPoolExecutor(max_workers=processes) as summarizers:
+        extractions = {}
+        for item in to_extract:
+            logging.info(f"Processing: {item[1]}")
+            extractions[extractors.submit(extract_pages, item[1], current_span().context(), SPILL_DIR)] = item
+        futures = {}
+        for i, file, filename, digest, inputs_hash, output in pending:
+            if i in extracted:
+                futures[i] = summarizers.submit(in_current_context(summarize_file), file, filename, digest,
+                                                extracted[i], inputs_hash, output)
+        for extraction in as_completed(extractions):
+            i, file, filename, digest, inputs_hash, output = extractions[extraction]
+            pages = iter_spilled_pages(extraction.result())
+            if digest and DOCUMENT_STORE_ENABLED:
+                pages = DOCUMENT_STORE.record_pages(digest, pages)
+            futures[i] = summarizers.submit(in_current_context(summarize_file), file, filename, digest,
+                                            pages, inputs_hash, output)
+        for i, future in futures.items():
+            summaries[i] = future.result()
     return summaries
 
-def generate_introduction(podcast_plan, requirements):
+def generate_introduction(podcast_plan, requirements, on_text=None):
     GENERATE_INTRODUCTION_PROMPT = """You are a podcast speaker. You should write the introduction of a podcast which skeleton will be provided by the user.
     Keep it really short and interesting. You don't have to include all data, just to present the podcast, your colleagues will do the different sections after you.
     Keep it short. You should comply with this requirements: {podcast_requirements}"""
-    return generate_answer(GENERATE_INTRODUCTION_PROMPT.format(podcast_requirements=requirements), [podcast_plan], "gpt-3.5-turbo")
+    return generate_answer(GENERATE_INTRODUCTION_PROMPT.format(podcast_requirements=requirements), [podcast_plan], "gpt-3.5-turbo",
+                           on_text=on_text)
 
-def generate_closure(podcast_plan, requirements):
+def generate_closure(podcast_plan, requirements, on_text=None):
     GENERATE_CLOSURE_PROMPT = """You are a podcast speaker. You should write the closure of a podcast which skeleton will be provided by the user.
     Keep it short and engaging. You don't have to talk about all topics, as your colleagues have already tackled them.
     You should comply with this requirements: {podcast_requirements}"""
-    return generate_answer(GENERATE_CLOSURE_PROMPT.format(podcast_requirements=requirements), [podcast_plan], "gpt-3.5-turbo")
+    return generate_answer(GENERATE_CLOSURE_PROMPT.format(podcast_requirements=requirements), [podcast_plan], "gpt-3.5-turbo",
+                           on_text=on_text)
+
+def generate_section(section, requirements, on_text=None):
+    GENERATE_SECTION_PROMPT = """You are a speaker. You should write a section talking about some ideas and including some statements.
+    You should comply with this requirements: {podcast_requirements}"""
+    return generate_answer(GENERATE_SECTION_PROMPT.format(podcast_requirements=requirements), [section], "gpt-3.5-turbo",
+                           on_text=on_text)
 
-def generate_skeleton(workspace, requirements=None, summaries=None):
+def _add_section_tasks(graph, workspace, sections, requirements, manifest, speak=False):
+    """
+    Adds a task to graph writing each section to sections/section<i>.txt, named after the file.
+    With speak, each section is also spoken into mp3_sections/section<i>.mp3 while it is written.
+    Returns the names of the tasks, in the order of the sections.
+    """
+    names = []
+    for i, section in enumerate(sections, start=1):
+        name = f"sections/section{i}"
+        speech = (VOICE_SECTION, f"mp3_sections/section{i}.mp3") if speak else None
+        graph.add(name, functools.partial(
+            _text_artifact, manifest, workspace, name, content_hash(requirements, section),
+            functools.partial(generate_section, section, requirements), speech=speech))
+        names.append(name)
+    return names
+
+@traced("stage.plan")
+def generate_texts(workspace, requirements=None, summaries=None, manifest=None, with_sections=False, speak=False):
+    """
+    This function writes the podcast plan and then, concurrently, every text that only depends on it:
+    the introduction, the closure and, if with_sections is set, the speech of every section.
+    With speak, the texts after the plan are streamed and rendered to audio while they are written.
+
+    Parameters:
+    - workspace: folder of the spodkast
+    - requirements, summaries: read from the workspace if not given
+    - manifest: WorkspaceManifest used to reuse texts that were already written
+    - with_sections: whether the sections are written too
+    - speak: whether the texts are spoken while they are written
+
+    Returns a dict with the podcast_plan, its parsed sections, the introduction, the closure
+    and, with_sections, the written full_sections.
+    """
     GENERATE_STRUCTURE_PROMPT = """
     You are a podcast planner. You must create the skeleton of a podcast based on different summaries of some arguments, each with some original statements that must be stated in different moments of the podcast.
     You should divide it in sections, with the following structure:
@@ -246,119 +1057,507 @@ def generate_skeleton(workspace, requirements=None, summaries=None):
     ```
     The podcast must comply with the following requirements: {podcast_requirements}
     """
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+    fs = get_filesystem()
 
     if not requirements:
         requirements = read_file(f'{workspace}/requirements.txt')
     if not summaries:
-        summary_files = fs.glob(f'{workspace}/input_summaries/')
+        summary_files = fs.glob(f'{workspace}/input_summaries/*')
         summaries = [read_file(file) for file in summary_files]
-    podcast_plan = generate_answer(GENERATE_STRUCTURE_PROMPT.format(podcast_requirements=requirements), message_list=summaries, model="gpt-3.5-turbo")
-    write_to_file(f'{workspace}/podcast_plan.txt', podcast_plan)
-    sections = parse_sections(podcast_plan)
-    introduction = generate_introduction(podcast_plan, requirements)
-    write_to_file(f'{workspace}/introduction.txt', introduction)
-    closure = generate_closure(podcast_plan, requirements)
-    write_to_file(f'{workspace}/closure.txt', closure)
-    return introduction, sections, closure
-
-def generate_sections(workspace, sections = None, requirements = None):
-    GENERATE_SECTION_PROMPT = """You are a speaker. You should write a section talking about some ideas and including some statements.
-    You should comply with this requirements: {podcast_requirements}"""
-    
+    if manifest is None:
+        manifest = WorkspaceManifest(workspace)
+
+    graph = TaskGraph(TEXT_CONCURRENCY)
+    graph.add("podcast_plan", lambda: build_text_artifact(
+        manifest, "podcast_plan", content_hash(requirements, summaries), f'{workspace}/podcast_plan.txt',
+        lambda: generate_answer(GENERATE_STRUCTURE_PROMPT.format(podcast_requirements=requirements), message_list=summaries, model="gpt-3.5-turbo")))
+    graph.add("introduction", lambda podcast_plan: _text_artifact(
+        manifest, workspace, "introduction", content_hash(requirements, podcast_plan),
+        functools.partial(generate_introduction, podcast_plan, requirements),
+        speech=(VOICE_INTRODUCTION, "introduction.mp3") if speak else None), depends_on=["podcast_plan"])
+    graph.add("closure", lambda podcast_plan: _text_artifact(
+        manifest, workspace, "closure", content_hash(requirements, podcast_plan),
+        functools.partial(generate_closure, podcast_plan, requirements),
+        speech=(VOICE_CLOSURE, "closure.mp3") if speak else None), depends_on=["podcast_plan"])
+    graph.add("sections", parse_sections, depends_on=["podcast_plan"])
+    if with_sections:
+        # The number of sections is only known once the plan is written
+        graph.add("section_tasks", lambda sections: _add_section_tasks(graph, workspace, sections, requirements,
+                                                                       manifest, speak=speak),
+                  depends_on=["sections"])
+    with manifest:
+        results = graph.run()
+
+    texts = {key: results[key] for key in ("podcast_plan", "sections", "introduction", "closure")}
+    if with_sections:
+        texts["full_sections"] = [results[name] for name in results["section_tasks"]]
+    return texts
+
+@traced("stage.sections")
+def generate_sections(workspace, sections = None, requirements = None, manifest = None):
     if not sections:
         sections = parse_sections(read_file(f'{workspace}/podcast_plan.txt'))
     if not requirements:
         requirements = read_file(f"{workspace}/requirements.txt")
 
-    full_sections = []
-    i = 0
-    for section in sections:
-        i+=1
-        generated_section = generate_answer(GENERATE_SECTION_PROMPT.format(podcast_requirements=requirements), [section], "gpt-3.5-turbo")
-        write_to_file(f'{workspace}/sections/section{i}.txt', generated_section)
-        full_sections += [generated_section]
-    return full_sections
-
-def generate_podcast(workspace, introduction=None, sections=None, closure=None):
-    fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
+    if manifest is None:
+        manifest = WorkspaceManifest(workspace)
+
+    graph = TaskGraph(TEXT_CONCURRENCY)
+    names = _add_section_tasks(graph, workspace, sections, requirements, manifest)
+    with manifest:
+        results = graph.run()
+    return [results[name] for name in names]
+
+def _tts_request(voice, text):
+    """Returns the url, headers and body of the text-to-speech request of text."""
+    url = TTS_URL.format(voice=voice)
+
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": ELEVENLABS_API_KEY
+    }
+
+    data = {
+        "text": text,
+        "model_id": TTS_MODEL_ID,
+        "voice_settings": TTS_VOICE_SETTINGS
+    }
+    return url, headers, data
+
+def tts_cache_key(voice, text):
+    return TTS_CACHE.key(voice, TTS_MODEL_ID, TTS_VOICE_SETTINGS, text)
+
+@traced("tts.render")
+def generate_audio(voice, text, output_file):
+    """
+    Renders text with the given voice and saves the mp3 in output_file.
+    Requests go through the rate limiter of the voice, which allows TTS_VOICE_CONCURRENCY
+    requests at the same time, and failures are retried up to TTS_MAX_ATTEMPTS times.
+    """
+    fs = get_filesystem()
+    span = current_span()
+    span.set(voice=voice, characters=len(text), path=output_file, cached=False)
+    logging.info(f"Generating audio: {text if LOG_PROMPTS else output_file}. With voice: {voice}")
+    #audio = generate(text=text, voice=voice, verify=False)
+    url, headers, data = _tts_request(voice, text)
+
+    cache_key = tts_cache_key(voice, text)
+    if TTS_CACHE_ENABLED and TTS_CACHE.get_file(cache_key, output_file):
+        logging.info(f"Audio for {output_file} found in cache")
+        span.set(cached=True)
+        return output_file
+
+    def render():
+        with get_http_session().post(url, json=data, headers=headers, verify=False, stream=True) as response:
+            response.raise_for_status()
+            logging.info("Saving audio")
+            with fs.open(output_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=AUDIO_BLOCK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        span.add("bytes", len(chunk))
+
+    call_with_retries(get_rate_limiter("tts", voice), render, tokens=len(text), max_attempts=TTS_MAX_ATTEMPTS)
+    if TTS_CACHE_ENABLED:
+        TTS_CACHE.put_file(cache_key, output_file)
+    return output_file
+
+@traced("tts.request")
+def open_tts_stream(voice, text):
+    """
+    Requests text with the given voice and returns the response as soon as its
+    headers arrive, with its body still to be read from response.raw.
+    The request goes through the rate limiter of the voice and failures are
+    retried up to TTS_MAX_ATTEMPTS times.
+    """
+    current_span().set(voice=voice, characters=len(text))
+    logging.info(f"Streaming audio{': ' + text if LOG_PROMPTS else ''}. With voice: {voice}")
+    url, headers, data = _tts_request(voice, text)
+
+    def request():
+        response = get_http_session().post(url, json=data, headers=headers, verify=False, stream=True)
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    response = call_with_retries(get_rate_limiter("tts", voice), request, tokens=len(text), max_attempts=TTS_MAX_ATTEMPTS)
+    response.raw.decode_content = True
+    return response
+
+def generate_audios(segments, on_rendered=None):
+    """
+    Renders every (voice, text, output_file) segment concurrently.
+    Returns the output files in the same order as segments.
+    Parameters:
+        segments: The (voice, text, output_file) segments to render
+        on_rendered: Called with the index of each segment as soon as it is saved
+    """
+    def render(i, voice, text, output_file):
+        generate_audio(voice, text, output_file)
+        if on_rendered:
+            on_rendered(i)
+        return output_file
+
+    voices = set(voice for voice, _, _ in segments)
+    max_workers = max(1, min(len(segments), TTS_VOICE_CONCURRENCY * len(voices)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(in_current_context(render), i, voice, text, output_file)
+                   for i, (voice, text, output_file) in enumerate(segments)]
+        return [future.result() for future in futures]
+
+# Layer III bitrates (kbps) and sample rates (Hz) indexed by the MPEG version bits
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+ID3V1_SIZE = 128
+# Enough bytes to hold the largest Layer III frame
+MP3_PROBE_SIZE = 4096
+
+def _read_exactly(src, size):
+    """Reads size bytes from src unless the stream ends before."""
+    data = b''
+    while len(data) < size:
+        chunk = src.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def _mp3_info_frame_length(data):
+    """
+    Returns the length of the first frame in data when it is a Xing, Info or VBRI
+    header frame, which only describes the file it belongs to. Returns 0 otherwise.
+    """
+    if len(data) < 4 or data[0] != 0xFF or (data[1] & 0xE0) != 0xE0:
+        return 0
+    version = (data[1] >> 3) & 0x03
+    layer = (data[1] >> 1) & 0x03
+    bitrate_index = (data[2] >> 4) & 0x0F
+    sample_rate_index = (data[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return 0
+    padding = (data[2] >> 1) & 0x01
+    mono = ((data[3] >> 6) & 0x03) == 3
+    bitrate = MP3_BITRATES[version][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    frame_length = (144 if version == 3 else 72) * bitrate // sample_rate + padding
+    if version == 3:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    xing_tag = data[4 + side_info:8 + side_info]
+    if xing_tag in (b'Xing', b'Info') or data[36:40] == b'VBRI':
+        return frame_length
+    return 0
+
+def copy_mp3(src, dst, block_size=None):
+    """
+    Copies the mp3 stream in src into dst in blocks of block_size bytes,
+    leaving out its ID3 tags and Xing/Info/VBRI header frame so the
+    concatenated file is a plain sequence of audio frames.
+    Returns the number of bytes written.
+    """
+    if block_size is None:
+        block_size = AUDIO_BLOCK_SIZE
+    written = 0
+    block = _read_exactly(src, 10)
+    if len(block) == 10 and block[:3] == b'ID3':
+        tag_size = (block[6] << 21) | (block[7] << 14) | (block[8] << 7) | block[9]
+        if block[5] & 0x10:
+            # Tag has a footer
+            tag_size += 10
+        while tag_size > 0:
+            skipped = src.read(min(tag_size, block_size))
+            if not skipped:
+                break
+            tag_size -= len(skipped)
+        block = b''
+    block += _read_exactly(src, max(block_size, MP3_PROBE_SIZE) - len(block))
+    info_frame_length = _mp3_info_frame_length(block)
+    if 0 < info_frame_length <= len(block):
+        block = block[info_frame_length:]
+
+    # The last ID3V1_SIZE bytes are held back until the end of the stream is
+    # reached, as they may be an ID3v1 tag
+    tail = b''
+    while block:
+        if len(block) >= ID3V1_SIZE:
+            dst.write(tail)
+            dst.write(memoryview(block)[:-ID3V1_SIZE])
+            written += len(tail) + len(block) - ID3V1_SIZE
+            tail = block[-ID3V1_SIZE:]
+        else:
+            pending = tail + block
+            dst.write(pending[:-ID3V1_SIZE])
+            written += max(0, len(pending) - ID3V1_SIZE)
+            tail = pending[-ID3V1_SIZE:]
+        block = src.read(block_size)
+    if not (len(tail) == ID3V1_SIZE and tail[:3] == b'TAG'):
+        dst.write(tail)
+        written += len(tail)
+    return written
+
+def read_audio_asset(file):
+    """
+    Returns the content of an audio asset used by every podcast,
+    keeping it in the in-memory tier of TTS_CACHE.
+    """
+    cache_key = TTS_CACHE.key("asset", file)
+    content = TTS_CACHE.get(cache_key, persistent=False)
+    if content is None:
+        content = read_bytes(file)
+        TTS_CACHE.put(cache_key, content, persist=False)
+    return content
+
+def combine_audios(audio_files, destiny_name):
+    """
+    Concatenates audio_files into destiny_name, streaming each of them in
+    blocks so memory usage doesn't depend on the podcast length.
+    """
+    fs = get_filesystem()
+    with replacing_upload(destiny_name) as destiny_file:
+        for file in audio_files:
+            if file in HOT_AUDIO_ASSETS:
+                copy_mp3(BytesIO(read_audio_asset(file)), destiny_file)
+                continue
+            with fs.open(file, 'rb', block_size=AUDIO_BLOCK_SIZE) as audio_file:
+                copy_mp3(audio_file, destiny_file)
+    return destiny_name
+
+@contextlib.contextmanager
+def replacing_upload(path, block_size=None):
+    """
+    Opens an upload to a temporary object next to path, moved onto path when the block succeeds.
+    If the block fails the upload is discarded, so path keeps its last complete content.
+    """
+    fs = get_filesystem()
+    partial = f"{path}.{secrets.token_hex(8)}.partial"
+    destiny_file = fs.open(partial, 'wb', block_size=block_size or UPLOAD_BLOCK_SIZE)
+    try:
+        yield destiny_file
+        destiny_file.close()
+    except BaseException:
+        # Closing would commit what was written so far, and the partial object is removed if it was
+        for abort in (destiny_file.discard, destiny_file.close):
+            try:
+                abort()
+            except Exception:
+                pass
+        if fs.exists(partial):
+            fs.rm(partial)
+        raise
+    fs.mv(partial, path)
+
+def fetch_tts_audio(voice, text):
+    """
+    Reads the audio of text with the given voice into a spooled temporary file, requesting it
+    again if its body fails while it is read, up to TTS_MAX_ATTEMPTS times.
+    Returns the file, rewound.
+    """
+    for attempt in range(1, TTS_MAX_ATTEMPTS + 1):
+        response = open_tts_stream(voice, text)
+        audio = tempfile.SpooledTemporaryFile(max_size=TTS_SPOOL_BYTES)
+        try:
+            with response:
+                shutil.copyfileobj(response.raw, audio, AUDIO_BLOCK_SIZE)
+        except Exception as e:
+            audio.close()
+            if attempt == TTS_MAX_ATTEMPTS:
+                raise
+            logging.warning(f"Audio of voice {voice} failed while it was read, requesting it again: {e!r}")
+            current_span().add("body_retries", 1)
+            continue
+        audio.seek(0)
+        return audio
+
+class TeeReader:
+    """File-like reader that copies every byte read from src into tee, if given."""
+    def __init__(self, src, tee=None):
+        self.src = src
+        self.tee = tee
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        if data and self.tee is not None:
+            self.tee.write(data)
+        return data
+
+def stream_podcast(workspace, segments, artifacts, hashes, manifest):
+    """
+    Writes the podcast of segments in a single upload, copying every TTS response
+    into it, in order, while the next ones are already requested. Each response is
+    read whole before it is copied, so one whose body fails is requested again, and
+    the podcast only replaces the previous one once it is complete.
+    Segments up to date in the manifest or found in TTS_CACHE are read from storage.
+    With PRODUCE_TEE_SEGMENTS, rendered segments are also saved to their own files.
+    Returns the podcast file.
+    """
+    fs = get_filesystem()
+    podcast = f'{workspace}/podcast.mp3'
+    to_render = []
+    for i, (voice, text, output_file) in enumerate(segments):
+        if manifest.lookup(artifacts[i], hashes[i]):
+            continue
+        if TTS_CACHE_ENABLED and TTS_CACHE.get_file(tts_cache_key(voice, text), output_file):
+            manifest.record(artifacts[i], hashes[i], output_file)
+            continue
+        to_render.append(i)
+    logging.info(f"Streaming {len(to_render)} of {len(segments)} audio segments")
+
+    order = [("segment", 0), ("asset", SINTONIA_AUDIO)]
+    order += [("segment", i) for i in range(1, len(segments) - 1)]
+    order += [("asset", SINTONIA_AUDIO), ("segment", len(segments) - 1)]
+    bytes_moved = 0
+    with ThreadPoolExecutor(max_workers=max(1, TTS_STREAM_PREFETCH)) as executor, \
+         replacing_upload(podcast) as destiny_file:
+        queued = deque(to_render)
+        streams = {}
+
+        def prefetch():
+            while queued and len(streams) < max(1, TTS_STREAM_PREFETCH):
+                i = queued.popleft()
+                voice, text, _ = segments[i]
+                streams[i] = executor.submit(in_current_context(fetch_tts_audio), voice, text)
+
+        prefetch()
+        for kind, item in order:
+            if kind == "asset":
+                bytes_moved += copy_mp3(BytesIO(read_audio_asset(item)), destiny_file)
+                continue
+            voice, text, output_file = segments[item]
+            if item not in streams:
+                with fs.open(output_file, 'rb', block_size=AUDIO_BLOCK_SIZE) as audio_file:
+                    written = copy_mp3(audio_file, destiny_file)
+                bytes_moved += 2 * written
+                continue
+            audio = streams.pop(item).result()
+            prefetch()
+            with audio:
+                if PRODUCE_TEE_SEGMENTS:
+                    with fs.open(output_file, 'wb', block_size=UPLOAD_BLOCK_SIZE) as segment_file:
+                        reader = TeeReader(audio, segment_file)
+                        written = copy_mp3(reader, destiny_file)
+                else:
+                    written = copy_mp3(audio, destiny_file)
+            bytes_moved += (3 if PRODUCE_TEE_SEGMENTS else 2) * written
+            if PRODUCE_TEE_SEGMENTS:
+                manifest.record(artifacts[item], hashes[item], output_file)
+                if TTS_CACHE_ENABLED:
+                    TTS_CACHE.put_file(tts_cache_key(voice, text), output_file)
+    logging.info(f"Podcast streamed to {podcast}, about {bytes_moved} bytes moved")
+    current_span().set(bytes=bytes_moved)
+    return podcast
+
+@traced("stage.podcast")
+def generate_podcast(workspace, introduction=None, sections=None, closure=None, manifest=None):
+    fs = get_filesystem()
     if not introduction:
         introduction = read_file(f'{workspace}/introduction.txt')
     if not sections:
-        section_files = fs.glob(f'{workspace}/sections/')
+        section_files = fs.glob(f'{workspace}/sections/*')
         sections = [read_file(file) for file in section_files]
     if not closure:
         closure = read_file(f'{workspace}/closure.txt')
 
-    def generate_audio(voice, text, output_file):
-        fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-        logging.info(f"Generating audio: {text}. With voice: {voice}")
-        #audio = generate(text=text, voice=voice, verify=False)
-        CHUNK_SIZE = 1024
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice}"
-
-        headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": ELEVENLABS_API_KEY
-        }
-
-        data = {
-            "text": text,
-            "model_id": "eleven_monolingual_v1",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.5
-            }
-        }
+    segments = [(VOICE_INTRODUCTION, introduction, f'{workspace}/introduction.mp3')]
+    segments += [(VOICE_SECTION, section, f'{workspace}/mp3_sections/section{i}.mp3')
+                 for i, section in enumerate(sections, start=1)]
+    segments += [(VOICE_CLOSURE, closure, f'{workspace}/closure.mp3')]
+    if manifest is None:
+        manifest = WorkspaceManifest(workspace)
 
-        response = requests.post(url, json=data, headers=headers, verify=False)
-        logging.info("Saving audio")
-        with fs.open(output_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-        return output_file  
-    
-    def combine_audios(audio_files, destiny_name):
-        fs = gcsfs.GCSFileSystem(project=PROJECT_ID)
-        combined_audio = b''
-        for file in audio_files:
-            with fs.open(file, 'rb') as audio_file:
-                combined_audio += audio_file.read()
+    # Only segments whose voice or text changed are rendered again
+    artifacts = [output_file[len(workspace) + 1:] for _, _, output_file in segments]
+    hashes = [content_hash(voice, text, TTS_MODEL_ID, TTS_VOICE_SETTINGS) for voice, text, _ in segments]
+    podcast = f'{workspace}/podcast.mp3'
+    podcast_hash = content_hash(hashes, SINTONIA_AUDIO)
+    if manifest.lookup("podcast", podcast_hash):
+        logging.info("Reusing podcast")
+        return podcast
+    with manifest:
+        if PRODUCE_MODE == "stream":
+            podcast = stream_podcast(workspace, segments, artifacts, hashes, manifest)
+        else:
+            podcast = _render_and_combine(workspace, segments, artifacts, hashes, manifest)
+        manifest.record("podcast", podcast_hash, podcast)
+    return podcast
 
-        with fs.open(destiny_name, 'wb') as destiny_file:
-            destiny_file.write(combined_audio)
-        return destiny_name
-    
-    introduction_audio = generate_audio(VOICE_INTRODUCTION, introduction, f'{workspace}/introduction.mp3')
-    section_audios = []
-    i = 0
-    for section in sections:
-        i += 1
-        section_audio = generate_audio(VOICE_SECTION, section, f'{workspace}/mp3_sections/section{i}.mp3')
-        section_audios += [section_audio]
-    closure_audio = generate_audio(VOICE_CLOSURE, closure, f'{workspace}/closure.mp3')
+def _render_and_combine(workspace, segments, artifacts, hashes, manifest):
+    """Renders the outdated segments to their own files and then combines them all."""
+    pending = [i for i in range(len(segments)) if not manifest.lookup(artifacts[i], hashes[i])]
+    logging.info(f"Rendering {len(pending)} of {len(segments)} audio segments")
+    generate_audios([segments[i] for i in pending],
+                    on_rendered=lambda j: manifest.record(artifacts[pending[j]], hashes[pending[j]], segments[pending[j]][2]))
+    rendered = [output_file for _, _, output_file in segments]
+    introduction_audio, section_audios, closure_audio = rendered[0], rendered[1:-1], rendered[-1]
     audios = [introduction_audio]
     audios += [SINTONIA_AUDIO]
     audios += section_audios
     audios += [SINTONIA_AUDIO]
     audios += [closure_audio]
     logging.info("Combining audios")
-    podcast = combine_audios(audios, f'{workspace}/podcast.mp3')
-    return podcast
+    return combine_audios(audios, f'{workspace}/podcast.mp3')
+
+class EventDeadline:
+    """
+    Time left to the current invocation, used to decide if another stage still fits in it.
+    """
+    def __init__(self, budget=None):
+        self.budget = EVENT_TIME_BUDGET if budget is None else budget
+        self.started = time.monotonic()
 
-def _export_spodkast(author, spodkast_id, payload):
+    def remaining(self):
+        return self.budget - (time.monotonic() - self.started)
+
+    def allows(self, operation):
+        return self.remaining() >= FUSED_STAGE_SECONDS[operation]
+
+def event_workspace(author, spodkast_id, payload):
+    """Returns the workspace of an event, the way its operation finds it."""
+    if author == "#spokeAgent#":
+        author = payload["conversationId"].split(".")[0]
+    user = payload["user"] if payload.get("user", "undefined") != "undefined" else author
+    return SPODKAST_ROUTE.format(owner=user, id=spodkast_id)
+
+def _hand_over(operation, author, spodkast_id, payload, deadline=None, artifacts=None):
+    """
+    This function runs the next operation of a slow=0 request. It runs in this invocation,
+    reusing the artifacts held in memory, while the deadline leaves time for it, and is
+    published to the event bus otherwise.
+    Parameters:
+        operation: Next operation
+        author: Author of the request
+        spodkast_id: Id of the podcast
+        payload: Payload of the next operation
+        deadline: EventDeadline of the invocation, None to always publish
+        artifacts: Artifacts generated so far, as keyword arguments of the next operation
+    """
+    if FUSED_PIPELINE and deadline is not None and deadline.allows(operation):
+        logging.info(f"Running {operation} in this invocation, {deadline.remaining():.0f}s left")
+        with trace_span(f"operation.{operation}", entity_id=spodkast_id, fused=True):
+            OPERATIONS[operation](author, spodkast_id, payload, deadline=deadline, artifacts=artifacts)
+    else:
+        publish_message(author=author, operation=operation, entity_id=spodkast_id, payload=json.dumps(payload))
+
+def _export_spodkast(author, spodkast_id, payload, deadline=None, artifacts=None):
     logging.info(f"Received request from {author} to export podcast {spodkast_id}: {payload}")
     if author == "#spokeAgent":
         author = payload["conversationId"].split('.')[0]
     user = payload["user"] if payload["user"]!="undefined" else author
     assigned_folder = SPODKAST_ROUTE.format(owner=user, id=spodkast_id)
     export_route = EXPORT_ROUTE.format(owner=user, id=spodkast_id)
-    destiny_folder = "gs://"+export_route
+    destiny_folder = EXPORT_FOLDER.format(owner=user, id=spodkast_id)
     mail = read_file(f"{assigned_folder}/mail.txt")
-    podcast = read_bytes(f"{assigned_folder}/podcast.mp3")
-    write_bytes(f"{destiny_folder}/podcast.mp3", podcast)
+    # Copied server side, or streamed by blocks, so the episode is never loaded in memory
+    copy_file(f"{assigned_folder}/podcast.mp3", f"{destiny_folder}/podcast.mp3")
     message = f"""#c#send-mail#|#author={USER}#|#body=Your podcast have been produced, you can download it using this link: https://storage.googleapis.com/{export_route}/podcast.mp3#|#to={mail}#|#subject=Produced podcast from your PDF#|#from=PDFtoPodcast#c#"""
     messagePayload = json.dumps({
         'author': USER,
@@ -370,7 +1569,7 @@ def _export_spodkast(author, spodkast_id, payload):
 
 
 
-def _produce_spodkast(author, spodkast_id, payload):
+def _produce_spodkast(author, spodkast_id, payload, deadline=None, artifacts=None):
     logging.info(f"Received request from {author} to produce podcast {spodkast_id}: {payload}")
     if author == "#spokeAgent#":
         author = payload["conversationId"].split(".")[0]
@@ -379,42 +1578,81 @@ def _produce_spodkast(author, spodkast_id, payload):
     
     # Generate podcast
     logging.info("Generating podcast")
-    generate_podcast(assigned_folder)
-    publish_message(author=author, operation="export", entity_id=spodkast_id, payload=json.dumps(payload))
+    generate_podcast(assigned_folder, **(artifacts or {}))
+    _hand_over("export", author, spodkast_id, payload, deadline=deadline)
 
-def _extend_spodkast(author, spodkast_id, payload):
+def _extend_spodkast(author, spodkast_id, payload, deadline=None, artifacts=None):
     logging.info(f"Received request from {author} to extend sections for {spodkast_id}:{payload}")
     if author == "#spokeAgent#":
         author = payload["conversationId"].split(".")[0]
     user = payload["user"] if payload["user"]!="undefined" else author
     assigned_folder = SPODKAST_ROUTE.format(owner=user, id=spodkast_id)
+    artifacts = artifacts or {}
     
     # Generate sections
     logging.info("Extending sections")
-    generate_sections(assigned_folder)
+    sections = artifacts.get("full_sections")
+    if sections is None:
+        sections = generate_sections(assigned_folder, sections=artifacts.get("sections"),
+                                     requirements=artifacts.get("requirements"), manifest=artifacts.get("manifest"))
 
     if payload["slow"]=="0":
-        publish_message(author=author, operation="produce", entity_id=spodkast_id, payload=json.dumps(payload))
+        _hand_over("produce", author, spodkast_id, payload, deadline=deadline,
+                   artifacts={"introduction": artifacts.get("introduction"), "sections": sections,
+                              "closure": artifacts.get("closure"), "manifest": artifacts.get("manifest")})
 
-def _create_spodkast(author, spodkast_id, payload):
+def _create_spodkast(author, spodkast_id, payload, deadline=None, artifacts=None):
     logging.info(f"Received request from {author} to extend sections for {spodkast_id}:{payload}")
     if author == "#spokeAgent#":
         author = payload["conversationId"].split(".")[0]
     user = payload["user"] if payload["user"]!="undefined" else author
     assigned_folder = SPODKAST_ROUTE.format(owner=user, id=spodkast_id)
+    manifest = WorkspaceManifest(assigned_folder)
+    input_files = None
+    if payload.get("asyncDownload", "0") == "1":
+        # The action answered before downloading, so the files are fetched here
+        urls = [file.strip() for file in payload["inputFiles"].split(',') if file.strip()!='']
+        downloaded = []
+        progress_lock = threading.Lock()
+        def on_downloaded(saved_file):
+            with progress_lock:
+                downloaded.append(saved_file)
+                # Every download but the last one may be skipped, if the previous update is recent
+                report_progress(assigned_folder, "downloading", throttle=len(downloaded) < len(urls),
+                                downloaded=len(downloaded), total=len(urls))
+        report_progress(assigned_folder, "downloading", downloaded=0, total=len(urls))
+        try:
+            input_files = download_files(urls, f"{assigned_folder}/input_files", on_downloaded=on_downloaded)
+        except ValueError as e:
+            # Oversized inputs will not fit on a retry either
+            logging.error(f"Could not download input files: {e}")
+            report_progress(assigned_folder, "failed", error=str(e))
+            return
+        except Exception as e:
+            report_progress(assigned_folder, "failed", error=str(e))
+            raise
     # Process input files
     logging.info("Summarizing")
-    summaries = process_input_files(assigned_folder)
+    report_progress(assigned_folder, "summarizing")
+    summaries = process_input_files(assigned_folder, input_files=input_files, manifest=manifest)
 
     # Generate podcast skeleton
     logging.info("Generating skeleton")
-    generate_skeleton(assigned_folder, summaries=summaries)
+    report_progress(assigned_folder, "planning")
+    requirements = read_file(f'{assigned_folder}/requirements.txt')
+    # Without stops in between, the sections are written together with the introduction and the closure,
+    # and with PIPELINED_SPEECH they are spoken as they are written
+    texts = generate_texts(assigned_folder, requirements=requirements, summaries=summaries, manifest=manifest,
+                           with_sections=payload["slow"]=="0", speak=payload["slow"]=="0" and PIPELINED_SPEECH)
+    report_progress(assigned_folder, "planned")
 
     if payload["slow"]=="0":
         if author == "#spokeAgent#":
             author = payload["conversationId"].split(".")[0]
-        publish_message(operation="extend", author = author, entity_id = spodkast_id, 
-                      payload = json.dumps({'user': payload["user"], "slow": "0"}))
+        _hand_over("extend", author, spodkast_id, {'user': payload["user"], "slow": "0"}, deadline=deadline,
+                   artifacts={"sections": texts["sections"], "full_sections": texts["full_sections"],
+                              "requirements": requirements, "introduction": texts["introduction"],
+                              "closure": texts["closure"], "manifest": manifest})
 
 # Cloud function triggered from a message on a Cloud Pub/Sub topic
 @functions_framework.cloud_event
@@ -423,21 +1661,92 @@ def spodkast_event_manager(cloud_event):
     Cloud function triggered from a message on a Cloud Pub/Sub topic
     """
     logging.info("Event received")
+    deadline = EventDeadline()
     event = json.loads(base64.b64decode(cloud_event.data["message"]["data"]).decode())
-    if event['entity']==ENTITY:
-        if event['operation']=="create":
-            _create_spodkast(event['author'],
-                             spodkast_id=event['entityId'],
-                             payload=json.loads(event['payload']))
-        elif event['operation']=="extend":
-            _extend_spodkast(event['author'],
-                             event['entityId'],
-                             payload=json.loads(event['payload']))
-        elif event['operation']=="produce":
-            _produce_spodkast(event["author"],
-                              event['entityId'],
-                              payload=json.loads(event['payload']))
-        elif event['operation']=="export":
-            _export_spodkast(event["author"],
-                              event["entityId"],
-                              payload=json.loads(event['payload'])) 
\ No newline at end of file
+    message_id = cloud_event.data["message"].get("messageId")
+    age = event_age(cloud_event.data["message"].get("publishTime"))
+    if age > EVENT_MAX_AGE:
+        logging.error(f"Dropping {event.get('operation')} of {event.get('entityId')}, published {age:.0f}s ago, "
+                      f"after failing every delivery for {EVENT_MAX_AGE}s")
+        return
+    profiler = start_profiler()
+    try:
+        _dispatch_event(event, deadline=deadline, message_id=message_id)
+    finally:
+        if profiler is not None:
+            report_profiler(profiler)
+        logging.info(f"LLM cache stats: {LLM_CACHE.stats()}")
+        logging.info(f"TTS cache stats: {TTS_CACHE.stats()}")
+        report_peak_memory()
+        export_spans()
+
+def event_age(publish_time):
+    """Returns the seconds since an RFC 3339 Pub/Sub publishTime, or 0 if there is none."""
+    if not publish_time:
+        return 0.0
+    # Python 3.10 only parses fractions of 3 or 6 digits, publish times may have up to 9
+    publish_time = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), publish_time)
+    try:
+        published = datetime.datetime.fromisoformat(publish_time.replace("Z", "+00:00"))
+    except ValueError:
+        logging.warning(f"Unreadable publishTime {publish_time}")
+        return 0.0
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=datetime.timezone.utc)
+    return (datetime.datetime.now(datetime.timezone.utc) - published).total_seconds()
+
+def report_peak_memory():
+    """Logs the peak memory of the instance and its worker processes, warning when it exceeds MEMORY_TARGET_MB."""
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    if MEMORY_TARGET_MB and peak + workers > MEMORY_TARGET_MB:
+        logging.warning(f"Peak memory {peak:.0f} MiB (+{workers:.0f} MiB in workers) exceeds the {MEMORY_TARGET_MB} MiB target")
+    else:
+        logging.info(f"Peak memory {peak:.0f} MiB (+{workers:.0f} MiB in workers)")
+
+OPERATIONS = {
+    "create": _create_spodkast,
+    "extend": _extend_spodkast,
+    "produce": _produce_spodkast,
+    "export": _export_spodkast,
+}
+
+def _dispatch_event(event, deadline=None, message_id=None):
+    """
+    This function runs the operation of event. With IDEMPOTENCY_ENABLED, it runs while holding
+    the lease of the workspace, and is skipped if the event ledger of the workspace already has it,
+    or if another delivery of the same event is handling it. Events without a requestId or
+    message_id can't be told apart, and always run.
+    """
+    if event['entity']!=ENTITY or event['operation'] not in OPERATIONS:
+        return
+    payload = json.loads(event['payload'])
+    operation = OPERATIONS[event['operation']]
+    with trace_span(f"operation.{event['operation']}", entity_id=event['entityId'], fused=False,
+                    message_id=message_id) as span:
+        key = event_key(event, message_id)
+        if not IDEMPOTENCY_ENABLED or key is None:
+            operation(event['author'], event['entityId'], payload=payload, deadline=deadline)
+            return
+        workspace = event_workspace(event['author'], event['entityId'], payload)
+        ledger = EventLedger(workspace)
+        if ledger.lookup(key):
+            logging.info(f"Skipping {event['operation']} of {event['entityId']}, event {key} was already handled")
+            span.set(duplicate=True)
+            return
+        lease = WorkspaceLease(workspace, key)
+        if not lease.acquire():
+            logging.info(f"Skipping {event['operation']} of {event['entityId']}, event {key} is being handled")
+            span.set(duplicate=True)
+            return
+        try:
+            # Another delivery may have finished the event while this one waited for the lease
+            if ledger.lookup(key):
+                logging.info(f"Skipping {event['operation']} of {event['entityId']}, event {key} was already handled")
+                span.set(duplicate=True)
+                return
+            operation(event['author'], event['entityId'], payload=payload, deadline=deadline)
+            ledger.record(key, event, message_id)
+        finally:
+            lease.release()
@@ -0,0 +1,200 @@
+"""Client-side rate limits of the OpenAI models and TTS voices, and retries of their requests."""
+import os
+import logging
+import time
+import random
+import email.utils
+import datetime
+import threading
+from clients import _get_client
+from tracing import current_span
+
+# Maximum number of concurrent text-to-speech requests per voice
+TTS_VOICE_CONCURRENCY = int(os.environ.get('TTS_VOICE_CONCURRENCY', 2))
+# Client-side quotas of every OpenAI model and every TTS voice, 0 for no limit
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 0))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get('LLM_TOKENS_PER_MINUTE', 0))
+TTS_REQUESTS_PER_MINUTE = int(os.environ.get('TTS_REQUESTS_PER_MINUTE', 0))
+TTS_CHARACTERS_PER_MINUTE = int(os.environ.get('TTS_CHARACTERS_PER_MINUTE', 0))
+# Maximum number of concurrent requests per OpenAI model
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 16))
+# Failed requests wait a random time up to BACKOFF_BASE * 2**attempt seconds, capped at BACKOFF_MAX
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE', 1.0))
+BACKOFF_MAX = float(os.environ.get('BACKOFF_MAX', 60.0))
+
+class TokenBucket:
+    """
+    Allows per_minute units a minute, refilled continuously. A per_minute of 0 never waits.
+    It is not thread safe, RateLimiter guards it.
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """Returns the seconds until amount units are available."""
+        if not self.capacity:
+            return 0.0
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        # Larger requests than the whole bucket still go through once it is full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) * 60 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity:
+            self.available -= amount
+
+class RateLimiter:
+    """
+    Client-side limits of one API resource, like an OpenAI model or a TTS voice.
+    Requests and tokens per minute are token buckets, and the requests in flight are capped
+    by a concurrency that halves on rate limit responses and grows back by one request
+    every concurrency successes.
+    """
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_concurrency=1):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, tokens=0):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = max(self.paused_until - now,
+                           self.requests.wait_time(1, now),
+                           self.tokens.wait_time(tokens, now))
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self.in_flight += 1
+                    return
+                # Released slots notify, refills and pauses are waited for
+                self._condition.wait(wait if wait > 0 else None)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def consume(self, tokens):
+        """Charges tokens used beyond the estimate given to acquire, or refunds them if negative."""
+        with self._condition:
+            self.tokens.take(tokens)
+
+    def succeeded(self):
+        with self._condition:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def throttled(self, retry_after=None):
+        """
+        Halves the concurrency and pauses every request for retry_after seconds.
+        The rate limit responses of requests sent together only halve it once.
+        """
+        with self._condition:
+            now = time.monotonic()
+            if now - self.decreased_at >= BACKOFF_BASE:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.decreased_at = now
+                logging.warning(f"{self.name} is rate limited, lowering its concurrency to {int(self.concurrency)}")
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+def get_rate_limiter(kind, key):
+    """
+    This function returns the shared RateLimiter of an OpenAI model or a TTS voice.
+    Parameters:
+        kind: "llm" or "tts"
+        key: The model or the voice
+    """
+    def factory():
+        if kind == "llm":
+            return RateLimiter(f"llm:{key}", LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY)
+        return RateLimiter(f"tts:{key}", TTS_REQUESTS_PER_MINUTE, TTS_CHARACTERS_PER_MINUTE, TTS_VOICE_CONCURRENCY)
+    return _get_client(f"rate_limiter:{kind}:{key}", factory)
+
+def _error_status(error):
+    """Returns the HTTP status of a requests or openai error, None for network errors."""
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    return status
+
+def retry_after(error):
+    """Returns the seconds the server asked to wait before retrying, or None."""
+    headers = getattr(error, "headers", None)
+    response = getattr(error, "response", None)
+    if not headers and response is not None:
+        headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms") or headers.get("Retry-After-Ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+def backoff_delay(attempt, wait=None):
+    """
+    Returns the seconds to sleep before retrying attempt: the wait asked by the server
+    plus some jitter, or a random time up to BACKOFF_BASE * 2**attempt.
+    """
+    if wait is not None:
+        return wait + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def call_with_retries(limiter, request, tokens=0, max_attempts=1):
+    """
+    This function runs request under limiter and returns its result, retrying transient
+    failures with exponential backoff and jitter. Rate limit responses also lower the
+    concurrency of limiter and pause it for the Retry-After the server asked for.
+    Parameters:
+        limiter: RateLimiter of the resource called
+        request: Function making the request, called without arguments
+        tokens: Tokens or characters used by the request
+        max_attempts: Attempts before the last error is raised
+    """
+    span = current_span()
+    for attempt in range(max_attempts):
+        limiter.acquire(tokens)
+        try:
+            result = request()
+        except Exception as e:
+            limiter.release()
+            status = _error_status(e)
+            wait = retry_after(e)
+            if status == 429:
+                limiter.throttled(wait)
+                span.add("throttled", 1)
+            transient = status is None or status in (408, 409, 429) or status >= 500
+            if attempt + 1 >= max_attempts or not transient:
+                raise
+            delay = backoff_delay(attempt, wait)
+            span.add("retries", 1)
+            logging.warning(f"{limiter.name} request failed ({status or type(e).__name__}), retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+        else:
+            limiter.release()
+            limiter.succeeded()
+            return result
@@ -0,0 +1,358 @@
+"""Files of the workspaces, the downloads of input files and the store of input documents."""
+import os
+import logging
+import json
+import hashlib
+import time
+import secrets
+import datetime
+import threading
+from clients import get_filesystem, get_http_session, path_protocol
+from tracing import current_span, traced
+
+# Size of the ranges read from input PDFs while extracting their text
+PDF_BLOCK_SIZE = int(os.environ.get('PDF_BLOCK_SIZE', 1024 * 1024))
+# Size of the blocks copied while concatenating audio files
+AUDIO_BLOCK_SIZE = int(os.environ.get('AUDIO_BLOCK_SIZE', 1024 * 1024))
+# Size of the blocks streamed while downloading input files
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+# Largest input file accepted, and largest total accepted per request
+MAX_INPUT_FILE_BYTES = int(os.environ.get('MAX_INPUT_FILE_BYTES', 64 * 1024 * 1024))
+MAX_INPUT_BYTES = int(os.environ.get('MAX_INPUT_BYTES', 256 * 1024 * 1024))
+# Documents no workspace linked in DOCUMENT_TTL seconds are deleted by the scheduled prune of backfill.py
+DOCUMENT_TTL = int(os.environ.get('DOCUMENT_TTL', 90 * 24 * 3600))
+DOCUMENT_FILE = "document.pdf"
+DOCUMENT_LINK_SUFFIX = ".link"
+# Separates the pages of stored and spilled texts
+PAGE_SEPARATOR = "\x1e"
+
+def modified_time(fs, info):
+    """
+    Returns the modification time, in seconds, of a file listed by fs.ls or fs.find with detail,
+    from the listing itself when it has it, so listed files don't need a request each.
+    """
+    # Local files have mtime, GCS objects updated and memory files created
+    for key in ("mtime", "updated", "created"):
+        value = info.get(key)
+        if isinstance(value, datetime.datetime):
+            return value.timestamp()
+        if isinstance(value, str):
+            return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        if value is not None:
+            return float(value)
+    return fs.modified(info["name"]).timestamp()
+
+@traced("storage.copy")
+def copy_file(source, destination):
+    """
+    Copies source to destination, server side when both are in the same
+    filesystem and streaming by blocks otherwise.
+    """
+    current_span().set(source=source, destination=destination)
+    source_protocol = path_protocol(source)
+    destination_protocol = path_protocol(destination)
+    source_fs = get_filesystem(source_protocol)
+    if source_protocol == destination_protocol:
+        source_fs.copy(source, destination)
+        return destination
+    with source_fs.open(source, 'rb') as src, get_filesystem(destination_protocol).open(destination, 'wb') as dst:
+        for block in iter(lambda: src.read(AUDIO_BLOCK_SIZE), b''):
+            dst.write(block)
+            current_span().add("bytes", len(block))
+    return destination
+
+def content_hash(*parts):
+    """Returns the sha256 hex digest of the JSON serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+@traced("storage.read")
+def read_file(file):
+    fs = get_filesystem()
+    with fs.open(file, 'r') as f:
+        content = f.read()
+    current_span().set(path=file, bytes=len(content))
+    return content
+
+@traced("storage.read")
+def read_bytes(file):
+    fs = get_filesystem()
+    with fs.open(file, 'rb') as f:
+        content = f.read()
+    current_span().set(path=file, bytes=len(content))
+    return content
+
+@traced("storage.write")
+def write_to_file(file, content):
+    fs = get_filesystem()
+    with fs.open(file, "w") as file_:
+        file_.write(content)
+    current_span().set(path=file, bytes=len(content))
+
+@traced("storage.write")
+def write_bytes(file, content):
+    fs = get_filesystem()
+    with fs.open(file, mode='wb') as file_:
+        file_.write(content)
+    current_span().set(path=file, bytes=len(content))
+
+class ByteBudget:
+    """
+    Bytes left to download for one request, shared by its download threads.
+    """
+    def __init__(self, limit):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, size, source):
+        with self._lock:
+            if size > self.remaining:
+                raise ValueError(f"Input files exceed {MAX_INPUT_BYTES} bytes while downloading {source}")
+            self.remaining -= size
+
+@traced("http.download")
+def download_file(url, destiny_file, budget=None, max_bytes=None):
+    """
+    This function streams url into destiny_file, removing it if the download fails.
+    Parameters:
+        url: Url of the file
+        destiny_file: Where to save the file
+        budget: ByteBudget shared with the other files of the request
+        max_bytes: Largest size accepted, MAX_INPUT_FILE_BYTES by default
+    """
+    max_bytes = MAX_INPUT_FILE_BYTES if max_bytes is None else max_bytes
+    current_span().set(url=url, path=destiny_file)
+    fs = get_filesystem()
+    with get_http_session().get(url, stream=True) as r:
+        r.raise_for_status()
+        # Refuse oversized files before transferring anything
+        length = r.headers.get('Content-Length')
+        if length is not None and int(length) > max_bytes:
+            raise ValueError(f"{url} is larger than {max_bytes} bytes")
+        written = 0
+        try:
+            with fs.open(destiny_file, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"{url} is larger than {max_bytes} bytes")
+                    if budget is not None:
+                        budget.take(len(chunk), url)
+                    f.write(chunk)
+        except Exception:
+            if fs.exists(destiny_file):
+                fs.rm(destiny_file)
+            raise
+    current_span().set(bytes=written)
+    return destiny_file
+
+class DocumentStore:
+    """
+    Content-addressed store of input documents under route. Every document is kept once,
+    in {route}/{sha256}/document.pdf, next to the text extracted from it and its summaries,
+    so workspaces with the same document share them. Workspaces hold a small link file
+    instead of a copy, and every link leaves a reference in {route}/{sha256}/refs/.
+    Documents without references newer than ttl are deleted by prune.
+    """
+    def __init__(self, route, ttl=None):
+        self.route = route.rstrip('/')
+        self.ttl = DOCUMENT_TTL if ttl is None else ttl
+
+    def _filesystem(self):
+        return get_filesystem(path_protocol(self.route))
+
+    def path(self, digest, name=DOCUMENT_FILE):
+        return f"{self.route}/{digest}/{name}"
+
+    def _read_json(self, path):
+        try:
+            with self._filesystem().open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable {path}: {e}")
+            return None
+
+    def _write_json(self, path, content):
+        with self._filesystem().open(path, 'w') as f:
+            json.dump(content, f)
+
+    @traced("http.download")
+    def download(self, url, budget=None, max_bytes=None):
+        """
+        This function downloads url into the store, unless it already holds the same bytes,
+        and returns their sha256. The validators of the last download of url are sent,
+        so files that didn't change are not transferred again.
+        Parameters:
+            url: Url of the file
+            budget: ByteBudget shared with the other files of the request
+            max_bytes: Largest size accepted, MAX_INPUT_FILE_BYTES by default
+        """
+        max_bytes = MAX_INPUT_FILE_BYTES if max_bytes is None else max_bytes
+        span = current_span()
+        span.set(url=url, bytes=0, deduplicated=False)
+        fs = self._filesystem()
+        index_file = f"{self.route}/_urls/{hashlib.sha256(url.encode()).hexdigest()}.json"
+        known = self._read_json(index_file)
+        headers = {}
+        if known and fs.exists(self.path(known["sha256"])):
+            if known.get("etag"):
+                headers["If-None-Match"] = known["etag"]
+            if known.get("last_modified"):
+                headers["If-Modified-Since"] = known["last_modified"]
+        with get_http_session().get(url, stream=True, headers=headers) as r:
+            if r.status_code == 304 and headers:
+                span.set(deduplicated=True, not_modified=True)
+                return known["sha256"]
+            r.raise_for_status()
+            # Refuse oversized files before transferring anything
+            length = r.headers.get('Content-Length')
+            if length is not None and int(length) > max_bytes:
+                raise ValueError(f"{url} is larger than {max_bytes} bytes")
+            incoming = f"{self.route}/_incoming/{secrets.token_hex(16)}"
+            digest = hashlib.sha256()
+            written = 0
+            try:
+                with fs.open(incoming, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        written += len(chunk)
+                        if written > max_bytes:
+                            raise ValueError(f"{url} is larger than {max_bytes} bytes")
+                        if budget is not None:
+                            budget.take(len(chunk), url)
+                        digest.update(chunk)
+                        f.write(chunk)
+                sha256 = digest.hexdigest()
+                deduplicated = fs.exists(self.path(sha256))
+                if not deduplicated:
+                    fs.mv(incoming, self.path(sha256))
+            finally:
+                if fs.exists(incoming):
+                    fs.rm(incoming)
+            self._write_json(index_file, {"sha256": sha256, "etag": r.headers.get("ETag"),
+                                          "last_modified": r.headers.get("Last-Modified")})
+        span.set(bytes=written, deduplicated=deduplicated)
+        return sha256
+
+    def link(self, digest, file, url=None):
+        """
+        Writes the link to the document digest as file plus DOCUMENT_LINK_SUFFIX and
+        references the document from it. Returns the link file.
+        """
+        link_file = file + DOCUMENT_LINK_SUFFIX
+        write_to_file(link_file, json.dumps({"sha256": digest, "document": self.path(digest), "url": url}))
+        reference = hashlib.sha256(link_file.encode()).hexdigest()
+        with self._filesystem().open(self.path(digest, f"refs/{reference}"), 'w') as f:
+            f.write(link_file)
+        return link_file
+
+    @staticmethod
+    def resolve(file):
+        """
+        Returns the sha256, the file to read and the name of an input file.
+        Links resolve to the document they point to, other files have no sha256.
+        """
+        filename = file.split('/')[-1]
+        if not file.endswith(DOCUMENT_LINK_SUFFIX):
+            return None, file, filename
+        link = json.loads(read_file(file))
+        return link["sha256"], link["document"], filename[:-len(DOCUMENT_LINK_SUFFIX)]
+
+    def get_pages(self, digest):
+        """
+        Returns an iterator over the text of every page of the document, read from
+        the store as it goes, or None if the document was not extracted before.
+        """
+        path = self.path(digest, "pages.txt")
+        if not self._filesystem().exists(path):
+            return None
+        return self._read_pages(path)
+
+    def _read_pages(self, path):
+        with self._filesystem().open(path, 'r', block_size=PDF_BLOCK_SIZE) as f:
+            yield from iter_separated_pages(f)
+
+    def record_pages(self, digest, pages):
+        """
+        Yields pages while writing them to the store. The pages are only kept
+        if every one of them is read.
+        """
+        fs = self._filesystem()
+        path = self.path(digest, "pages.txt")
+        incoming = f"{self.route}/_incoming/{secrets.token_hex(16)}"
+        completed = False
+        try:
+            with fs.open(incoming, 'w') as f:
+                for page in pages:
+                    f.write(page.replace(PAGE_SEPARATOR, "") + PAGE_SEPARATOR)
+                    yield page
+            fs.mv(incoming, path)
+            completed = True
+        finally:
+            if not completed and fs.exists(incoming):
+                fs.rm(incoming)
+
+    def _summary_path(self, digest, settings):
+        return self.path(digest, f"summaries/{content_hash(settings)}.json")
+
+    def get_summary(self, digest, settings):
+        """
+        Returns the summary of the document made with the summarizer settings, if any,
+        as a dict with the summary and the llm_calls it took.
+        """
+        return self._read_json(self._summary_path(digest, settings))
+
+    def put_summary(self, digest, settings, summary, llm_calls):
+        self._write_json(self._summary_path(digest, settings), {"summary": summary, "llm_calls": llm_calls})
+
+    def prune(self):
+        """
+        Deletes the documents no link referenced in the last ttl seconds and the downloads
+        left unfinished, and returns the stats of the store: documents, references and the
+        dedup_ratio, the share of references served by an already stored document.
+        The whole store is listed once, so it runs from a scheduled job, not while handling events.
+        """
+        fs = self._filesystem()
+        now = time.time()
+        try:
+            root = fs._strip_protocol(self.route)
+            files, refs, stored, stale = {}, {}, {}, []
+            for path, info in fs.find(self.route, detail=True).items():
+                digest, _, name = path[len(root) + 1:].partition('/')
+                modified = modified_time(fs, info)
+                if digest == "_incoming":
+                    if now - modified > 24 * 3600:
+                        stale.append(path)
+                    continue
+                if digest.startswith("_"):
+                    continue
+                files.setdefault(digest, []).append(path)
+                if name.startswith("refs/"):
+                    refs.setdefault(digest, []).append(modified)
+                elif name == DOCUMENT_FILE:
+                    stored[digest] = modified
+            # Documents are referenced right after they are stored
+            expired = {digest for digest in files
+                       if now - (max(refs[digest]) if digest in refs else stored.get(digest, 0)) > self.ttl}
+            removed = stale + [path for digest in expired for path in files[digest]]
+            if removed:
+                fs.rm(removed)
+            documents = len(files) - len(expired)
+            references = sum(len(times) for digest, times in refs.items() if digest not in expired)
+            stats = {"documents": documents, "references": references, "deleted": len(expired),
+                     "dedup_ratio": round(1 - documents / references, 3) if references else 0.0}
+        except Exception as e:
+            logging.warning(f"Could not prune the document store: {e}")
+            return None
+        logging.info(f"Document store stats: {stats}")
+        return stats
+
+def iter_separated_pages(reader, block_size=None):
+    """Yields the pages of a text file-like reader whose pages end with PAGE_SEPARATOR."""
+    pending = ""
+    for block in iter(lambda: reader.read(block_size or PDF_BLOCK_SIZE), ""):
+        pages = (pending + block).split(PAGE_SEPARATOR)
+        pending = pages.pop()
+        yield from pages
+    if pending:
+        yield pending
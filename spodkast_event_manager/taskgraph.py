@@ -0,0 +1,46 @@
+"""Runs the tasks of a podcast as soon as the tasks they depend on have finished."""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tracing import in_current_context
+
+class TaskGraph:
+    """
+    Runs named tasks as soon as the tasks they depend on have finished, at most max_workers at a time.
+    Every task receives the results of its dependencies as positional arguments, in the order they were given.
+    Tasks may add new tasks to the graph while it runs, e.g. once the podcast plan tells how many sections there are.
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self._pending = {}
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def add(self, name, function, depends_on=()):
+        with self._lock:
+            if name in self._names:
+                raise ValueError(f"Task {name} is already in the graph")
+            self._names.add(name)
+            self._pending[name] = (function, tuple(depends_on))
+
+    def run(self):
+        """
+        Runs every task of the graph and returns a dict with the result of each one.
+        The first task that fails stops the graph and its exception is raised once the running tasks finish.
+        """
+        results = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self._lock:
+                    for name in [name for name, (_, depends_on) in self._pending.items()
+                                 if all(dependency in results for dependency in depends_on)]:
+                        function, depends_on = self._pending.pop(name)
+                        arguments = [results[dependency] for dependency in depends_on]
+                        running[executor.submit(in_current_context(function), *arguments)] = name
+                    if not running:
+                        if self._pending:
+                            raise ValueError(f"Tasks {sorted(self._pending)} depend on missing or circular tasks")
+                        return results
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
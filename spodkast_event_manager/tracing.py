@@ -0,0 +1,264 @@
+"""Spans timing the operations of every event, and the profilers of whole events."""
+import os
+import logging
+import json
+import time
+import sys
+import contextlib
+import contextvars
+import functools
+import secrets
+import cProfile
+import pstats
+import datetime
+import threading
+from collections import Counter
+from io import StringIO
+from clients import get_http_session
+
+# "json" logs every span as a JSON line, "otlp" exports every event as an OpenTelemetry
+# trace, posted to TRACE_OTLP_ENDPOINT when set and logged otherwise, "none" disables spans
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'json')
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT')
+TRACE_SERVICE_NAME = "spodkast-event-manager"
+# "cprofile" profiles the thread handling each event, "sampling" samples the stacks of every
+# thread each PROFILE_INTERVAL seconds, the PROFILE_TOP_ENTRIES heaviest entries are logged
+PROFILE_EVENTS = os.environ.get('PROFILE_EVENTS', 'none')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+PROFILE_TOP_ENTRIES = int(os.environ.get('PROFILE_TOP_ENTRIES', 30))
+
+class Span:
+    """
+    A timed operation of an event. Its attributes hold what it measured, like tokens,
+    bytes or retries, and can be updated from any thread.
+    """
+    def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def context(self):
+        return self.trace_id, self.span_id
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, name, value):
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def to_json(self):
+        return {
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": datetime.datetime.fromtimestamp(self.start / 1e9).isoformat(),
+            "duration_ms": round((self.end - self.start) / 1e6, 3),
+            "error": self.error,
+            **self.attributes,
+        }
+
+    def to_otlp(self):
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": k, "value": value(v)} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class _NoSpan:
+    """Stands for the span when tracing is disabled or no span is open."""
+    def context(self):
+        return None
+
+    @property
+    def attributes(self):
+        # Nothing is recorded, so a new dict keeps callers from sharing writes
+        return {}
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, value):
+        pass
+
+NO_SPAN = _NoSpan()
+_current_span = contextvars.ContextVar("current_span", default=None)
+_finished_spans = []
+_finished_spans_lock = threading.Lock()
+
+def current_span():
+    """Returns the span open in this context, or NO_SPAN."""
+    return _current_span.get() or NO_SPAN
+
+def start_span(name, parent=None, **attributes):
+    """
+    This function starts a span without making it current, for operations that
+    do not run in a single block, like generators.
+    Parameters:
+        name: Name of the span
+        parent: (trace_id, span_id) of the parent, the current span by default
+        attributes: Initial attributes of the span
+    """
+    if TRACE_EXPORTER == "none":
+        return NO_SPAN
+    if parent is None and _current_span.get() is not None:
+        parent = _current_span.get().context()
+    trace_id, parent_id = parent or (None, None)
+    return Span(name, trace_id, parent_id, attributes)
+
+def finish_span(span, error=None):
+    if span is NO_SPAN:
+        return
+    span.end = time.time_ns()
+    if error is not None:
+        span.error = repr(error)
+    with _finished_spans_lock:
+        _finished_spans.append(span)
+
+@contextlib.contextmanager
+def trace_span(name, parent=None, **attributes):
+    """
+    Times the enclosed block as a span, child of the span open in this context,
+    and yields it so the block can record attributes on it.
+    """
+    span = start_span(name, parent, **attributes)
+    if span is NO_SPAN:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        finish_span(span, e)
+        raise
+    else:
+        finish_span(span)
+    finally:
+        _current_span.reset(token)
+
+def traced(name):
+    """Decorator that runs every call of the function in a span called name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def in_current_context(function):
+    """
+    Wraps function to run in a copy of the calling context, so the spans opened
+    from executor threads are children of the span that submitted them.
+    """
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+def export_spans():
+    """
+    This function exports the spans finished since the last export with TRACE_EXPORTER.
+    """
+    with _finished_spans_lock:
+        spans = list(_finished_spans)
+        _finished_spans.clear()
+    if not spans:
+        return
+    if TRACE_EXPORTER == "json":
+        # Cloud Logging keeps every JSON line as a structured entry
+        for span in spans:
+            print(json.dumps(span.to_json(), default=str))
+    elif TRACE_EXPORTER == "otlp":
+        trace = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": TRACE_SERVICE_NAME},
+                            "spans": [span.to_otlp() for span in spans]}]
+        }]}
+        if TRACE_OTLP_ENDPOINT:
+            try:
+                get_http_session().post(TRACE_OTLP_ENDPOINT, json=trace, timeout=10).raise_for_status()
+            except Exception as e:
+                logging.warning(f"Could not export {len(spans)} spans: {e}")
+        else:
+            print(json.dumps(trace))
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread each interval, as cProfile only sees the thread
+    that enables it. Stacks are counted in the collapsed format of flame graphs.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval or PROFILE_INTERVAL
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def report(self, top):
+        return "\n".join(f"{count} {stack}" for stack, count in self.samples.most_common(top))
+
+def start_profiler():
+    """
+    Starts the profiler selected by PROFILE_EVENTS, returning None when profiling is off.
+    """
+    if PROFILE_EVENTS == "cprofile":
+        profiler = cProfile.Profile()
+    elif PROFILE_EVENTS == "sampling":
+        profiler = SamplingProfiler()
+    else:
+        return None
+    profiler.enable()
+    return profiler
+
+def report_profiler(profiler):
+    profiler.disable()
+    if isinstance(profiler, SamplingProfiler):
+        report = profiler.report(PROFILE_TOP_ENTRIES)
+    else:
+        output = StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+        report = output.getvalue()
+    logging.info(f"Event profile:\n{report}")
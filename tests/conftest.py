@@ -0,0 +1,49 @@
+"""
+Fixtures shared by the tests. Both functions run in this process against the fsspec memory
+filesystem, with tracing and the LLM and TTS caches off, so no test reaches GCP or an API.
+"""
+import importlib.util
+import os
+import sys
+
+import fsspec
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.update({
+    "FILESYSTEM_PROTOCOL": "memory",
+    "TRACE_EXPORTER": "none",
+    "LLM_CACHE_ENABLED": "0",
+    "TTS_CACHE_ENABLED": "0",
+    "INGESTION_PROCESSES": "1",
+    "SPODKAST_ROUTE": "memory://spodkast/{owner}/{id}",
+    "DOCUMENT_STORE_ROUTE": "memory://spodkast/_documents",
+    "LLM_CACHE_ROUTE": "memory://spodkast/_cache/llm",
+    "TTS_CACHE_ROUTE": "memory://spodkast/_cache/tts",
+})
+sys.path.insert(0, os.path.join(ROOT, "spodkast_event_manager"))
+# benchmark.py builds the PDFs used by the tests
+sys.path.append(ROOT)
+
+@pytest.fixture(scope="session")
+def event_manager():
+    import main
+    return main
+
+@pytest.fixture(scope="session")
+def actions():
+    spec = importlib.util.spec_from_file_location("actions_spodkast_main",
+                                                  os.path.join(ROOT, "actions_spodkast", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(autouse=True)
+def memory_filesystem():
+    """Empties the memory filesystem after every test and returns it."""
+    fs = fsspec.filesystem("memory")
+    yield fs
+    fs.store.clear()
+    fs.pseudo_dirs.clear()
+    fs.pseudo_dirs.append("")
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+from werkzeug.test import Client
+
+CREATE = {"author": "owner", "name": "podcast", "notificationMail": "owner@example.com",
+          "inputFiles": "https://example.com/a.pdf"}
+
+@pytest.fixture
+def schema(actions):
+    return actions.ROUTES["/create"][1]
+
+def test_parse_fills_defaults(schema):
+    payload = schema.parse(json.dumps(CREATE))
+
+    assert payload == {**CREATE, "user": "undefined", "slow": "0", "requirements": "undefined",
+                       "asyncDownload": "0"}
+
+@pytest.mark.parametrize("body, error", [
+    ("{", "Invalid JSON body"),
+    (b"\xff", "Invalid JSON body"),
+    ("[]", "The body must be a JSON object"),
+    (json.dumps({"author": "owner", "name": "podcast"}), "Missing arguments: notificationMail, inputFiles"),
+    (json.dumps({**CREATE, "slow": 0}), "slow must be a string"),
+    (json.dumps({**CREATE, "name": None}), "name must be a string"),
+])
+def test_parse_rejects_invalid_bodies(actions, schema, body, error):
+    with pytest.raises(actions.InvalidRequest, match=error):
+        schema.parse(body)
+
+def test_every_action_requires_author_and_name(actions):
+    for path, (_, schema) in actions.ROUTES.items():
+        with pytest.raises(actions.InvalidRequest, match="Missing arguments: author, name"):
+            schema.parse("{}")
+
+@pytest.mark.parametrize("input_files", ["", " , ", "undefined"])
+def test_create_without_input_files_is_refused(actions, monkeypatch, input_files):
+    monkeypatch.setattr(actions, "SPODKAST_ROUTE", "memory://spodkast/{owner}/{id}")
+    body = {**CREATE, "requirements": "A short podcast", "inputFiles": input_files}
+
+    response = Client(actions.application).post("/create", data=json.dumps(body))
+
+    assert response.status_code == 400
+    assert json.loads(response.get_data()) == {"payload": {"error": "No input files"},
+                                               "responseMessage": "ERROR: No input files"}
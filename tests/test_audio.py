@@ -0,0 +1,49 @@
+from io import BytesIO
+
+import pytest
+
+# MPEG-1 Layer III frame at 128 kbps and 44.1 kHz, 417 bytes long
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])
+FRAME_LENGTH = 417
+
+def audio_frame(fill):
+    return FRAME_HEADER + bytes([fill]) * (FRAME_LENGTH - len(FRAME_HEADER))
+
+def info_frame(tag=b"Info"):
+    # The tag follows the 32 bytes of side information of a stereo MPEG-1 frame
+    return (FRAME_HEADER + bytes(32) + tag).ljust(FRAME_LENGTH, b"\x00")
+
+def id3v2_tag(size, footer=False):
+    flags = 0x10 if footer else 0x00
+    header = b"ID3" + bytes([4, 0, flags]) + bytes([(size >> shift) & 0x7F for shift in (21, 14, 7, 0)])
+    return header + b"\x01" * size + (b"3DI" + bytes(7) if footer else b"")
+
+ID3V1_TAG = b"TAG" + b"\x02" * 125
+AUDIO = b"".join(audio_frame(i) for i in range(1, 4))
+
+def copy(event_manager, data, block_size):
+    output = BytesIO()
+    written = event_manager.copy_mp3(BytesIO(data), output, block_size=block_size)
+    assert written == len(output.getvalue())
+    return output.getvalue()
+
+@pytest.mark.parametrize("block_size", [7, FRAME_LENGTH, 1024 * 1024])
+def test_copy_mp3_strips_tags_and_info_frame(event_manager, block_size):
+    tagged = id3v2_tag(300) + info_frame() + AUDIO + ID3V1_TAG
+
+    assert copy(event_manager, tagged, block_size) == AUDIO
+
+@pytest.mark.parametrize("tag", [b"Xing", b"Info"])
+def test_copy_mp3_strips_xing_and_info_frames(event_manager, tag):
+    assert copy(event_manager, info_frame(tag) + AUDIO, 64) == AUDIO
+
+def test_copy_mp3_skips_id3v2_footer(event_manager):
+    assert copy(event_manager, id3v2_tag(50, footer=True) + AUDIO, 64) == AUDIO
+
+@pytest.mark.parametrize("block_size", [7, 1024 * 1024])
+def test_copy_mp3_keeps_plain_audio(event_manager, block_size):
+    assert copy(event_manager, AUDIO, block_size) == AUDIO
+
+def test_copy_mp3_keeps_short_streams(event_manager):
+    # Shorter than an ID3v1 tag, so the held back tail is all of it
+    assert copy(event_manager, AUDIO[:100], 16) == AUDIO[:100]
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from cache import TieredCache
+
+ROUTE = "memory://spodkast/_cache/test"
+
+def test_memory_tier_evicts_least_recently_used(memory_filesystem):
+    cache = TieredCache("test", ROUTE, max_entries=2, ttl=60)
+    cache.put("a", b"1", persist=False)
+    cache.put("b", b"2", persist=False)
+    assert cache.get("a", persistent=False) == b"1"
+
+    cache.put("c", b"3", persist=False)
+
+    assert cache.get("b", persistent=False) is None
+    assert cache.get("a", persistent=False) == b"1"
+    assert cache.get("c", persistent=False) == b"3"
+    assert cache.stats()["evictions"] == 1
+    assert not memory_filesystem.exists(ROUTE)
+
+def test_memory_tier_evicts_over_max_bytes():
+    cache = TieredCache("test", ROUTE, max_entries=10, ttl=60, max_bytes=10)
+    cache.put("a", b"x" * 6, persist=False)
+    cache.put("b", b"y" * 6, persist=False)
+
+    assert cache.get("a", persistent=False) is None
+    assert cache.get("b", persistent=False) == b"y" * 6
+
+def test_evicted_entries_are_read_from_persistent_tier():
+    cache = TieredCache("test", ROUTE, max_entries=1, ttl=60)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+
+    assert cache.get("a") == b"1"
+    stats = cache.stats()
+    assert (stats["persistent_hits"], stats["misses"]) == (1, 0)
+
+def test_expired_entries_are_misses(monkeypatch):
+    cache = TieredCache("test", ROUTE, max_entries=10, ttl=60)
+    cache.put("a", b"1")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+def test_prune_deletes_expired_entries(memory_filesystem):
+    cache = TieredCache("test", ROUTE, max_entries=10, ttl=0.5)
+    cache.put("a", b"1")
+    time.sleep(0.6)
+    cache.put("b", b"2")
+
+    cache.prune()
+
+    assert not memory_filesystem.exists(cache._path("a"))
+    assert memory_filesystem.exists(cache._path("b"))
+
+@pytest.mark.parametrize("max_bytes, kept", [(None, "abc"), (25, "bc"), (15, "c"), (5, "")])
+def test_prune_deletes_oldest_entries_over_max_bytes(memory_filesystem, max_bytes, kept):
+    cache = TieredCache("test", ROUTE, max_entries=10, ttl=60)
+    for key in "abc":
+        cache.put(key, b"x" * 10)
+        # Entries are ordered by their modification time
+        time.sleep(0.01)
+
+    cache.prune(max_bytes)
+
+    assert "".join(key for key in "abc" if memory_filesystem.exists(cache._path(key))) == kept
@@ -0,0 +1,93 @@
+"""
+actions_spodkast stores the input files it downloads with its own copy of the DocumentStore
+layout, as both functions are deployed separately. These tests keep both copies in step.
+"""
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from storage import DocumentStore
+
+ROUTE = "memory://spodkast/_documents"
+FOLDER = "memory://spodkast/owner/podcast/input_files"
+FILES = {"/a.pdf": b"%PDF-1.4 first document", "/b.pdf": b"%PDF-1.4 second document"}
+
+class FileServer(ThreadingHTTPServer):
+    """Serves FILES with an ETag, answering 304 to requests that send it back."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        self.transfers = 0
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+class FileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content = FILES[self.path]
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.transfers += 1
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def store(actions):
+    assert actions.DOCUMENT_STORE_ROUTE == ROUTE
+    return DocumentStore(ROUTE)
+
+def test_both_functions_store_documents_alike(actions, store, server, memory_filesystem):
+    url = server.url("/a.pdf")
+
+    digest = actions.store_document(url)
+
+    assert digest == hashlib.sha256(FILES["/a.pdf"]).hexdigest()
+    assert actions.document_path(digest) == store.path(digest)
+    assert memory_filesystem.cat(store.path(digest)) == FILES["/a.pdf"]
+    # The event manager finds the document by its url and doesn't transfer it again
+    assert store.download(url) == digest
+    assert server.transfers == 1
+
+def test_actions_reuse_documents_of_the_event_manager(actions, store, server):
+    url = server.url("/b.pdf")
+
+    digest = store.download(url)
+
+    assert actions.store_document(url) == digest
+    assert server.transfers == 1
+
+def test_both_functions_link_documents_alike(actions, store, server, memory_filesystem):
+    url = server.url("/a.pdf")
+    digest = store.download(url)
+
+    actions_link = actions.link_document(digest, f"{FOLDER}/a.pdf", url=url)
+    actions_files = {path: memory_filesystem.cat(path) for path in memory_filesystem.find(ROUTE)}
+    actions_content = memory_filesystem.cat(actions_link)
+    memory_filesystem.rm(actions_link)
+    memory_filesystem.rm(memory_filesystem.find(f"{ROUTE}/{digest}/refs"))
+    store_link = store.link(digest, f"{FOLDER}/a.pdf", url=url)
+
+    assert actions_link == store_link
+    assert json.loads(actions_content) == json.loads(memory_filesystem.cat(store_link))
+    assert {path: memory_filesystem.cat(path) for path in memory_filesystem.find(ROUTE)} == actions_files
+    assert DocumentStore.resolve(actions_link) == (digest, store.path(digest), "a.pdf")
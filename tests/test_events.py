@@ -0,0 +1,48 @@
+import base64
+import datetime
+import json
+import types
+
+import pytest
+
+def cloud_event(published):
+    event = {"entity": "spodkast", "entityId": "podcast", "operation": "create", "author": "owner",
+             "requestId": "request-1", "payload": "{}"}
+    message = {"data": base64.b64encode(json.dumps(event).encode()), "messageId": "message-1"}
+    if published is not None:
+        message["publishTime"] = published
+    return types.SimpleNamespace(data={"message": message})
+
+def ago(seconds, digits=9):
+    published = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=seconds)
+    return published.strftime("%Y-%m-%dT%H:%M:%S.%f")[:20 + digits] + "Z"
+
+@pytest.mark.parametrize("digits", [1, 3, 6])
+def test_event_age_reads_publish_times(event_manager, digits):
+    assert 59 < event_manager.event_age(ago(60, digits)) < 70
+
+def test_event_age_reads_nanoseconds(event_manager):
+    assert 59 < event_manager.event_age(ago(60)[:-1] + "123Z") < 70
+
+@pytest.mark.parametrize("published", [None, "", "yesterday"])
+def test_event_age_without_publish_time(event_manager, published):
+    assert event_manager.event_age(published) == 0.0
+
+@pytest.mark.parametrize("age, dispatched", [(0, True), (3600, True), (7 * 24 * 3600, False)])
+def test_old_events_are_dropped(event_manager, monkeypatch, age, dispatched):
+    events = []
+    monkeypatch.setattr(event_manager, "_dispatch_event", lambda event, **kwargs: events.append(event))
+    monkeypatch.setattr(event_manager, "export_spans", lambda: None)
+
+    event_manager.spodkast_event_manager(cloud_event(ago(age)))
+
+    assert len(events) == int(dispatched)
+
+def test_events_without_publish_time_are_dispatched(event_manager, monkeypatch):
+    events = []
+    monkeypatch.setattr(event_manager, "_dispatch_event", lambda event, **kwargs: events.append(event))
+    monkeypatch.setattr(event_manager, "export_spans", lambda: None)
+
+    event_manager.spodkast_event_manager(cloud_event(None))
+
+    assert len(events) == 1
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from idempotency import EventLedger, WorkspaceBusy, WorkspaceLease, event_key
+
+WORKSPACE = "memory://spodkast/owner/podcast"
+
+def event(request_id="request-1", operation="create"):
+    return {"entity": "spodkast", "entityId": "podcast", "operation": operation, "requestId": request_id}
+
+def test_event_key_identifies_requests():
+    assert event_key(event(), "message-1") == event_key(event(), "message-2")
+    assert event_key(event("request-1")) != event_key(event("request-2"))
+    assert event_key(event(operation="create")) != event_key(event(operation="extend"))
+
+def test_event_key_falls_back_to_message_id():
+    unstamped = event(request_id=None)
+    assert event_key(unstamped, "message-1") == event_key(unstamped, "message-1")
+    assert event_key(unstamped, "message-1") != event_key(unstamped, "message-2")
+    assert event_key(unstamped) is None
+
+def test_ledger_skips_handled_events():
+    ledger = EventLedger(WORKSPACE)
+    key = event_key(event())
+    assert ledger.lookup(key) is None
+
+    ledger.record(key, event(), message_id="message-1")
+
+    record = EventLedger(WORKSPACE).lookup(key)
+    assert (record["operation"], record["message_id"]) == ("create", "message-1")
+    assert ledger.lookup(event_key(event("request-2"))) is None
+
+def test_ledger_forgets_events_after_ttl(monkeypatch):
+    ledger = EventLedger(WORKSPACE, ttl=60)
+    key = event_key(event())
+    ledger.record(key, event())
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+
+    assert ledger.lookup(key) is None
+
+def test_lease_is_exclusive():
+    holder = WorkspaceLease(WORKSPACE, "event-1")
+    assert holder.acquire(wait=0)
+
+    with pytest.raises(WorkspaceBusy):
+        WorkspaceLease(WORKSPACE, "event-2").acquire(wait=0)
+    # Another delivery of the same event is told the lease is taken without waiting
+    assert WorkspaceLease(WORKSPACE, "event-1").acquire(wait=30) is False
+
+    holder.release()
+    assert WorkspaceLease(WORKSPACE, "event-2").acquire(wait=0)
+
+def test_expired_lease_is_reclaimed(memory_filesystem):
+    crashed = WorkspaceLease(WORKSPACE, "event-1", seconds=-1)
+    assert crashed.acquire(wait=0)
+
+    contender = WorkspaceLease(WORKSPACE, "event-2")
+    assert contender.acquire(wait=0)
+    assert contender.holder()["owner"] == contender.token
+
+    contender.release()
+    assert contender.holder() is None
+    assert memory_filesystem.glob(f"{WORKSPACE}/lease-reclaim-*") == []
+
+def test_unexpired_lease_is_not_reclaimed():
+    WorkspaceLease(WORKSPACE, "event-1", seconds=600).acquire(wait=0)
+
+    with pytest.raises(WorkspaceBusy):
+        WorkspaceLease(WORKSPACE, "event-2").acquire(wait=0.2)
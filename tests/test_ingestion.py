@@ -0,0 +1,51 @@
+import time
+
+from benchmark import make_pdf
+
+SPILL_DIR = "memory://spodkast/_spill"
+WORKSPACE = "memory://spodkast/owner/podcast"
+
+def test_spilled_pages_are_read_back_and_removed(event_manager, memory_filesystem):
+    pages = ["first page", "", "third \x1e page", "último"]
+
+    path = event_manager.spill_pages(iter(pages), SPILL_DIR)
+
+    assert path.startswith(SPILL_DIR + "/")
+    assert list(event_manager.iter_spilled_pages(path)) == ["first page", "", "third  page", "último"]
+    assert not memory_filesystem.exists(path)
+
+def test_spilled_pages_are_read_by_blocks(event_manager, monkeypatch):
+    monkeypatch.setattr(event_manager, "PDF_BLOCK_SIZE", 3)
+    pages = [f"page {i}" for i in range(10)]
+
+    assert list(event_manager.iter_spilled_pages(event_manager.spill_pages(pages, SPILL_DIR))) == pages
+
+def test_prune_deletes_only_old_spilled_pages(event_manager, memory_filesystem):
+    old = event_manager.spill_pages(["old"], SPILL_DIR)
+    time.sleep(0.6)
+    new = event_manager.spill_pages(["new"], SPILL_DIR)
+
+    assert event_manager.prune_spilled_pages(SPILL_DIR, ttl=0.5) == 1
+    assert not memory_filesystem.exists(old)
+    assert memory_filesystem.exists(new)
+
+def test_extracted_pages_are_spilled_not_returned(event_manager, memory_filesystem):
+    memory_filesystem.pipe(f"{WORKSPACE}/input_files/a.pdf", make_pdf(["first page", "second page"]))
+
+    path = event_manager.extract_pages(f"{WORKSPACE}/input_files/a.pdf", spill_dir=SPILL_DIR)
+
+    assert path.startswith(SPILL_DIR + "/")
+    assert [page.strip() for page in event_manager.iter_spilled_pages(path)] == ["first page", "second page"]
+
+def test_single_document_is_summarized_while_extracted(event_manager, memory_filesystem, monkeypatch):
+    memory_filesystem.pipe(f"{WORKSPACE}/input_files/a.pdf", make_pdf(["first page", "second page"]))
+    monkeypatch.setattr(event_manager, "INGESTION_PROCESSES", 4)
+    monkeypatch.setattr(event_manager, "SPILL_DIR", SPILL_DIR)
+    monkeypatch.setattr(event_manager, "extract_pages", None)
+    monkeypatch.setattr(event_manager, "generate_answer",
+                        lambda prompt, message_list, model, **kwargs: " ".join(message_list).strip())
+
+    summaries = event_manager.process_input_files(WORKSPACE)
+
+    assert [summary.split() for summary in summaries] == [["first", "page", "second", "page"]]
+    assert not memory_filesystem.exists(SPILL_DIR)
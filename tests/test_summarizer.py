@@ -0,0 +1,61 @@
+import random
+import re
+import threading
+import time
+
+import pytest
+
+# Every page starts with a marker of a single token, so no chunk splits it
+MARKER = re.compile(r"m\d{3}")
+
+class FakeLLM:
+    """
+    Stands for generate_answer: answers with the markers found in its messages, in order,
+    after a delay drawn from the messages, so calls finish out of document order.
+    """
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt, message_list, model, use_cache=True, on_text=None):
+        with self._lock:
+            self.calls.append((prompt, list(message_list)))
+        time.sleep(random.Random(str(message_list)).uniform(0, 0.01))
+        return " ".join(MARKER.findall(" ".join(message_list)))
+
+    def chunk_calls(self):
+        return [messages for prompt, messages in self.calls if prompt.startswith("You are a text analyst")]
+
+def make_pages(count):
+    return [f"m{i:03d} " + "lorem ipsum dolor sit amet " * 6 for i in range(count)]
+
+@pytest.fixture
+def llm(event_manager, monkeypatch):
+    fake = FakeLLM()
+    monkeypatch.setattr(event_manager, "generate_answer", fake)
+    return fake
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_summary_keeps_document_order(event_manager, llm, monkeypatch, max_workers):
+    monkeypatch.setattr(event_manager, "REDUCE_FAN_IN", 2)
+    pages = make_pages(40)
+    stats = {}
+
+    summary = event_manager.summarizer(pages=iter(pages), max_tokens=200, max_workers=max_workers, stats=stats)
+
+    assert summary.split() == [f"m{i:03d}" for i in range(40)]
+    chunks = list(event_manager.iter_text_chunks(pages, 200, event_manager.SUMMARIZER_MODEL))
+    assert len(chunks) > 2
+    assert stats["chunks"] == len(chunks)
+    assert llm.chunk_calls() == [[chunk] for chunk in chunks]
+    # Every reduce of a fan-in of 2 combines two summaries into one, until one is left
+    assert stats["calls"] == len(llm.calls) == 2 * len(chunks) - 1
+
+def test_single_chunk_is_not_reduced(event_manager, llm):
+    stats = {}
+
+    summary = event_manager.summarizer(text=make_pages(1)[0], stats=stats)
+
+    assert summary == "m000"
+    assert stats == {"chunks": 1, "calls": 1}
+    assert len(llm.calls) == 1